@@ -0,0 +1,627 @@
+"""Load generator and benchmark for the LAN chat server.
+
+Simulates many clients speaking the same hello/msg/command protocol as
+client.py, spread over several rooms, and measures what the server delivers:
+
+    python bench.py --spawn asyncio --clients 500 --rooms 20 --rate 1000
+    python bench.py --host 192.168.1.10 --port 3000 --clients 100
+    python bench.py --compare bench_results/a.json bench_results/b.json
+    python bench.py --spawn asyncio --wire binary
+    python bench.py --codec
+
+--wire binary makes the simulated clients use the binary wire format;
+--codec compares the JSON lines and binary encodings of chat messages
+offline: encode and decode time per message and bytes on the wire, plain
+and deflated.
+
+With --spawn the server is started in a scratch directory on a free port and
+its CPU and memory are sampled; otherwise pass --server-pid to sample an
+already running server. Every run is saved as JSON so runs can be compared
+between server modes and commits.
+
+A server on another machine caps connections and rate limits per address,
+except for its admins, so start it with the bench host as one:
+
+    python server.py --admin-ip 192.168.1.20
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import wire
+from framing import LineDecoder, READ_SIZE
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = "bench_results"
+MARKER = "bench"
+# /history is left out by default: its replies replay chat lines, which
+# would be counted as deliveries
+DEFAULT_COMMAND_MIX = "/users:4,/allrooms:2,/pm:3"
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.commands = 0
+        self.expected = 0  # deliveries the sent messages should fan out to
+        self.delivered = 0
+        self.replies = 0  # system/private lines received
+        self.bytes_in = 0
+        self.errors = 0
+        self.latencies = []  # ns, measured after warmup
+        self.measuring = False
+
+
+class SimClient:
+    """One simulated chat client on the bench event loop"""
+
+    def __init__(self, index, room, stats, binary=False):
+        self.index = index
+        self.username = f"{MARKER}{index}"
+        self.room = room
+        self.joined_at = 0  # perf_counter_ns() of the last /join
+        self.stats = stats
+        self.binary = binary
+        self.sending_binary = False
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        hello = {"username": self.username, "room": self.room}
+        if self.binary:
+            hello["wire"] = "binary"
+        self.send(hello)
+
+    def send(self, payload):
+        if self.sending_binary:
+            self.writer.write(wire.pack_payload(payload, encode_line))
+        else:
+            self.writer.write(encode_line(payload))
+
+    async def receive(self):
+        decoder = wire.FrameDecoder(max_frame=4 * 1024 * 1024)
+        if self.binary:
+            decoder.expect_binary()
+        stats = self.stats
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                stats.bytes_in += len(data)
+                now = time.perf_counter_ns()
+                for line in decoder.feed(data):
+                    msg = line if isinstance(line, dict) else json.loads(line)
+                    if msg.get("type") == "wire":
+                        self.writer.write(wire.WIRE_SWITCH + b"\n")
+                        self.sending_binary = True
+                    elif msg.get("type") == "ping":
+                        # Quiet clients would otherwise be reaped mid-run
+                        self.send({"type": "pong"})
+                        continue
+                    if msg.get("type") != "msg":
+                        stats.replies += 1
+                        continue
+                    parts = msg.get("msg", "").split("|")
+                    if len(parts) == 3 and parts[0] == MARKER:
+                        if int(parts[2]) < self.joined_at:
+                            # Backlog of a room just joined, not a delivery
+                            continue
+                        stats.delivered += 1
+                        if stats.measuring:
+                            stats.latencies.append(now - int(parts[2]))
+        except (OSError, ValueError):
+            stats.errors += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def encode_line(payload):
+    return (json.dumps(payload) + "\n").encode()
+
+
+class ProcessSampler:
+    """CPU time and resident memory of a process, via psutil or /proc"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.proc = psutil.Process(pid) if psutil else None
+        self.max_rss = 0
+
+    def sample(self):
+        """Return (cpu seconds, rss bytes), or None if unavailable"""
+        try:
+            if self.proc is not None:
+                cpu = self.proc.cpu_times()
+                rss = self.proc.memory_info().rss
+                result = (cpu.user + cpu.system, rss)
+            else:
+                with open(f"/proc/{self.pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                ticks = os.sysconf("SC_CLK_TCK")
+                cpu = (int(fields[11]) + int(fields[12])) / ticks
+                rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+                result = (cpu, rss)
+        except Exception:
+            # Process gone, no /proc, or a psutil.Error
+            return None
+        self.max_rss = max(self.max_rss, result[1])
+        return result
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition(":")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def make_command(name, clients, rooms):
+    if name == "/pm":
+        target = random.choice(clients).username
+        return f"/pm {target} {MARKER} private"
+    if name == "/join":
+        return f"/join {random.choice(rooms)}"
+    if name == "/search":
+        return f"/search {MARKER}"
+    return name
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[i]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(mode, port, extra_args, workdir):
+    cmd = [
+        sys.executable,
+        os.path.join(HERE, "server.py"),
+        "--mode",
+        mode,
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        # free_port() only checked the chat port
+        "--file-port",
+        "0",
+        *extra_args,
+    ]
+    proc = subprocess.Popen(
+        cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start listening")
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def run_load(args, stats, sampler):
+    rooms = [f"room{i}" for i in range(args.rooms)]
+    binary = args.wire == "binary"
+    clients = [
+        SimClient(i, rooms[i % len(rooms)], stats, binary) for i in range(args.clients)
+    ]
+    room_sizes = {room: 0 for room in rooms}
+    for client in clients:
+        room_sizes[client.room] += 1
+
+    # Connect in bounded batches so the accept queue is not flooded
+    gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with gate:
+            await client.connect(args.host, args.port)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(c) for c in clients))
+    connect_time = time.perf_counter() - started
+    readers = [asyncio.create_task(c.receive()) for c in clients]
+    await asyncio.sleep(0.5)
+
+    mix = parse_mix(args.command_mix)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+
+    tick = 0.01
+    credit = 0.0
+    last_sample = 0.0
+    last_tick = time.perf_counter()
+    cpu_start = sampler.sample() if sampler else None
+    started = time.perf_counter()
+    warmup_end = started + args.warmup
+    end = started + args.warmup + args.duration
+    measure_start = None  # set when the warmup ends
+    measured_from = None
+
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if not stats.measuring and now >= warmup_end:
+            stats.measuring = True
+            cpu_start = sampler.sample() if sampler else None
+            measured_from = (stats.sent, stats.delivered, stats.commands)
+            measure_start = now
+
+        credit += args.rate * (now - last_tick)
+        last_tick = now
+        while credit >= 1:
+            credit -= 1
+            client = random.choice(clients)
+            if names and random.random() < args.command_ratio:
+                cmd = make_command(random.choices(names, weights)[0], clients, rooms)
+                client.send({"type": "command", "cmd": cmd})
+                stats.commands += 1
+                if cmd.startswith("/join "):
+                    # Keep the expected fan-out in step with the move
+                    room_sizes[client.room] -= 1
+                    client.room = cmd.split()[1]
+                    client.joined_at = time.perf_counter_ns()
+                    room_sizes[client.room] += 1
+            else:
+                text = f"{MARKER}|{client.index}|{time.perf_counter_ns()}"
+                client.send({"type": "msg", "msg": text})
+                stats.sent += 1
+                stats.expected += room_sizes[client.room]
+        if sampler and now - last_sample >= 1:
+            sampler.sample()
+            last_sample = now
+        await asyncio.sleep(tick)
+
+    measure_end = time.perf_counter()
+    cpu_end = sampler.sample() if sampler else None
+    sent_end, commands_end = stats.sent, stats.commands
+    if measure_start is None:
+        # Over before the warmup was: nothing measured
+        measure_start = measure_end
+        measured_from = (sent_end, stats.delivered, commands_end)
+
+    # Let in-flight deliveries arrive
+    await asyncio.sleep(args.drain)
+    stats.measuring = False
+    delivered_end = stats.delivered
+
+    for client in clients:
+        client.close()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    elapsed = measure_end - measure_start
+    server = None
+    if cpu_start and cpu_end and elapsed > 0:
+        server = {
+            "cpu_percent": round(100 * (cpu_end[0] - cpu_start[0]) / elapsed, 1),
+            "rss_mb": round(cpu_end[1] / 1e6, 1),
+            "max_rss_mb": round(sampler.max_rss / 1e6, 1),
+        }
+    return {
+        "connect_seconds": round(connect_time, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_sent": sent_end - measured_from[0],
+        "commands_sent": commands_end - measured_from[2],
+        "deliveries": delivered_end - measured_from[1],
+        "server": server,
+    }
+
+
+def summarize(stats, run):
+    lat = sorted(stats.latencies)
+
+    def ms(ns):
+        return None if ns is None else round(ns / 1e6, 3)
+
+    elapsed = run["elapsed_seconds"] or 1
+    try:
+        import resource
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        client_cpu = usage.ru_utime + usage.ru_stime
+    except ImportError:
+        client_cpu = None
+    return {
+        "throughput": {
+            "messages_in_per_sec": round(run["messages_sent"] / elapsed, 1),
+            "commands_per_sec": round(run["commands_sent"] / elapsed, 1),
+            "deliveries_per_sec": round(run["deliveries"] / elapsed, 1),
+            "delivery_ratio": round(stats.delivered / stats.expected, 4)
+            if stats.expected
+            else None,
+            "mb_in_per_sec": round(stats.bytes_in / 1e6 / elapsed, 3),
+        },
+        "latency_ms": {
+            "samples": len(lat),
+            "p50": ms(percentile(lat, 0.50)),
+            "p90": ms(percentile(lat, 0.90)),
+            "p99": ms(percentile(lat, 0.99)),
+            "max": ms(lat[-1] if lat else None),
+        },
+        "server": run["server"],
+        "client_cpu_seconds": client_cpu,
+        "errors": stats.errors,
+        "connect_seconds": run["connect_seconds"],
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+            timeout=5,
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(result):
+    cfg = result["config"]
+    print(
+        f"{cfg['clients']} clients / {cfg['rooms']} rooms, {cfg['rate']} sends/s "
+        f"for {cfg['duration']}s (server: {cfg['server_mode'] or 'external'})"
+    )
+    for section in ("throughput", "latency_ms", "server"):
+        values = result["results"].get(section)
+        if not values:
+            continue
+        print(f"  {section}:")
+        for key, value in values.items():
+            print(f"    {key:22} {value}")
+    print(f"  errors: {result['results']['errors']}")
+
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            flatten(f"{prefix}.{key}" if prefix else key, inner, out)
+    else:
+        out[prefix] = value
+    return out
+
+
+def compare(paths):
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    tables = [flatten("", run["results"], {}) for run in runs]
+    keys = [k for k in tables[0] if all(k in t for t in tables[1:])]
+    width = max(len(k) for k in keys) + 2
+    header = "".join(
+        f"{(r['config']['server_mode'] or 'ext') + '@' + (r.get('commit') or '?'):>18}"
+        for r in runs
+    )
+    print(f"{'':{width}}{header}")
+    for key in keys:
+        row = "".join(f"{str(t[key]):>18}" for t in tables)
+        print(f"{key:{width}}{row}")
+
+
+def codec_benchmark(count):
+    """Encode and decode `count` chat messages as JSON lines and as binary
+    frames, the way the server and a client handle them"""
+    rng = random.Random(1)
+    words = ["lunch", "build", "deploy", "meeting", "ok", "thanks", "on my way", "ship it"]
+    messages = [
+        {
+            "type": "msg",
+            "room": f"room{rng.randrange(20)}",
+            "from": f"user{rng.randrange(200)}",
+            "msg": " ".join(rng.choices(words, k=rng.randint(1, 12))),
+            "time": f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}",
+            "seq": i,
+        }
+        for i in range(count)
+    ]
+
+    def timed(fn):
+        started = time.perf_counter()
+        result = fn()
+        return result, (time.perf_counter() - started) * 1e9 / count
+
+    lines, json_encode = timed(lambda: [encode_line(m) for m in messages])
+    interner = wire.Interner()
+    names = wire.Names()
+
+    def pack_all():
+        frames = []
+        for message, line in zip(messages, lines):
+            packed = wire.pack_message(message, line, interner)
+            names.send(packed, frames.append)
+        return frames
+
+    frames, binary_encode = timed(pack_all)
+    json_stream = b"".join(lines)
+    binary_stream = wire.WIRE_SWITCH + b"\n" + b"".join(frames)
+
+    def decode_json():
+        decoder = LineDecoder(max_frame=len(json_stream))
+        return [json.loads(line) for line in decoder.feed(json_stream)]
+
+    def decode_binary():
+        decoder = wire.FrameDecoder(max_frame=len(binary_stream))
+        decoder.expect_binary()
+        return decoder.feed(binary_stream)[1:]
+
+    decoded_json, json_decode = timed(decode_json)
+    decoded_binary, binary_decode = timed(decode_binary)
+    assert decoded_json == decoded_binary == messages
+
+    def deflated(data):
+        return len(zlib.compress(data, 6)) / count
+
+    print(f"{count} chat messages, 200 users in 20 rooms")
+    print(f"  {'':24}{'json':>10}{'binary':>10}")
+    for label, a, b in (
+        ("encode ns/msg", json_encode, binary_encode),
+        ("decode ns/msg", json_decode, binary_decode),
+        ("bytes/msg", len(json_stream) / count, len(binary_stream) / count),
+        ("bytes/msg deflated", deflated(json_stream), deflated(binary_stream)),
+    ):
+        print(f"  {label:24}{a:>10.1f}{b:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAN Chat load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument(
+        "--spawn",
+        metavar="MODE",
+        choices=("threaded", "asyncio"),
+        help="start a private server in this mode on a free port",
+    )
+    parser.add_argument(
+        "--server-arg",
+        action="append",
+        default=[],
+        help="extra argument for the spawned server (repeatable)",
+    )
+    parser.add_argument("--server-pid", type=int, help="sample CPU/memory of this pid")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--rate", type=float, default=200, help="sends per second, total")
+    parser.add_argument(
+        "--command-ratio",
+        type=float,
+        default=0.05,
+        help="fraction of sends that are commands",
+    )
+    parser.add_argument(
+        "--command-mix",
+        default=DEFAULT_COMMAND_MIX,
+        help="weighted commands, e.g. '/users:4,/pm:1'",
+    )
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for stragglers")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument(
+        "--wire",
+        choices=("text", "binary"),
+        default="text",
+        help="wire format the simulated clients ask for",
+    )
+    parser.add_argument(
+        "--codec",
+        nargs="?",
+        type=int,
+        const=100000,
+        metavar="MESSAGES",
+        help="compare the JSON and binary encodings offline and exit",
+    )
+    parser.add_argument("--output", help="result file (default: bench_results/<time>.json)")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="compare saved runs")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+    if args.codec:
+        codec_benchmark(args.codec)
+        return
+
+    raise_fd_limit()
+    proc = None
+    workdir = None
+    pid = args.server_pid
+    stats = Stats()
+    try:
+        if args.spawn:
+            args.host = "127.0.0.1"
+            args.port = free_port()
+            workdir = tempfile.mkdtemp(prefix="chat-bench-")
+            proc = spawn_server(args.spawn, args.port, args.server_arg, workdir)
+            pid = proc.pid
+        sampler = ProcessSampler(pid) if pid else None
+        run = asyncio.run(run_load(args, stats, sampler))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            "server_mode": args.spawn,
+            "server_args": args.server_arg,
+            "wire": args.wire,
+            "clients": args.clients,
+            "rooms": args.rooms,
+            "rate": args.rate,
+            "command_ratio": args.command_ratio,
+            "command_mix": args.command_mix,
+            "duration": args.duration,
+            "warmup": args.warmup,
+        },
+        "results": summarize(stats, run),
+    }
+    print_report(result)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{args.spawn or 'external'}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
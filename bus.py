@@ -0,0 +1,146 @@
+"""Publish/subscribe bus between the worker processes of one server.
+
+With --workers N the server forks N processes that all accept on the same
+port through SO_REUSEPORT, so the kernel spreads clients across cores. The
+supervisor process runs a BusHub on a Unix domain socket and every worker
+keeps one BusClient connection to it.
+
+Events are JSON objects with an "op" field, one per line. The first event a
+worker sends is {"op": "hello", "worker": <index>}. The hub hands every
+event to a callback, which decides whether to relay it to the other workers,
+route it to a single one, or handle it itself.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+
+from framing import LineDecoder, READ_SIZE
+
+MAX_EVENT_SIZE = 16 * 1024 * 1024  # longest event line, in bytes
+CONNECT_TIMEOUT = 10.0  # seconds a worker waits for the hub to come up
+
+
+def _frame(event):
+    """Wire form of an event: a dict, or an already encoded line"""
+    if isinstance(event, bytes):
+        return event + b"\n"
+    return (json.dumps(event) + "\n").encode()
+
+
+class BusHub:
+    """Accepts worker connections and dispatches their events.
+
+    on_event(hub, worker, event, line) runs on the hub's event loop for every
+    event; line is the raw encoded event so it can be relayed without being
+    serialized again. on_disconnect(hub, worker) runs when a worker goes away.
+    """
+
+    def __init__(self, path, on_event, on_disconnect=None):
+        self.path = path
+        self.on_event = on_event
+        self.on_disconnect = on_disconnect
+        self.workers = {}  # worker index -> StreamWriter
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        decoder = LineDecoder(max_frame=MAX_EVENT_SIZE)
+        worker = None
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                for line in decoder.feed(data):
+                    event = json.loads(line)
+                    if worker is None:
+                        worker = event["worker"]
+                        self.workers[worker] = writer
+                    self.on_event(self, worker, event, line)
+        except asyncio.CancelledError:
+            # Hub shutting down
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Bus error from worker {worker}: {e}")
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                if self.on_disconnect is not None:
+                    self.on_disconnect(self, worker)
+            writer.close()
+
+    def send(self, worker, event):
+        """Deliver an event to one worker"""
+        writer = self.workers.get(worker)
+        if writer is not None:
+            writer.write(_frame(event))
+
+    def publish(self, event, exclude=None):
+        """Deliver an event to every worker except `exclude`"""
+        data = _frame(event)
+        for worker, writer in list(self.workers.items()):
+            if worker != exclude:
+                writer.write(data)
+
+
+class BusClient:
+    """A worker's connection to the hub.
+
+    publish() may be called from any thread. Incoming events are passed to
+    on_event from a reader thread; on_close runs once if the hub goes away.
+    """
+
+    def __init__(self, path, worker, on_event, on_close=None):
+        self.path = path
+        self.worker = worker
+        self.on_event = on_event
+        self.on_close = on_close
+        self.sock = None
+        self._lock = threading.Lock()
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+        self.sock = sock
+        self.publish({"op": "hello", "worker": self.worker})
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def publish(self, event):
+        data = _frame(event)
+        with self._lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+    def _read_loop(self):
+        decoder = LineDecoder(max_frame=MAX_EVENT_SIZE)
+        try:
+            frames = decoder.read_from(self.sock)
+            while frames is not None:
+                for line in frames:
+                    self.on_event(json.loads(line))
+                frames = decoder.read_from(self.sock)
+        except (OSError, ValueError) as e:
+            print(f"Bus connection lost: {e}")
+        if self.on_close is not None:
+            self.on_close()
@@ -1,8 +1,67 @@
 import socket
+import select
 import threading
 import tkinter as tk
-from tkinter import simpledialog, scrolledtext, messagebox
+from tkinter import simpledialog, scrolledtext, messagebox, filedialog
 import json
+import os
+import queue
+import itertools
+import bisect
+import collections
+import random
+import time
+
+import wire
+from multicast import Receiver
+
+SERVER_PORT = 3000
+
+# Server lines can be much longer than ours (e.g. /users in a big room)
+MAX_SERVER_FRAME = 1024 * 1024
+
+# Rendering: queued text is flushed to the chat area every tick
+RENDER_INTERVAL_MS = 50
+MAX_SEGMENTS_PER_TICK = 5000
+MAX_SCROLLBACK_LINES = 5000
+
+# Ask the server to zlib-compress what it sends; older servers ignore it
+COMPRESS = True
+
+# Ask for the compact binary wire format; older servers ignore it
+BINARY = True
+
+# Take room traffic by multicast when the server offers it
+MULTICAST = True
+
+# Once the server has pinged us, we ping it back whenever it is silent for its
+# ping interval, and give up on it after this many intervals of silence
+HEARTBEAT_TIMEOUT = 3
+
+# When the connection drops we redial after RECONNECT_MIN seconds, doubling up
+# to RECONNECT_MAX, and resume the session: the server keeps our place for a
+# while and replays what we missed
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+CONNECT_TIMEOUT = 5.0
+
+# Room messages remembered by seq, so ones replayed twice are shown once
+SEEN_LIMIT = 2000
+
+# File transfers run on their own connection to the server's file port
+FILE_CHUNK_SIZE = 256 * 1024
+
+
+def encode(payload):
+    return (json.dumps(payload) + "\n").encode()
+
+
+def format_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024:
+            return f"{size:g} {unit}"
+        size = round(size / 1024, 1)
+    return f"{size:g} GB"
 
 
 class ChatClient:
@@ -13,10 +72,37 @@ class ChatClient:
         self.root.minsize(600, 400)
 
         self.sock = None
+        self.binary = False  # sending binary frames on the current connection
+        self.send_lock = threading.Lock()
+        self.multicast = None
         self.running = False
+        self.server_ip = ""
         self.username = ""
         self.room = ""
 
+        # Session resume: the server's token and the last seq seen per room
+        self.session = None
+        self.epoch = None
+        self.last_seq = {}
+        self.seen = set()
+        self.seen_order = collections.deque()
+        self.seen_lock = threading.Lock()
+        self.in_backlog = False  # between "backlog" markers: messages we asked to see again
+
+        # Users list: names in the listbox, kept sorted, and connections per name
+        self.roster_room = None
+        self.roster_version = 0
+        self.roster_names = []
+        self.roster_counts = {}
+
+        # Files offered to the server, by request ref, until it grants the upload
+        self.uploads = {}
+        self.upload_refs = itertools.count()
+
+        # Text and UI updates waiting for the Tk thread
+        self.ui_queue = queue.SimpleQueue()
+        self.render_job = None
+
         # Set color scheme
         self.bg_color = "#f0f0f0"
         self.root.configure(bg=self.bg_color)
@@ -116,6 +202,7 @@ class ChatClient:
         self.text_area.tag_config(
             "sender", foreground="#27ae60", font=("Courier", 9, "bold")
         )
+        self.text_area.tag_config("file", foreground="#8e44ad", underline=True)
 
         # Input frame
         input_frame = tk.Frame(self.root, bg=self.bg_color)
@@ -157,6 +244,17 @@ class ChatClient:
         )
         cmd_btn.pack(side=tk.RIGHT, padx=5)
 
+        # Send file button
+        file_btn = tk.Button(
+            input_frame,
+            text="Send file",
+            command=self.send_file,
+            font=("Arial", 10),
+            padx=15,
+            pady=5
+        )
+        file_btn.pack(side=tk.RIGHT, padx=5)
+
         # Status bar
         self.status_label = tk.Label(
             self.root,
@@ -189,16 +287,19 @@ class ChatClient:
             if not room:
                 room = "general"
 
+            self.server_ip = server_ip
             self.username = username
             self.room = room
 
             # Connect to server
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((server_ip, 3000))
-
-            # Send initial connection data
-            payload = {"username": username, "room": room}
-            self.sock.sendall((json.dumps(payload) + "\n").encode())
+            self.open_connection()
+            if MULTICAST:
+                self.multicast = Receiver(
+                    self.sock.getsockname()[0],
+                    self.handle_message,
+                    self.send_payload,
+                    lambda count: self.display_message(f"⚠ {count} messages were lost", "system"),
+                )
 
             # Update status
             self.info_label.config(text=f"👤 {username} | 🏠 {room}")
@@ -207,6 +308,7 @@ class ChatClient:
 
             # Start receiving thread
             self.running = True
+            self.render_job = self.root.after(RENDER_INTERVAL_MS, self.render_pending)
             receive_thread = threading.Thread(target=self.receive, daemon=True)
             receive_thread.start()
 
@@ -226,39 +328,124 @@ class ChatClient:
             self.root.destroy()
             return False
 
+    def open_connection(self):
+        """Connect and send the hello; after a drop, ask to resume the session"""
+        sock = socket.create_connection((self.server_ip, SERVER_PORT), timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        payload = {"username": self.username, "room": self.room, "session": True}
+        if self.session is not None:
+            payload["resume"] = self.session
+        if self.room in self.last_seq:
+            payload["seq"] = self.last_seq[self.room]
+        if COMPRESS:
+            payload["compress"] = "zlib"
+        if MULTICAST:
+            payload["multicast"] = True
+        if BINARY:
+            payload["wire"] = "binary"
+        sock.sendall((json.dumps(payload) + "\n").encode())
+        with self.send_lock:
+            self.sock = sock
+            self.binary = False
+
     def receive(self):
-        """Receive messages from server"""
-        buffer = ""
+        """Receive messages from server, reconnecting whenever the connection drops"""
         while self.running:
+            self.read_messages()
+            if not self.running:
+                break
+            self.display_message("⚠ Disconnected from server", "system")
+            if not self.reconnect():
+                break
+
+    def reconnect(self):
+        """Redial with exponential backoff; jitter keeps a whole office of
+        clients from reconnecting in lockstep after a server restart"""
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        delay = RECONNECT_MIN
+        while self.running:
+            wait = random.uniform(delay / 2, delay)
+            self.run_on_ui(
+                lambda: self.status_label.config(text=f"✗ Disconnected, retrying in {wait:.1f}s")
+            )
+            time.sleep(wait)
+            if not self.running:
+                break
             try:
-                data = self.sock.recv(1024).decode()
-                if not data:
+                self.open_connection()
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+            self.display_message("✓ Reconnected", "system")
+            self.run_on_ui(lambda: self.status_label.config(text="✓ Connected to server"))
+            return True
+        return False
+
+    def read_messages(self):
+        """Handle messages from the current connection until it drops"""
+        decoder = wire.FrameDecoder(max_frame=MAX_SERVER_FRAME)
+        if COMPRESS:
+            decoder.expect_compression()
+        if BINARY:
+            decoder.expect_binary()
+        # Servers that ping tell us their interval; until then never time out.
+        # The wait is a select() so sends from the UI thread keep blocking
+        # rather than time out halfway through a frame.
+        heartbeat = None
+        last_recv = time.monotonic()
+        self.in_backlog = False
+        while self.running:
+            try:
+                if heartbeat is not None and not select.select([self.sock], [], [], heartbeat)[0]:
+                    if time.monotonic() - last_recv > heartbeat * HEARTBEAT_TIMEOUT:
+                        raise ConnectionError("server stopped responding")
+                    self.send_payload({"type": "ping"})
+                    continue
+                frames = decoder.read_from(self.sock)
+                if frames is None:
                     break
+                last_recv = time.monotonic()
 
-                buffer += data
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if not line.strip():
+                for line in frames:
+                    if isinstance(line, dict):
+                        # Decoded from a binary frame
+                        msg = line
+                    elif not line.strip():
                         continue
-
-                    try:
-                        msg = json.loads(line)
+                    else:
+                        try:
+                            msg = json.loads(line)
+                        except ValueError:
+                            continue
+                    if msg["type"] == "wire":
+                        self.switch_to_binary()
+                    elif msg["type"] == "ping":
+                        if heartbeat is None:
+                            heartbeat = msg.get("interval") or 30.0
+                        self.send_payload({"type": "pong"})
+                    elif msg["type"] == "backlog":
+                        self.in_backlog = not msg.get("end")
+                    elif msg["type"] != "pong":
                         self.handle_message(msg)
-                    except json.JSONDecodeError:
-                        continue
 
             except Exception as e:
                 if self.running:
                     self.display_message(f"⚠ Connection lost: {str(e)}", "system")
                 break
 
-        if self.running:
-            self.display_message("⚠ Disconnected from server", "system")
-            self.status_label.config(text="✗ Disconnected")
-
     def handle_message(self, msg):
         """Handle different types of messages"""
+        if self.multicast is not None and self.multicast.handle(msg):
+            return
+
         if msg["type"] == "msg":
+            if not self.first_sighting(msg):
+                return
             timestamp = msg.get("time", "")
             sender = msg.get("from", "Unknown")
             text = msg.get("msg", "")
@@ -282,15 +469,127 @@ class ChatClient:
                 f"[{timestamp}] 🔒 [PM from {sender}] {text}", "private"
             )
 
+        elif msg["type"] == "presence":
+            self.run_on_ui(lambda: self.update_users(msg))
+
+        elif msg["type"] == "file":
+            self.show_file(msg)
+
+        elif msg["type"] == "upload":
+            path = self.uploads.pop(msg.get("ref"), None)
+            if path is not None:
+                threading.Thread(target=self.upload, args=(path, msg), daemon=True).start()
+
+        elif msg["type"] == "download":
+            self.run_on_ui(lambda: self.save_download(msg))
+
+        elif msg["type"] == "session":
+            self.session = msg["token"]
+            if msg.get("epoch") != self.epoch:
+                # A restarted server may hand out seqs we have seen again
+                self.epoch = msg.get("epoch")
+                with self.seen_lock:
+                    self.seen.clear()
+                    self.seen_order.clear()
+
+    def first_sighting(self, msg):
+        """Note a room message's seq; False if it was already shown"""
+        if "seq" not in msg:
+            return True
+        room = msg.get("room")
+        key = (room, msg["seq"])
+        with self.seen_lock:
+            if key in self.seen:
+                # Only a resume replay repeats itself; /history and the
+                # /join backlog were asked for
+                return self.in_backlog
+            self.seen.add(key)
+            self.seen_order.append(key)
+            if len(self.seen_order) > SEEN_LIMIT:
+                self.seen.discard(self.seen_order.popleft())
+            if msg["seq"] > self.last_seq.get(room, -1):
+                self.last_seq[room] = msg["seq"]
+        return True
+
+    def update_users(self, msg):
+        """Apply a presence snapshot or delta to the users list (Tk thread)"""
+        if "users" in msg:
+            # Snapshot on entering a room: the only time the list is rebuilt
+            self.roster_room = msg["room"]
+            self.roster_version = msg["v"]
+            self.roster_counts = {}
+            for name in msg["users"]:
+                self.roster_counts[name] = self.roster_counts.get(name, 0) + 1
+            self.roster_names = sorted(self.roster_counts)
+            self.users_listbox.delete(0, tk.END)
+            self.users_listbox.insert(tk.END, *self.roster_names)
+            if self.room != msg["room"]:
+                self.room = msg["room"]
+                self.info_label.config(text=f"👤 {self.username} | 🏠 {self.room}")
+                self.root.title(f"LAN Chat - {self.username} @ {self.room}")
+            return
+
+        if msg["room"] != self.roster_room or msg["v"] <= self.roster_version:
+            # For another room, or already part of the snapshot
+            return
+        self.roster_version = msg["v"]
+        for name in msg.get("join", ()):
+            count = self.roster_counts.get(name, 0)
+            self.roster_counts[name] = count + 1
+            if not count:
+                i = bisect.bisect_left(self.roster_names, name)
+                self.roster_names.insert(i, name)
+                self.users_listbox.insert(i, name)
+        for name in msg.get("leave", ()):
+            count = self.roster_counts.get(name, 0)
+            if count > 1:
+                self.roster_counts[name] = count - 1
+            elif count:
+                del self.roster_counts[name]
+                i = bisect.bisect_left(self.roster_names, name)
+                del self.roster_names[i]
+                self.users_listbox.delete(i)
+
     def display_message(self, message, tag=None, newline=True):
-        """Display message in text area"""
-        self.text_area.config(state="normal")
-        if tag:
-            self.text_area.insert("end", message + ("\n" if newline else ""), tag)
-        else:
-            self.text_area.insert("end", message + ("\n" if newline else ""))
-        self.text_area.config(state="disabled")
-        self.text_area.see("end")
+        """Queue text for the chat area; safe to call from any thread"""
+        self.ui_queue.put((message + ("\n" if newline else ""), tag or ()))
+
+    def run_on_ui(self, callback):
+        """Run a callback on the Tk thread at the next render tick"""
+        self.ui_queue.put(callback)
+
+    def render_pending(self):
+        """Flush queued text to the chat area in a single insert.
+
+        Runs on the Tk thread every RENDER_INTERVAL_MS. All (text, tag) pairs
+        pending since the last tick go into one Text.insert call, followed by
+        one trim of old lines and one scroll.
+        """
+        chunks = []
+        callbacks = []
+        for _ in range(MAX_SEGMENTS_PER_TICK):
+            try:
+                item = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            if callable(item):
+                callbacks.append(item)
+            else:
+                chunks.extend(item)
+
+        if chunks:
+            self.text_area.config(state="normal")
+            self.text_area.insert("end", *chunks)
+            lines = int(self.text_area.index("end-1c").split(".")[0])
+            if lines > MAX_SCROLLBACK_LINES:
+                self.text_area.delete("1.0", f"{lines - MAX_SCROLLBACK_LINES}.0")
+            self.text_area.config(state="disabled")
+            self.text_area.see("end")
+
+        for callback in callbacks:
+            callback()
+
+        self.render_job = self.root.after(RENDER_INTERVAL_MS, self.render_pending)
 
     def send_msg(self, event=None):
         """Send message to server"""
@@ -300,16 +599,108 @@ class ChatClient:
 
         self.entry.delete(0, tk.END)
 
-        try:
-            if msg.startswith("/"):
-                payload = {"type": "command", "cmd": msg}
-            else:
-                payload = {"type": "msg", "msg": msg}
+        if msg.startswith("/"):
+            self.send_payload({"type": "command", "cmd": msg})
+        else:
+            self.send_payload({"type": "msg", "msg": msg})
 
-            self.sock.sendall((json.dumps(payload) + "\n").encode())
+    def send_payload(self, payload):
+        try:
+            with self.send_lock:
+                if self.binary:
+                    self.sock.sendall(wire.pack_payload(payload, encode))
+                else:
+                    self.sock.sendall(encode(payload))
         except Exception as e:
             self.display_message(f"⚠ Error sending message: {str(e)}", "system")
 
+    def switch_to_binary(self):
+        """The server speaks binary now; tell it we do too from here on"""
+        with self.send_lock:
+            self.sock.sendall(wire.WIRE_SWITCH + b"\n")
+            self.binary = True
+
+    def send_file(self):
+        """Offer a file to the room; it is uploaded once the server grants it"""
+        path = filedialog.askopenfilename(title="Send file")
+        if not path:
+            return
+        ref = next(self.upload_refs)
+        self.uploads[ref] = path
+        self.send_payload(
+            {"type": "upload", "ref": ref, "name": os.path.basename(path), "size": os.path.getsize(path)}
+        )
+
+    def show_file(self, msg):
+        """Show a shared file as a link that downloads it when clicked"""
+        tag = f"file-{msg['id']}"
+        self.display_message(f"[{msg.get('time', '')}] ", "timestamp", newline=False)
+        self.display_message(f"{msg.get('from', 'Unknown')}: ", "sender", newline=False)
+        self.display_message(f"📎 {msg['name']} ({format_size(msg['size'])})", ("file", tag))
+        self.run_on_ui(
+            lambda: self.text_area.tag_bind(
+                tag, "<Button-1>", lambda event: self.send_payload({"type": "download", "id": msg["id"]})
+            )
+        )
+
+    def open_file_channel(self, grant):
+        """Connect to the file port and present a ticket"""
+        sock = socket.create_connection((self.server_ip, grant["port"]))
+        sock.sendall((json.dumps({"ticket": grant["ticket"]}) + "\n").encode())
+        return sock
+
+    def upload(self, path, grant):
+        """Send a file to the file port; runs in its own thread"""
+        name = os.path.basename(path)
+        self.run_on_ui(lambda: self.status_label.config(text=f"Uploading {name}..."))
+        try:
+            with self.open_file_channel(grant) as sock, open(path, "rb") as f:
+                sock.sendfile(f)
+                reply = json.loads(sock.makefile("rb").readline() or b"{}")
+        except (OSError, ValueError) as e:
+            reply = {"error": str(e)}
+        if reply.get("ok"):
+            status = f"✓ Sent {name}"
+        else:
+            status = f"✗ Could not send {name}"
+            self.display_message(f"⚠ {status}: {reply.get('error', 'connection closed')}", "system")
+        self.run_on_ui(lambda: self.status_label.config(text=status))
+
+    def save_download(self, grant):
+        """Ask where to save a granted download, then fetch it"""
+        path = filedialog.asksaveasfilename(title="Save file", initialfile=grant["name"])
+        if path:
+            threading.Thread(target=self.download, args=(path, grant), daemon=True).start()
+
+    def download(self, path, grant):
+        """Fetch a file from the file port; runs in its own thread"""
+        name = grant["name"]
+        self.run_on_ui(lambda: self.status_label.config(text=f"Downloading {name}..."))
+        complete = False
+        try:
+            with self.open_file_channel(grant) as sock:
+                reader = sock.makefile("rb")
+                header = json.loads(reader.readline() or b"{}")
+                error = header.get("error", "connection closed")
+                if header.get("ok"):
+                    received = 0
+                    with open(path, "wb") as f:
+                        while received < header["size"]:
+                            chunk = reader.read1(FILE_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            received += len(chunk)
+                    complete = received == header["size"]
+        except (OSError, ValueError) as e:
+            error = str(e)
+        if complete:
+            status = f"✓ Saved {name}"
+        else:
+            status = f"✗ Could not download {name}"
+            self.display_message(f"⚠ {status}: {error}", "system")
+        self.run_on_ui(lambda: self.status_label.config(text=status))
+
     def show_help(self):
         """Show help dialog with available commands"""
         help_text = """
@@ -329,9 +720,22 @@ class ChatClient:
 /pm <username> <message>
   └─ Send a private message to a user
 
+/history [before] [count]
+  └─ Show earlier messages in this room
+
+/search <terms> [room]
+  └─ Search chat history
+
+/stats
+  └─ Show server statistics (admins only)
+
 /help
   └─ Display this help message
 
+Send file
+  └─ Share a file with the room; click a shared
+     file to download it
+
 ═══════════════════════════════════════════════════
 
 TIPS:
@@ -345,8 +749,14 @@ TIPS:
     def on_closing(self):
         """Handle window closing"""
         self.running = False
+        if self.render_job is not None:
+            self.root.after_cancel(self.render_job)
+        if self.multicast is not None:
+            self.multicast.close()
         if self.sock:
             try:
+                # Leaving for good: the server need not hold our place
+                self.send_payload({"type": "bye"})
                 self.sock.close()
             except Exception:
                 pass
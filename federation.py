@@ -0,0 +1,375 @@
+"""Server-to-server federation.
+
+Chat servers on different floors or subnets can be linked so that rooms
+span all of them. Each server has a name and any number of peer links:
+outbound ones it keeps dialling (--peer host:port) and inbound ones accepted
+on its federation port. Links carry the same events as the worker bus (msg,
+room, pm, join, move, leave), so a server sees the users of its peers the
+same way it sees clients of another worker.
+
+Every event is stamped with a message id ("<origin>/<n>") and a hop count
+and flooded over every link except the one it arrived on. Ids already seen
+are dropped, which stops loops in any topology. Presence events, including
+the duplicates, record which links lead to each remote client; private
+messages follow one of those routes instead of being flooded. Presence ids
+start with "<server name>/", so a server ignores its own clients when they
+are echoed back.
+
+Every server floods an "alive" event each HEARTBEAT_INTERVAL. When nothing
+has been heard from a server for PEER_TIMEOUT, its clients are dropped; a
+lost link alone only drops the clients no other link leads to, and only
+locally, since the peers on the other side may still reach them.
+
+On the wire a link is newline-delimited JSON: one {"peer": name} line from
+each side, then {"batch": [event, ...]} lines. Events queued within
+BATCH_DELAY of each other share a line. Events of any other kind than the
+ones a link carries are dropped on arrival.
+
+Only trusted peers get a link. Without a shared secret, inbound links are
+accepted only from the hosts this server dials itself. With one, every link
+must prove it: each side adds a random nonce to its peer line and answers
+the other's with a {"proof": hmac} line, the HMAC-SHA256 under the secret of
+its own name and that nonce.
+"""
+
+import collections
+import hashlib
+import hmac
+import itertools
+import json
+import secrets
+import socket
+import threading
+import time
+
+from framing import LineDecoder
+
+PRESENCE_OPS = ("join", "move", "leave")
+BATCH_DELAY = 0.005  # seconds a link waits for more events before sending
+BATCH_MAX = 500  # events per batch
+PEER_QUEUE_SIZE = 100000  # events queued per link before the oldest are dropped
+MAX_BATCH_SIZE = 64 * 1024 * 1024  # longest batch line accepted, in bytes
+MAX_HOPS = 16
+SEEN_LIMIT = 100000  # message ids remembered for deduplication
+CONNECT_TIMEOUT = 5.0
+RECONNECT_MIN = 0.5  # seconds between dial attempts, doubled up to RECONNECT_MAX
+RECONNECT_MAX = 30.0
+HEARTBEAT_INTERVAL = 2.0  # seconds between "alive" events
+PEER_TIMEOUT = 6.0  # silence after which a server's clients are dropped
+
+
+class PeerLink:
+    """One connection to a peer server with a batching writer thread"""
+
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.name = name
+        self.queue = collections.deque()
+        self.closed = False
+        self.sent = 0
+        self.received = 0
+        self.batches = 0
+        self.dropped = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def send(self, event):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self.queue) >= PEER_QUEUE_SIZE:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(event)
+            self._cond.notify()
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self.queue and not self.closed:
+                        self._cond.wait()
+                    if self.closed:
+                        return
+                # Let the batch fill up
+                time.sleep(BATCH_DELAY)
+                with self._cond:
+                    count = min(len(self.queue), BATCH_MAX)
+                    batch = [self.queue.popleft() for _ in range(count)]
+                self.sock.sendall((json.dumps({"batch": batch}) + "\n").encode())
+                self.sent += len(batch)
+                self.batches += 1
+        except OSError:
+            self.close()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self.queue.clear()
+            self._cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Federation:
+    """The peer links of one server.
+
+    on_event(event) is called from link threads for every new event from a
+    peer whose op is one of ops. snapshot() returns join events for every
+    client this server knows about; they are sent to each peer when its link
+    comes up. With a secret, only peers that share it get a link.
+    """
+
+    def __init__(self, name, on_event, snapshot, ops, secret=None):
+        self.name = name
+        self.on_event = on_event
+        self.snapshot = snapshot
+        self.ops = frozenset(ops) | {"alive"}
+        self.secret = secret.encode() if secret else None
+        self.dialled = set()  # hosts of connect(), trusted for inbound links
+        self.links = []
+        self.routes = {}  # presence id -> PeerLinks it was announced on
+        self.seen = collections.OrderedDict()
+        self.duplicates = 0
+        self.last_heard = {}  # server name -> monotonic time of its last event
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    # Links
+
+    def listen(self, host, port):
+        server = socket.create_server((host, port))
+        threading.Thread(target=self._accept_loop, args=(server,), daemon=True).start()
+
+    def _accept_loop(self, server):
+        while True:
+            sock, addr = server.accept()
+            if self.secret is None and not self._dialled(addr[0]):
+                # Nothing else vouches for it
+                print(f"Refusing federation link from {addr[0]}: not a --peer host")
+                sock.close()
+                continue
+            threading.Thread(target=self._run_link, args=(sock,), daemon=True).start()
+
+    def _dialled(self, address):
+        """Whether address is one of the hosts this server dials"""
+        for host in list(self.dialled):
+            try:
+                infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+            except OSError:
+                continue
+            if any(info[4][0] == address for info in infos):
+                return True
+        return False
+
+    def connect(self, host, port):
+        """Keep a link to host:port up, redialling with backoff"""
+        self.dialled.add(host)
+        threading.Thread(target=self._dial_loop, args=(host, port), daemon=True).start()
+
+    def _dial_loop(self, host, port):
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+                sock.settimeout(None)
+                if self._run_link(sock):
+                    delay = RECONNECT_MIN
+            except OSError:
+                pass
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def _run_link(self, sock):
+        """Handshake and read events until the link drops; False if refused"""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = LineDecoder(max_frame=MAX_BATCH_SIZE)
+        link = None
+        try:
+            hello = {"peer": self.name}
+            if self.secret is not None:
+                hello["nonce"] = secrets.token_hex(16)
+            sock.sendall((json.dumps(hello) + "\n").encode())
+            frames = self._read_frames(decoder, sock)
+            if frames is None:
+                return False
+            peer = json.loads(frames.pop(0))
+            name = peer["peer"]
+            if name == self.name:
+                print(f"Refusing federation link to {name}: same server name")
+                return False
+            if self.secret is not None:
+                proof = self._proof(self.name, str(peer.get("nonce", "")))
+                sock.sendall((json.dumps({"proof": proof}) + "\n").encode())
+                if not frames:
+                    frames = self._read_frames(decoder, sock)
+                    if frames is None:
+                        return False
+                answer = json.loads(frames.pop(0)).get("proof")
+                expected = self._proof(name, hello["nonce"])
+                if not isinstance(answer, str) or not hmac.compare_digest(answer, expected):
+                    print(f"Refusing federation link to {name}: wrong secret")
+                    return False
+
+            link = PeerLink(sock, name)
+            link.start()
+            with self._lock:
+                self.links.append(link)
+            print(f"Federation link to {name} up")
+            for event in self.snapshot():
+                link.send(self._stamp(event))
+
+            while frames is not None:
+                for line in frames:
+                    for event in json.loads(line)["batch"]:
+                        self._receive(link, event)
+                frames = decoder.read_from(sock)
+            return True
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Federation link error: {e}")
+            return link is not None
+        finally:
+            if link is not None:
+                self._link_down(link)
+            sock.close()
+
+    @staticmethod
+    def _read_frames(decoder, sock):
+        """The next non-empty list of lines, or None at end of stream"""
+        frames = decoder.read_from(sock)
+        while frames == []:
+            frames = decoder.read_from(sock)
+        return frames
+
+    def _proof(self, name, nonce):
+        message = f"{name}\n{nonce}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def _link_down(self, link):
+        """Forget every client reached through a lost link"""
+        link.close()
+        with self._lock:
+            if link in self.links:
+                self.links.remove(link)
+            lost = []
+            for bus_id, via in list(self.routes.items()):
+                via.discard(link)
+                if not via:
+                    del self.routes[bus_id]
+                    lost.append(bus_id)
+        print(f"Federation link to {link.name} down")
+
+        for bus_id in lost:
+            self.on_event({"op": "leave", "id": bus_id})
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            if self.links:
+                self.send({"op": "alive"})
+
+            now = time.monotonic()
+            with self._lock:
+                silent = {
+                    name
+                    for name, heard in self.last_heard.items()
+                    if now - heard > PEER_TIMEOUT
+                }
+                for name in silent:
+                    del self.last_heard[name]
+                lost = [
+                    bus_id for bus_id in self.routes if bus_id.split("/", 1)[0] in silent
+                ]
+                for bus_id in lost:
+                    del self.routes[bus_id]
+            for name in silent:
+                print(f"Federated server {name} went silent")
+            for bus_id in lost:
+                self.on_event({"op": "leave", "id": bus_id})
+
+    # Events
+
+    def _local(self, bus_id):
+        return bus_id.startswith(self.name + "/")
+
+    def _stamp(self, event):
+        event["origin"] = self.name
+        event["mid"] = f"{self.name}/{next(self._ids)}"
+        event["hops"] = 0
+        with self._lock:
+            self._remember(event["mid"])
+        return event
+
+    def _remember(self, mid):
+        """Record a message id; False if it was already seen"""
+        if mid in self.seen:
+            return False
+        self.seen[mid] = True
+        if len(self.seen) > SEEN_LIMIT:
+            self.seen.popitem(last=False)
+        return True
+
+    def send(self, event):
+        """Send an event that originated on this server to the peers"""
+        self._forward(self._stamp(event), None)
+
+    def _forward(self, event, source):
+        if event["op"] == "pm":
+            if self._local(event["id"]):
+                return
+            via = [link for link in self.routes.get(event["id"], ()) if link is not source]
+            if via:
+                via[0].send(event)
+                return
+        for link in list(self.links):
+            if link is not source:
+                link.send(event)
+
+    def _receive(self, link, event):
+        link.received += 1
+        op = event["op"]
+        if op not in self.ops:
+            # Not something a peer may ask of this server
+            return
+        with self._lock:
+            self.last_heard[event["origin"]] = time.monotonic()
+            if not self._remember(event["mid"]):
+                self.duplicates += 1
+                # A duplicate still shows another way to reach the client
+                if op in ("join", "move") and event["id"] in self.routes:
+                    self.routes[event["id"]].add(link)
+                return
+
+            if op in PRESENCE_OPS:
+                if self._local(event["id"]):
+                    return
+                if op == "leave":
+                    self.routes.pop(event["id"], None)
+                elif op == "join":
+                    self.routes[event["id"]] = {link}
+                else:
+                    self.routes.setdefault(event["id"], set()).add(link)
+                owner = event["id"].split("/", 1)[0]
+                self.last_heard.setdefault(owner, time.monotonic())
+
+        event["hops"] += 1
+        if event["hops"] < MAX_HOPS:
+            self._forward(event, link)
+        if op == "pm" and not self._local(event["id"]):
+            # Only passing through on its way to the recipient's server
+            return
+        if op != "alive":
+            self.on_event(event)
+
+    def stats(self):
+        """One summary line per link"""
+        return [
+            f"{link.name}: {link.sent} sent in {link.batches} batches, "
+            f"{link.received} received, {len(link.queue)} queued, {link.dropped} dropped"
+            for link in list(self.links)
+        ]
@@ -0,0 +1,320 @@
+"""File transfer over a side channel.
+
+File bytes never travel over the chat connection. A client asks for an
+upload ticket on its chat connection, opens a second TCP connection to the
+file port and streams the file; the server spools it to disk in CHUNK_SIZE
+pieces and then tells the room about it with one small "file" event.
+Downloads are the reverse: a room member asks for a download ticket, and the
+file port writes the file to the socket with socket.sendfile, which is
+os.sendfile on Linux, so the data goes from the page cache to the socket
+without passing through Python.
+
+On the file port a client sends one JSON line, {"ticket": "..."}. For an
+upload the file's bytes follow, exactly as many as the ticket says, and the
+server answers with one line, {"ok": true} or {"ok": false, "error": ...}.
+For a download the server answers with {"ok": true, "name": ..., "size": ...}
+followed by the file.
+
+Tickets are signed with a secret that every process of a server shares, so a
+ticket issued by one worker is accepted by any of them. Spooled files are
+stored as <directory>/<id> with their metadata in <id>.json; the name a user
+gave is kept there and never used as a path. The spool is bounded: uploads
+that would take it past the quota are refused, and files older than the
+store's ttl are deleted by a sweep that runs with the file port.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import socket
+import threading
+import time
+
+CHUNK_SIZE = 256 * 1024  # bytes received per recv while spooling an upload
+TICKET_TTL = 60.0  # seconds a ticket stays valid
+IO_TIMEOUT = 30.0  # seconds a transfer may stall before it is dropped
+MAX_TRANSFERS = 32  # concurrent transfers per process
+MAX_HEADER = 4096  # longest ticket line, in bytes
+EXPIRE_INTERVAL = 300.0  # seconds between sweeps for expired files
+ACCEPT_BACKOFF = 0.5  # seconds to wait after accept() fails, e.g. out of descriptors
+
+
+class FileStore:
+    """Spool directory plus the tickets that grant access to it"""
+
+    def __init__(self, directory, secret, quota=0, ttl=0):
+        self.directory = directory
+        self.secret = secret
+        self.quota = quota  # bytes the spool may hold, 0 = no limit
+        self.ttl = ttl  # seconds a file is kept, 0 = forever
+        self._reserved = 0  # bytes claimed by uploads still spooling here
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # Tickets
+
+    def issue(self, fields):
+        """Signed ticket for a dict of fields whose op is put or get"""
+        fields = dict(fields, exp=time.time() + TICKET_TTL)
+        body = base64.urlsafe_b64encode(json.dumps(fields).encode()).decode()
+        return f"{body}.{self._sign(body)}"
+
+    def verify(self, ticket):
+        """Fields of a valid, unexpired ticket, otherwise None"""
+        if not isinstance(ticket, str) or not ticket.isascii():
+            return None
+        body, _, signature = ticket.partition(".")
+        if not hmac.compare_digest(signature, self._sign(body)):
+            return None
+        try:
+            fields = json.loads(base64.urlsafe_b64decode(body))
+        except ValueError:
+            return None
+        if fields.get("exp", 0) < time.time():
+            return None
+        return fields
+
+    def _sign(self, body):
+        return hmac.new(self.secret, body.encode(), hashlib.sha256).hexdigest()
+
+    # Files
+
+    def new_id(self):
+        return secrets.token_hex(8)
+
+    def path(self, file_id):
+        return os.path.join(self.directory, file_id)
+
+    def info(self, file_id):
+        """Metadata of a spooled file, or None"""
+        if not file_id.isalnum():
+            return None
+        try:
+            with open(self.path(file_id) + ".json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # Space
+
+    def usage(self):
+        """Bytes held by finished uploads.
+
+        Uploads still spooling in this process are counted by reserve();
+        those of other workers are not, so with several workers the spool
+        can overshoot the quota by what they have in flight.
+        """
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.isalnum():
+                try:
+                    total += entry.stat().st_size
+                except OSError:
+                    pass
+        return total
+
+    def has_room(self, size):
+        """Whether an upload of size bytes fits under the quota right now"""
+        return not self.quota or self.usage() + self._reserved + size <= self.quota
+
+    def reserve(self, size):
+        """Claim room for an upload; False if it would pass the quota"""
+        with self._lock:
+            if not self.has_room(size):
+                return False
+            self._reserved += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self._reserved -= size
+
+    def expire(self):
+        """Delete files past the ttl and abandoned uploads; returns how many files went"""
+        now = time.time()
+        removed = 0
+        for entry in os.scandir(self.directory):
+            try:
+                age = now - entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.name.endswith(".part"):
+                # A live upload writes at least every IO_TIMEOUT seconds
+                stale = age > 2 * IO_TIMEOUT
+            else:
+                stale = self.ttl and age > self.ttl
+            if not stale:
+                continue
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                continue
+            if entry.name.isalnum():
+                removed += 1
+        return removed
+
+
+class FileServer:
+    """Accepts transfers on the file port, one thread each.
+
+    on_upload(meta) is called from the transfer thread once a file has been
+    spooled completely; meta holds id, name, size, room and from.
+    """
+
+    def __init__(self, files, on_upload):
+        self.files = files
+        self.on_upload = on_upload
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.downloads = 0
+        self.download_bytes = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(MAX_TRANSFERS)
+
+    def listen(self, host, port, reuse_port=False):
+        server = socket.create_server((host, port), reuse_port=reuse_port)
+        threading.Thread(target=self._accept_loop, args=(server,), daemon=True).start()
+        threading.Thread(target=self._expire_loop, daemon=True).start()
+
+    def _accept_loop(self, server):
+        while True:
+            try:
+                sock, addr = server.accept()
+            except OSError as e:
+                print(f"File port accept failed: {e}")
+                time.sleep(ACCEPT_BACKOFF)
+                continue
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                self._reply(sock, ok=False, error="server busy, try again")
+                sock.close()
+                continue
+            threading.Thread(target=self._serve, args=(sock, addr), daemon=True).start()
+
+    def _serve(self, sock, addr):
+        try:
+            sock.settimeout(IO_TIMEOUT)
+            header, rest = self._read_header(sock)
+            fields = self.files.verify(header.get("ticket")) if header else None
+            if fields is None:
+                self._reply(sock, ok=False, error="invalid or expired ticket")
+            elif fields["op"] == "put":
+                self._receive(sock, fields, rest)
+            elif fields["op"] == "get":
+                self._send(sock, fields)
+        except (OSError, ValueError) as e:
+            print(f"File transfer from {addr[0]} failed: {e}")
+        finally:
+            self._slots.release()
+            sock.close()
+
+    def _expire_loop(self):
+        while True:
+            try:
+                removed = self.files.expire()
+            except OSError as e:
+                print(f"Sweeping {self.files.directory} failed: {e}")
+            else:
+                if removed:
+                    print(f"Deleted {removed} expired file(s)")
+            time.sleep(EXPIRE_INTERVAL)
+
+    @staticmethod
+    def _read_header(sock):
+        """The ticket line and any bytes that came after it"""
+        data = b""
+        while b"\n" not in data:
+            chunk = sock.recv(MAX_HEADER)
+            if not chunk or len(data) + len(chunk) > MAX_HEADER:
+                return None, b""
+            data += chunk
+        line, _, rest = data.partition(b"\n")
+        header = json.loads(line)
+        return (header, rest) if isinstance(header, dict) else (None, b"")
+
+    @staticmethod
+    def _reply(sock, **fields):
+        try:
+            sock.sendall((json.dumps(fields) + "\n").encode())
+        except OSError:
+            pass
+
+    def _receive(self, sock, fields, rest):
+        """Spool an upload to <id>.part, then publish it under <id>"""
+        size = fields["size"]
+        if not self.files.reserve(size):
+            self._reply(sock, ok=False, error="file storage is full, try again later")
+            return
+        try:
+            self._spool(sock, fields, rest)
+        finally:
+            self.files.release(size)
+
+    def _spool(self, sock, fields, rest):
+        size = fields["size"]
+        path = self.files.path(fields["id"])
+        try:
+            # Only one upload per ticket: "x" fails while another is spooling,
+            # and the finished file exists once it is done
+            f = open(path + ".part", "xb")
+        except FileExistsError:
+            f = None
+        if f is not None and os.path.exists(path):
+            f.close()
+            os.unlink(path + ".part")
+            f = None
+        if f is None:
+            self._reply(sock, ok=False, error="ticket already used")
+            return
+
+        received = 0
+        try:
+            with f:
+                if rest:
+                    f.write(rest[:size])
+                    received = min(len(rest), size)
+                buf = bytearray(CHUNK_SIZE)
+                view = memoryview(buf)
+                while received < size:
+                    n = sock.recv_into(buf, min(CHUNK_SIZE, size - received))
+                    if not n:
+                        break
+                    f.write(view[:n])
+                    received += n
+        finally:
+            if received < size:
+                os.unlink(path + ".part")
+
+        if received < size:
+            self._reply(sock, ok=False, error=f"upload ended after {received} of {size} bytes")
+            return
+
+        meta = {k: fields[k] for k in ("id", "name", "size", "room", "from")}
+        with open(path + ".json", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".part", path)
+        self.uploads += 1
+        self.upload_bytes += size
+        self._reply(sock, ok=True)
+        self.on_upload(meta)
+
+    def _send(self, sock, fields):
+        meta = self.files.info(fields["id"])
+        if meta is None:
+            self._reply(sock, ok=False, error="no such file")
+            return
+        with open(self.files.path(fields["id"]), "rb") as f:
+            self._reply(sock, ok=True, name=meta["name"], size=meta["size"])
+            sent = sock.sendfile(f)
+        self.downloads += 1
+        self.download_bytes += sent
+
+    def stats(self):
+        return (
+            f"Files: {self.uploads} uploaded ({self.upload_bytes} bytes), "
+            f"{self.downloads} downloads ({self.download_bytes} bytes), "
+            f"{self.rejected} rejected as busy"
+        )
@@ -0,0 +1,94 @@
+"""Newline-delimited framing shared by the chat server and client.
+
+Every protocol message is one JSON document terminated by "\n". TCP gives
+no message boundaries, so a recv can end in the middle of a line or even in
+the middle of a multibyte UTF-8 character. LineDecoder buffers raw bytes and
+only hands out complete lines, leaving decoding to json.loads.
+
+A client may ask for compression by adding "compress": "zlib" to its hello.
+A server that supports it answers with the COMPRESS_ACK line, and every
+byte it sends after that line is one zlib stream, sync-flushed after each
+write. Servers that do not know the option never send the line, so the
+connection simply stays plain.
+"""
+
+import zlib
+
+MAX_FRAME_SIZE = 64 * 1024  # longest line accepted, in bytes
+READ_SIZE = 64 * 1024  # bytes requested per recv
+COMPRESS_ACK = b'{"type": "compress", "method": "zlib"}'
+
+
+class FrameTooLarge(ValueError):
+    """A line grew past the decoder's max_frame without a newline"""
+
+
+class LineDecoder:
+    """Incremental splitter from a byte stream into newline-terminated frames.
+
+    Received bytes are appended to one bytearray and complete lines are sliced
+    out by index. The newline search resumes where the previous feed stopped,
+    so every byte is scanned once however the stream is chunked. Blocking
+    socket reads go through a single preallocated buffer via recv_into.
+
+    After expect_compression(), the stream is inflated from the end of the
+    COMPRESS_ACK line onwards, even when the line and the compressed bytes
+    arrive in the same read.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME_SIZE, read_size=READ_SIZE):
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        self._scanned = 0
+        self._read_buf = bytearray(read_size)
+        self._read_view = memoryview(self._read_buf)
+        self._await_ack = False
+        self._inflater = None
+
+    def expect_compression(self):
+        """Switch to inflating once the server acknowledges compression"""
+        self._await_ack = True
+
+    def feed(self, data):
+        """Add received bytes and return the complete frames, without newlines"""
+        buf = self.buffer
+        if self._inflater is not None:
+            data = self._inflater.decompress(data)
+        buf += data
+
+        frames = []
+        start = 0
+        nl = buf.find(b"\n", self._scanned)
+        while nl >= 0:
+            if nl - start > self.max_frame:
+                raise FrameTooLarge(f"frame of {nl - start} bytes exceeds limit")
+            frame = bytes(buf[start:nl])
+            frames.append(frame)
+            start = nl + 1
+            if self._await_ack and frame == COMPRESS_ACK:
+                # Everything after the acknowledgement is compressed
+                self._await_ack = False
+                self._inflater = zlib.decompressobj()
+                rest = self._inflater.decompress(bytes(buf[start:]))
+                del buf[:]
+                buf += rest
+                start = 0
+            nl = buf.find(b"\n", start)
+
+        if start:
+            del buf[:start]
+        self._scanned = len(buf)
+        if len(buf) > self.max_frame:
+            raise FrameTooLarge(f"unterminated frame exceeds {self.max_frame} bytes")
+        return frames
+
+    def read_from(self, sock):
+        """Receive once from a blocking socket.
+
+        Returns the frames completed by this read (possibly none), or None
+        once the peer has closed the connection.
+        """
+        n = sock.recv_into(self._read_buf)
+        if not n:
+            return None
+        return self.feed(self._read_view[:n])
@@ -0,0 +1,163 @@
+"""Passing a running server's sockets and state to its replacement.
+
+A server listens for takeovers on a Unix domain socket. A new server started
+with --takeover connects there instead of binding the chat port, and the two
+talk like this:
+
+    new -> old  {"op": "takeover"}
+    old -> new  the state: an 8-byte header (JSON length, descriptor count),
+                the JSON, then the listening socket and every client socket,
+                passed with SCM_RIGHTS in batches of up to MAX_FDS
+    new -> old  {"op": "adopted"}
+    old -> new  {"op": "released"}, once its logs and store are flushed to
+                disk; then it exits
+
+The sockets are the same kernel objects in both processes, so clients see no
+disconnect, and connections still waiting in the listen backlog are simply
+accepted by the new process. Only a process of the same user may take over.
+"""
+
+import json
+import os
+import select
+import socket
+import struct
+import time
+
+MAX_FDS = 250  # descriptors per message, under Linux's SCM_MAX_FD of 253
+MAX_EVENT = 4096  # longest control line, in bytes
+HEADER = struct.Struct(">II")
+
+
+def supported():
+    return hasattr(socket, "AF_UNIX") and hasattr(socket, "send_fds")
+
+
+def listen(path):
+    """Unix socket for takeover requests.
+
+    Refuses to replace the socket of a server that is still answering on it.
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+        else:
+            raise OSError(f"another server is listening on {path}")
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(1)
+    return server
+
+
+def same_user(sock):
+    """Whether the peer of a Unix socket runs as this user; True where the
+    platform cannot tell"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+
+def connect(path, timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    sock.settimeout(timeout)
+    return sock
+
+
+def send_event(sock, event):
+    sock.sendall((json.dumps(event) + "\n").encode())
+
+
+def read_event(sock):
+    """One control line, read a byte at a time so nothing after it is consumed"""
+    line = bytearray()
+    while not line.endswith(b"\n"):
+        byte = sock.recv(1)
+        if not byte:
+            raise ConnectionError("the other server went away")
+        if len(line) >= MAX_EVENT:
+            raise ValueError("control line too long")
+        line += byte
+    return json.loads(line)
+
+
+def expect(sock, op):
+    event = read_event(sock)
+    if not isinstance(event, dict) or event.get("op") != op:
+        raise ValueError(f"expected {op!r}, got {event!r}")
+    return event
+
+
+def send_state(sock, state, fds):
+    data = json.dumps(state).encode()
+    sock.sendall(HEADER.pack(len(data), len(fds)) + data)
+    for i in range(0, len(fds), MAX_FDS):
+        # Each batch rides on one byte of its own
+        socket.send_fds(sock, [b"\0"], fds[i : i + MAX_FDS])
+
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("the other server went away")
+        data += chunk
+    return bytes(data)
+
+
+def receive_state(sock):
+    """The state and descriptors sent by send_state()"""
+    size, count = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    state = json.loads(_recv_exact(sock, size))
+    fds = []
+    try:
+        while len(fds) < count:
+            data, batch, flags, _ = socket.recv_fds(sock, 1, MAX_FDS)
+            fds.extend(batch)
+            if not data:
+                raise ConnectionError("the other server went away")
+            if flags & socket.MSG_CTRUNC:
+                raise OSError("descriptors were truncated")
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return state, fds
+
+
+def wait_exit(pid, timeout):
+    """Wait until process pid has exited, and so closed every socket it had.
+
+    Returns False if it is still there after timeout seconds.
+    """
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        # No pidfds; polling cannot tell an exited process from a zombie
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            time.sleep(0.05)
+        return False
+    try:
+        return bool(select.select([fd], [], [], timeout)[0])
+    finally:
+        os.close(fd)
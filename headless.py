@@ -0,0 +1,405 @@
+"""Headless chat client for bots, monitors and scripts.
+
+Speaks the same protocol as client.py without Tk: the hello with zlib
+compression, the binary wire format and a resumable session, answers to
+heartbeat pings, and reconnection with backoff that resumes the session and
+drops replayed messages it already has. Everything runs on an asyncio event
+loop, so one process can hold hundreds of clients:
+
+    async def main():
+        async with HeadlessClient("127.0.0.1", "echo-bot", "general") as bot:
+            @bot.on("msg")
+            async def echo(msg):
+                if msg["from"] != bot.username:
+                    bot.send(f"{msg['from']} said {msg['msg']}")
+            await bot.wait_closed()
+
+Messages can also be taken in order with `async for msg in client`, or one
+at a time with `await client.receive()`. From a terminal:
+
+    python headless.py alice --host 192.168.1.10 --room dev
+    python headless.py deploy-bot -m "deploy started" -m "deploy finished"
+
+The first reads lines from stdin and prints the room; the second sends its
+messages in one write and exits.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+
+import wire
+from framing import READ_SIZE
+
+PORT = 3000
+MAX_SERVER_FRAME = 1024 * 1024  # longest line accepted from the server
+QUEUE_SIZE = 10000  # messages kept for receive() before the oldest are dropped
+SEEN_LIMIT = 2000  # room messages remembered by seq to drop replayed ones
+HEARTBEAT_TIMEOUT = 3  # ping intervals of silence before the server is given up on
+RECONNECT_MIN = 0.5  # seconds before redialling, doubled up to RECONNECT_MAX
+RECONNECT_MAX = 30.0
+CONNECT_TIMEOUT = 5.0
+
+
+class HeadlessClient:
+    """One chat connection on the running event loop.
+
+    Callbacks registered with on(type) run for every message of that type,
+    or for every message with "*"; they may be plain functions or coroutine
+    functions. Messages are also queued for receive() and async iteration.
+    With reconnect=True a dropped connection is redialled and the session
+    resumed until close() is called.
+    """
+
+    def __init__(
+        self,
+        host,
+        username,
+        room="general",
+        port=PORT,
+        compress=True,
+        binary=True,
+        reconnect=True,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.room = room
+        self.compress = compress
+        self.binary = binary
+        self.sending_binary = False
+        self.reconnect = reconnect
+        self.reader = None
+        self.writer = None
+        self.callbacks = collections.defaultdict(list)
+        self.messages = asyncio.Queue()
+        self.dropped = 0
+        self.session = None
+        self.epoch = None
+        self.last_seq = {}
+        self.seen = set()
+        self.seen_order = collections.deque()
+        self.in_backlog = False  # between "backlog" markers: messages we asked to see again
+        self.closed = False
+        self._task = None
+        self._done = None
+
+    # Connection
+
+    async def connect(self):
+        """Connect, say hello and start reading in the background"""
+        self._done = asyncio.get_running_loop().create_future()
+        await self._open()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT
+        )
+        hello = {"username": self.username, "room": self.room, "session": True}
+        if self.session is not None:
+            hello["resume"] = self.session
+        if self.room in self.last_seq:
+            hello["seq"] = self.last_seq[self.room]
+        if self.compress:
+            hello["compress"] = "zlib"
+        if self.binary:
+            hello["wire"] = "binary"
+        self.sending_binary = False
+        self.send_payload(hello)
+
+    async def close(self):
+        """Say goodbye, so the server does not hold our place, and disconnect"""
+        self.closed = True
+        if self.writer is not None:
+            self.send_payload({"type": "bye"})
+            self.writer.close()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def wait_closed(self):
+        """Wait until the connection is gone for good"""
+        await asyncio.shield(self._done)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _run(self):
+        try:
+            delay = RECONNECT_MIN
+            while True:
+                try:
+                    await self._read_messages()
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"{self.username}: connection lost: {e}", file=sys.stderr)
+                except Exception as e:
+                    # Garbled or unexpected data: start over on a new connection
+                    print(f"{self.username}: protocol error: {e!r}", file=sys.stderr)
+                if self.closed or not self.reconnect:
+                    return
+                self.writer.close()
+                while not self.closed:
+                    # Jitter keeps a crowd of bots from redialling in lockstep
+                    await asyncio.sleep(random.uniform(delay / 2, delay))
+                    try:
+                        await self._open()
+                        break
+                    except (OSError, asyncio.TimeoutError):
+                        delay = min(delay * 2, RECONNECT_MAX)
+                delay = RECONNECT_MIN
+        finally:
+            self.closed = True
+            if not self._done.done():
+                self._done.set_result(None)
+
+    async def _read_messages(self):
+        """Handle messages from the current connection until it drops"""
+        decoder = wire.FrameDecoder(max_frame=MAX_SERVER_FRAME)
+        if self.compress:
+            decoder.expect_compression()
+        if self.binary:
+            decoder.expect_binary()
+        # Servers that ping tell us their interval; until then never time out
+        heartbeat = None
+        last_recv = time.monotonic()
+        self.in_backlog = False
+        while not self.closed:
+            try:
+                data = await asyncio.wait_for(self.reader.read(READ_SIZE), heartbeat)
+            except asyncio.TimeoutError:
+                if time.monotonic() - last_recv > heartbeat * HEARTBEAT_TIMEOUT:
+                    raise ConnectionError("server stopped responding") from None
+                self.send_payload({"type": "ping"})
+                continue
+            if not data:
+                return
+            last_recv = time.monotonic()
+            for line in decoder.feed(data):
+                if isinstance(line, dict):
+                    # Decoded from a binary frame
+                    msg = line
+                elif not line.strip():
+                    continue
+                else:
+                    msg = json.loads(line)
+                if msg["type"] == "wire":
+                    # The server speaks binary now; say we do too
+                    self.writer.write(wire.WIRE_SWITCH + b"\n")
+                    self.sending_binary = True
+                elif msg["type"] == "ping":
+                    heartbeat = msg.get("interval") or 30.0
+                    self.send_payload({"type": "pong"})
+                elif msg["type"] == "backlog":
+                    self.in_backlog = not msg.get("end")
+                elif msg["type"] not in ("pong", "compress"):
+                    # The compress acknowledgement only mattered to the decoder
+                    await self._dispatch(msg)
+
+    # Receiving
+
+    def on(self, msg_type, callback=None):
+        """Register a callback for a message type; usable as a decorator"""
+        if callback is None:
+            return lambda callback: self.on(msg_type, callback)
+        self.callbacks[msg_type].append(callback)
+        return callback
+
+    async def _dispatch(self, msg):
+        kind = msg["type"]
+        if kind == "session":
+            self.session = msg["token"]
+            if msg.get("epoch") != self.epoch:
+                # A restarted server may hand out seqs we have seen again
+                self.epoch = msg.get("epoch")
+                self.seen.clear()
+                self.seen_order.clear()
+        elif kind == "presence" and "users" in msg:
+            # A snapshot names the room we are in, also after /join
+            self.room = msg["room"]
+        elif kind == "msg" and not self._first_sighting(msg):
+            return
+
+        if self.messages.qsize() >= QUEUE_SIZE:
+            self.messages.get_nowait()
+            self.dropped += 1
+        self.messages.put_nowait(msg)
+        for callback in self.callbacks[kind] + self.callbacks["*"]:
+            try:
+                result = callback(msg)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                # One broken handler must not take the connection down
+                print(f"{self.username}: {kind} callback failed: {e!r}", file=sys.stderr)
+
+    def _first_sighting(self, msg):
+        """Note a room message's seq; False if it was already seen"""
+        if "seq" not in msg:
+            return True
+        room = msg.get("room")
+        key = (room, msg["seq"])
+        if key in self.seen:
+            # Only a resume replay repeats itself; /history and the /join
+            # backlog were asked for
+            return self.in_backlog
+        self.seen.add(key)
+        self.seen_order.append(key)
+        if len(self.seen_order) > SEEN_LIMIT:
+            self.seen.discard(self.seen_order.popleft())
+        if msg["seq"] > self.last_seq.get(room, -1):
+            self.last_seq[room] = msg["seq"]
+        return True
+
+    async def receive(self):
+        """Next message from the server"""
+        return await self.messages.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self.messages.empty():
+            raise StopAsyncIteration
+        get = asyncio.ensure_future(self.messages.get())
+        await asyncio.wait((get, self._done), return_when=asyncio.FIRST_COMPLETED)
+        if not get.done():
+            get.cancel()
+            raise StopAsyncIteration
+        return get.result()
+
+    # Sending
+
+    def send_payload(self, payload):
+        self.writer.write(self._pack(payload))
+
+    def _pack(self, payload):
+        if self.sending_binary:
+            return wire.pack_payload(payload, encode)
+        return encode(payload)
+
+    def send(self, text):
+        """Send a chat message, or a command if it starts with /"""
+        if text.startswith("/"):
+            self.send_payload({"type": "command", "cmd": text})
+        else:
+            self.send_payload({"type": "msg", "msg": text})
+
+    def send_batch(self, texts):
+        """Send several messages or commands in a single write"""
+        frames = []
+        for text in texts:
+            if text.startswith("/"):
+                payload = {"type": "command", "cmd": text}
+            else:
+                payload = {"type": "msg", "msg": text}
+            frames.append(self._pack(payload))
+        self.writer.write(b"".join(frames))
+
+    async def drain(self):
+        """Wait until everything sent so far is handed to the kernel"""
+        await self.writer.drain()
+
+
+def encode(payload):
+    return (json.dumps(payload) + "\n").encode()
+
+
+def format_message(msg):
+    """One terminal line for a message, or None for protocol chatter"""
+    kind = msg["type"]
+    when = f"[{msg['time']}] " if msg.get("time") else ""
+    if kind == "msg":
+        return f"{when}{msg.get('from', 'Unknown')}: {msg.get('msg', '')}"
+    if kind == "system":
+        return f"{when}* {msg.get('msg', '')}"
+    if kind == "private":
+        return f"{when}[PM from {msg.get('from', 'Unknown')}] {msg.get('msg', '')}"
+    if kind == "file":
+        return f"{when}{msg.get('from', 'Unknown')} shared {msg.get('name')} ({msg.get('size')} bytes)"
+    return None
+
+
+async def run_terminal(args):
+    client = HeadlessClient(
+        args.host,
+        args.username,
+        args.room,
+        args.port,
+        compress=not args.no_compress,
+        binary=not args.text,
+    )
+    await client.connect()
+
+    if args.message:
+        client.send_batch(args.message)
+        await client.drain()
+        # Give the server a moment to answer commands before leaving
+        await asyncio.sleep(args.linger)
+        while not client.messages.empty():
+            line = format_message(client.messages.get_nowait())
+            if line is not None and not args.quiet:
+                print(line)
+        await client.close()
+        return
+
+    async def show():
+        async for msg in client:
+            line = format_message(msg)
+            if line is not None:
+                print(line, flush=True)
+
+    printer = asyncio.create_task(show())
+    loop = asyncio.get_running_loop()
+    while True:
+        text = await loop.run_in_executor(None, sys.stdin.readline)
+        if not text or client.closed:
+            break
+        text = text.strip()
+        if text:
+            client.send(text)
+    if not client.closed:
+        # Piped input: let the replies to the last lines arrive
+        await client.drain()
+        await asyncio.sleep(args.linger)
+    await client.close()
+    await printer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LAN Chat headless client")
+    parser.add_argument("username")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--room", default="general")
+    parser.add_argument(
+        "-m",
+        "--message",
+        action="append",
+        help="send this message or command and exit (repeatable, sent in one write)",
+    )
+    parser.add_argument(
+        "--linger",
+        type=float,
+        default=0.5,
+        help="seconds to wait for replies before exiting after -m or end of input",
+    )
+    parser.add_argument("-q", "--quiet", action="store_true", help="print nothing with -m")
+    parser.add_argument("--no-compress", action="store_true", help="ask for a plain stream")
+    parser.add_argument("--text", action="store_true", help="stay on the JSON lines format")
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_terminal(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Lightweight server instrumentation with Prometheus text exposition.
+
+Metrics are plain objects updated inline on the hot path: a counter bump is
+one attribute add and a histogram observation one bisect over a dozen
+bucket bounds. Updates take no lock, so under heavy thread contention a
+count can occasionally be off by one; that is the price of staying out of
+the message path.
+
+Gauges are callbacks evaluated only when the metrics are rendered.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from 10us to 1s
+LATENCY_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.value = 0
+        self.values = {}  # label value -> count, when labelled
+
+    def inc(self, n=1):
+        self.value += n
+
+    def inc_label(self, label_value, n=1):
+        self.values[label_value] = self.values.get(label_value, 0) + n
+
+    def samples(self):
+        if self.label is None:
+            yield self.name, None, self.value
+        else:
+            for key, value in list(self.values.items()):
+                yield self.name, {self.label: key}, value
+
+
+class Gauge:
+    """Value computed by a callback at render time.
+
+    The callback returns a number, or a dict of label value -> number when
+    the gauge has a label. Pass type="counter" for totals that are kept
+    elsewhere and only read here.
+    """
+
+    def __init__(self, name, help, callback, label=None, type="gauge"):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.label = label
+        self.type = type
+
+    def samples(self):
+        value = self.callback()
+        if self.label is None:
+            yield self.name, None, value
+        else:
+            for key, inner in value.items():
+                yield self.name, {self.label: key}, inner
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            yield self.name + "_bucket", {"le": _number(bound)}, seen
+        yield self.name + "_bucket", {"le": "+Inf"}, seen + self.counts[-1]
+        yield self.name + "_sum", None, self.sum
+        yield self.name + "_count", None, self.count
+
+
+class RateMeter:
+    """Events per second over the last `window` seconds, in one-second slots"""
+
+    def __init__(self, window=60):
+        self.window = window
+        self.slots = [0] * window
+        self.epochs = [0] * window
+        self.total = 0
+
+    def mark(self, n=1):
+        second = int(time.monotonic())
+        i = second % self.window
+        if self.epochs[i] != second:
+            self.epochs[i] = second
+            self.slots[i] = 0
+        self.slots[i] += n
+        self.total += n
+
+    def rate(self):
+        now = int(time.monotonic())
+        recent = sum(
+            count
+            for count, epoch in zip(self.slots, self.epochs)
+            if now - epoch < self.window
+        )
+        return recent / self.window
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, label=None):
+        return self._add(Counter(name, help, label))
+
+    def gauge(self, name, help, callback, label=None, type="gauge"):
+        return self._add(Gauge(name, help, callback, label, type))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_http(registry, host, port):
+    """Serve GET /metrics from a daemon thread; returns the HTTP server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
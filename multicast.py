@@ -0,0 +1,419 @@
+"""Multicast delivery of room traffic on the LAN.
+
+In a big room most of the server's egress is one frame copied to every
+member. Clients that ask for multicast at hello are left out of the unicast
+fan-out once they have proven they can hear the room's group: the server
+sends each room frame once, as a UDP datagram, and all of them receive it.
+
+A datagram is a JSON header line followed by the frame exactly as it would
+have gone over TCP, behind a TAG_SIZE byte HMAC-SHA256 tag of both:
+
+    <tag>{"src": ..., "room": ..., "seq": n}\\n<frame>
+
+Any host on the LAN can send to a group, so the tag is what makes a datagram
+the server's. Its key is made fresh by every server process and handed only
+to clients in their offer, over their TCP connection; receivers drop
+datagrams whose tag does not check out. A client that was given the key can
+still forge traffic for the groups it was invited to.
+
+Rooms hash onto groups and several servers may share a LAN, so receivers
+keep only datagrams for the src and room they were given. Every room has its
+own sequence numbers. Each HEARTBEAT_INTERVAL the last seq of every recently
+active room is repeated as {"src", "room", "last": n}, so a receiver also
+notices when the end of a burst went missing.
+
+Switching a client over takes a handshake on its TCP connection, so that
+every frame reaches it exactly once:
+
+    server  {"type": "multicast", "room", "group", "port", "src", "token", "key"}
+    client  joins the group, then {"type": "multicast", "room"}
+    server  sends a probe datagram {"src", "room", "probe": token}
+    client  {"type": "multicast", "room", "confirm": true} once it hears it
+    server  {"type": "multicast", "room", "seq": n}; from seq n on the room
+            reaches this client only by multicast
+
+A client that never hears its probe simply stays on unicast. Lost datagrams
+are repaired over TCP: the client sends {"type": "nack", "room", "first",
+"last"} and the server answers from a window of recent frames with
+{"type": "repair", "room", "seq", "payload"} lines, or with
+{"type": "repair", "room", "lost": [first, last]} for frames already gone.
+Receivers deliver frames in order, holding back everything after a gap.
+"""
+
+import collections
+import hashlib
+import hmac
+import json
+import secrets
+import socket
+import struct
+import threading
+import time
+import zlib
+
+GROUP_PREFIX = "239.255"  # rooms map onto <prefix>.0.1 - <prefix>.255.254
+MAX_FRAME = 1400  # larger frames go by unicast; this fits an Ethernet frame
+REPAIR_WINDOW = 2048  # frames per room kept for repairs
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_IDLE = 30.0  # stop repeating a room's last seq after this long
+NACK_RETRY = 1.0  # seconds before a gap is asked for again
+PROBE_RETRIES = 3  # readiness messages sent before falling back to unicast
+TAG_SIZE = 16  # bytes of HMAC-SHA256 in front of every datagram
+
+
+def group_for(room, prefix=GROUP_PREFIX):
+    """Multicast group address for a room"""
+    index = zlib.crc32(room.encode()) % (256 * 254)
+    return f"{prefix}.{index // 254}.{index % 254 + 1}"
+
+
+def _header(**fields):
+    return (json.dumps(fields) + "\n").encode()
+
+
+def _tag(key, data):
+    return hmac.new(key, data, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+class Channel:
+    __slots__ = ("group", "next_seq", "window", "active")
+
+    def __init__(self, group, window):
+        self.group = group
+        self.next_seq = 0
+        self.window = collections.deque(maxlen=window)
+        self.active = 0.0
+
+
+class Sender:
+    """Server side: numbers room frames and sends them to the room groups.
+
+    `lock` is held while a frame is numbered and sent; hold it while deciding
+    who still needs a unicast copy, so that decision and the seq agree.
+    """
+
+    def __init__(self, src, port, interface=None, ttl=1, prefix=GROUP_PREFIX):
+        self.src = src
+        self.port = port
+        self.prefix = prefix
+        self.key = secrets.token_bytes(32)  # signs datagrams; clients get it in their offer
+        self.channels = {}  # room -> Channel
+        self.datagrams = 0
+        self.bytes = 0
+        self.errors = 0
+        self.repaired = 0
+        self.lost = 0
+        self.lock = threading.RLock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface:
+            self.sock.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+            )
+        # Never stall a broadcast; a datagram the kernel refuses is repaired
+        self.sock.setblocking(False)
+
+    def start(self):
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def _channel(self, room):
+        channel = self.channels.get(room)
+        if channel is None:
+            channel = Channel(group_for(room, self.prefix), REPAIR_WINDOW)
+            self.channels[room] = channel
+        return channel
+
+    def _sendto(self, data, group):
+        try:
+            self.sock.sendto(_tag(self.key, data) + data, (group, self.port))
+        except OSError:
+            self.errors += 1
+            return
+        self.datagrams += 1
+        self.bytes += len(data)
+
+    def offer(self, room, token):
+        """The multicast message that invites a client into a room's group"""
+        return {
+            "type": "multicast",
+            "room": room,
+            "group": group_for(room, self.prefix),
+            "port": self.port,
+            "src": self.src,
+            "token": token,
+            "key": self.key.hex(),
+        }
+
+    def probe(self, room, token):
+        with self.lock:
+            self._sendto(_header(src=self.src, room=room, probe=token), self._channel(room).group)
+
+    def next_seq(self, room):
+        with self.lock:
+            return self._channel(room).next_seq
+
+    def send(self, room, frame):
+        """Number a frame and send it to the room's group"""
+        with self.lock:
+            channel = self._channel(room)
+            seq = channel.next_seq
+            channel.next_seq += 1
+            channel.window.append(frame)
+            channel.active = time.monotonic()
+            self._sendto(_header(src=self.src, room=room, seq=seq) + frame, channel.group)
+
+    def repair(self, room, first, last):
+        """Encoded repair lines for seqs first..last of a room"""
+        with self.lock:
+            channel = self.channels.get(room)
+            if channel is None:
+                return []
+            last = min(last, channel.next_seq - 1)
+            oldest = channel.next_seq - len(channel.window)
+            frames = [
+                (seq, channel.window[seq - oldest])
+                for seq in range(max(first, oldest), last + 1)
+            ]
+
+        lines = []
+        if first < oldest and first <= last:
+            lost = min(oldest - 1, last)
+            self.lost += lost - first + 1
+            lines.append(_header(type="repair", room=room, lost=[first, lost]))
+        prefix = json.dumps(room)
+        for seq, frame in frames:
+            lines.append(
+                b'{"type": "repair", "room": %s, "seq": %d, "payload": %s}\n'
+                % (prefix.encode(), seq, frame.rstrip(b"\n"))
+            )
+        self.repaired += len(frames)
+        return lines
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                for room, channel in list(self.channels.items()):
+                    if channel.next_seq and now - channel.active < HEARTBEAT_IDLE:
+                        self._sendto(
+                            _header(src=self.src, room=room, last=channel.next_seq - 1),
+                            channel.group,
+                        )
+
+    def stats(self):
+        return (
+            f"Multicast: {self.datagrams} datagrams ({self.bytes} bytes) in "
+            f"{len(self.channels)} rooms, {self.repaired} frames repaired, "
+            f"{self.lost} lost, {self.errors} send errors"
+        )
+
+
+class Receiver:
+    """Client side of one room subscription at a time.
+
+    Callbacks run on the receiver's thread or on whichever thread passed in
+    the TCP message: on_message(msg) for every room message, in order;
+    send(payload) to write a message to the server over TCP; on_lost(count)
+    when frames could not be repaired.
+    """
+
+    def __init__(self, interface, on_message, send, on_lost=None):
+        self.interface = interface
+        self.on_message = on_message
+        self.send = send
+        self.on_lost = on_lost
+        self.sock = None
+        self.offer = None
+        self.key = None  # the offer's datagram key
+        self.state = None  # None, "probing", "confirming" or "active"
+        self.expected = 0
+        self.held = {}  # seq -> message waiting for an earlier one
+        self.nacked_at = 0.0
+        self.nacked_through = -1
+        self._lock = threading.Lock()
+
+    # Messages from the server's TCP connection
+
+    def handle(self, msg):
+        """Take a "multicast" or "repair" message; True if it was one of ours"""
+        if msg["type"] == "multicast":
+            if "group" in msg:
+                self._subscribe(msg)
+            elif "seq" in msg:
+                self._start(msg)
+            return True
+        if msg["type"] == "repair":
+            self._repair(msg)
+            return True
+        return False
+
+    def _subscribe(self, offer):
+        self.close()
+        try:
+            key = bytes.fromhex(offer["key"])
+        except (KeyError, TypeError, ValueError):
+            # Unsigned datagrams could come from anyone; stay on unicast
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # Several clients on one machine share the port
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            sock.bind(("", offer["port"]))
+            membership = struct.pack(
+                "4s4s", socket.inet_aton(offer["group"]), socket.inet_aton(self.interface)
+            )
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            # Stay on unicast
+            sock.close()
+            return
+
+        with self._lock:
+            self.sock = sock
+            self.offer = offer
+            self.key = key
+            self.state = "probing"
+            self.held = {}
+            self.nacked_at = 0.0
+            self.nacked_through = -1
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+        threading.Thread(target=self._probe_loop, args=(sock, offer["room"]), daemon=True).start()
+
+    def _probe_loop(self, sock, room):
+        """Tell the server we are listening until its probe gets through"""
+        for _ in range(PROBE_RETRIES):
+            if self.sock is not sock or self.state != "probing":
+                return
+            self.send({"type": "multicast", "room": room})
+            time.sleep(NACK_RETRY)
+
+    def _start(self, msg):
+        with self._lock:
+            if self.state != "confirming" or msg["room"] != self.offer["room"]:
+                return
+            self.state = "active"
+            self.expected = msg["seq"]
+            self.held = {seq: m for seq, m in self.held.items() if seq >= self.expected}
+            ready, nack = self._advance(None)
+        self._deliver(msg["room"], ready, nack)
+
+    def _repair(self, msg):
+        with self._lock:
+            if self.state != "active" or msg["room"] != self.offer["room"]:
+                return
+            lost = 0
+            if "lost" in msg:
+                first, last = msg["lost"]
+                if first <= self.expected <= last:
+                    lost = last - self.expected + 1
+                    self.expected = last + 1
+                    self.held = {s: m for s, m in self.held.items() if s > last}
+            elif msg["seq"] >= self.expected:
+                self.held.setdefault(msg["seq"], msg["payload"])
+            ready, nack = self._advance(None)
+        if lost and self.on_lost is not None:
+            self.on_lost(lost)
+        self._deliver(msg["room"], ready, nack)
+
+    # Datagrams
+
+    def _read_loop(self, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if self.sock is not sock:
+                return
+            try:
+                self.feed(data)
+            except (ValueError, KeyError):
+                pass
+
+    def feed(self, data):
+        """Handle one datagram"""
+        key = self.key
+        tag, data = data[:TAG_SIZE], data[TAG_SIZE:]
+        if key is None or not hmac.compare_digest(tag, _tag(key, data)):
+            return
+        header, _, frame = data.partition(b"\n")
+        header = json.loads(header)
+        confirm = False
+        with self._lock:
+            offer = self.offer
+            if offer is None or self.key is not key or header["src"] != offer["src"] or header["room"] != offer["room"]:
+                return
+            if "probe" in header:
+                if header["probe"] != offer["token"] or self.state != "probing":
+                    return
+                self.state = "confirming"
+                confirm = True
+                ready, nack = [], None
+            else:
+                seq = header.get("seq")
+                if seq is not None and (
+                    self.state == "confirming"
+                    or (self.state == "active" and seq >= self.expected)
+                ):
+                    # While confirming, keep everything until the start seq is known
+                    self.held.setdefault(seq, json.loads(frame))
+                if self.state != "active":
+                    return
+                ready, nack = self._advance(header.get("last"))
+
+        if confirm:
+            self.send({"type": "multicast", "room": offer["room"], "confirm": True})
+        self._deliver(offer["room"], ready, nack)
+
+    def _advance(self, last):
+        """Pop the messages now in order; returns them and a seq range to NACK.
+
+        last is the newest seq the server says exists, if known.
+        """
+        ready = []
+        while self.expected in self.held:
+            ready.append(self.held.pop(self.expected))
+            self.expected += 1
+        if self.held:
+            missing = max(self.held) - 1
+            last = missing if last is None else max(last, missing)
+        if last is None or last < self.expected:
+            return ready, None
+
+        first = self.expected
+        now = time.monotonic()
+        if now - self.nacked_at < NACK_RETRY:
+            # Already asked; only ask for what is new
+            first = max(first, self.nacked_through + 1)
+        while first in self.held:
+            first += 1
+        while last in self.held:
+            last -= 1
+        if first > last:
+            return ready, None
+        self.nacked_at = now
+        self.nacked_through = max(self.nacked_through, last)
+        return ready, (first, last)
+
+    def _deliver(self, room, ready, nack):
+        if nack is not None:
+            self.send({"type": "nack", "room": room, "first": nack[0], "last": nack[1]})
+        for msg in ready:
+            self.on_message(msg)
+
+    def close(self):
+        with self._lock:
+            sock, self.sock = self.sock, None
+            self.offer = None
+            self.key = None
+            self.state = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
@@ -0,0 +1,89 @@
+"""Token-bucket rate limiting.
+
+A bucket holds up to `burst` tokens and refills at `rate` tokens per second;
+every event takes one. RateLimiter keeps one bucket per (scope, key, kind),
+e.g. ("ip", "10.0.0.7", "msg"), and charges an event to all of its buckets
+at once: either every bucket has a token and each gives one up, or none is
+touched and the caller learns how long to wait.
+"""
+
+import threading
+import time
+
+PRUNE_THRESHOLD = 10000  # buckets kept before idle, full ones are dropped
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self):
+        """Seconds until a token is available, 0 if one is"""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Buckets for several scopes, charged together.
+
+    limits maps (scope, kind) to (rate, burst); a missing or zero-rate entry
+    means that scope does not limit that kind of event. The mapping is read
+    on every call, so it can be changed after the limiter is created.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, kind, keys):
+        """Charge one event of `kind` to the buckets of keys (scope -> key).
+
+        Returns (None, 0.0) if the event may go ahead, otherwise the most
+        restrictive scope and the seconds until it would have a token.
+        """
+        now = time.monotonic()
+        with self._lock:
+            charged = []
+            worst, worst_wait = None, 0.0
+            for scope, key in keys.items():
+                limit = self.limits.get((scope, kind))
+                if not limit or not limit[0]:
+                    continue
+                bucket = self.buckets.get((scope, key, kind))
+                if bucket is None:
+                    bucket = TokenBucket(limit[0], limit[1], now)
+                    self.buckets[(scope, key, kind)] = bucket
+                bucket.refill(now)
+                wait = bucket.wait()
+                if wait > worst_wait:
+                    worst, worst_wait = scope, wait
+                charged.append(bucket)
+
+            if worst is not None:
+                return worst, worst_wait
+            for bucket in charged:
+                bucket.tokens -= 1
+            if len(self.buckets) > PRUNE_THRESHOLD:
+                self._prune(now)
+            return None, 0.0
+
+    def _prune(self, now):
+        """Drop buckets that have refilled completely; they hold no state"""
+        full = [
+            key
+            for key, bucket in self.buckets.items()
+            if bucket.tokens + (now - bucket.stamp) * bucket.rate >= bucket.burst
+        ]
+        for key in full:
+            del self.buckets[key]
@@ -0,0 +1,303 @@
+"""Full-text search over chat history.
+
+SearchIndex keeps an inverted index (term -> sorted array of document ids)
+in memory and the documents themselves on disk:
+
+    <directory>/docs.jsonl   one [room, time, user, text] JSON line per message
+    <directory>/index.pickle postings snapshot, written on close()
+
+Messages are added from a background thread as the server logs them. On
+startup the snapshot is loaded and any documents appended after it are
+re-indexed from docs.jsonl, so an unclean stop loses nothing. The index can
+also be rebuilt offline from the plain chat_logs/<room>.txt files:
+
+    python search.py rebuild [chat_logs]
+"""
+
+import array
+import bisect
+import json
+import math
+import os
+import pickle
+import queue
+import re
+import sys
+import threading
+import time
+
+TOKEN_RE = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = 40
+RESULT_LIMIT = 10
+# Terms in more than this share of documents (and at least COMMON_TERM_MIN
+# of them) are too common to rank partial matches by
+COMMON_TERM_RATIO = 0.2
+COMMON_TERM_MIN = 1000
+
+LOG_LINE_RE = re.compile(r"^\[(\d\d:\d\d:\d\d)\] ([^:\s][^:]*): (.*)$")
+
+
+def tokenize(text):
+    return {
+        t for t in TOKEN_RE.findall(text.lower()) if len(t) <= MAX_TOKEN_LENGTH
+    }
+
+
+class SearchIndex:
+    """Incrementally updated inverted index over chat messages"""
+
+    _STOP = object()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.docs_path = os.path.join(directory, "docs.jsonl")
+        self.snapshot_path = os.path.join(directory, "index.pickle")
+        self._reset()
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._docs_file = None
+        self._reader = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _reset(self):
+        self.postings = {}
+        self.offsets = array.array("Q")  # doc id -> offset in docs.jsonl
+        self.doc_rooms = array.array("I")  # doc id -> room id
+        self.rooms = []
+        self.room_ids = {}
+
+    # Loading and saving
+
+    def load(self):
+        """Load the snapshot and index documents written after it"""
+        start = 0
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "rb") as f:
+                    state = pickle.load(f)
+                self.postings = state["postings"]
+                self.offsets = state["offsets"]
+                self.doc_rooms = state["doc_rooms"]
+                self.rooms = state["rooms"]
+                self.room_ids = {room: i for i, room in enumerate(self.rooms)}
+                start = state["end"]
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError) as e:
+                print(f"Search snapshot unusable, reindexing: {e}")
+                self._reset()
+                start = 0
+
+        if os.path.exists(self.docs_path):
+            with open(self.docs_path, "rb") as f:
+                f.seek(start)
+                offset = start
+                for line in f:
+                    try:
+                        room, _, _, text = json.loads(line)
+                    except ValueError:
+                        break
+                    self._index(offset, room, text)
+                    offset += len(line)
+            # Drop a torn trailing line so later appends stay parseable
+            if offset < os.path.getsize(self.docs_path):
+                with open(self.docs_path, "r+b") as f:
+                    f.truncate(offset)
+
+    def save(self):
+        with self._lock:
+            if self._docs_file is not None:
+                self._docs_file.flush()
+            state = {
+                "postings": self.postings,
+                "offsets": self.offsets,
+                "doc_rooms": self.doc_rooms,
+                "rooms": self.rooms,
+                "end": os.path.getsize(self.docs_path)
+                if os.path.exists(self.docs_path)
+                else 0,
+            }
+            tmp = self.snapshot_path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.snapshot_path)
+
+    # Indexing
+
+    def _index(self, offset, room, text):
+        doc = len(self.offsets)
+        room_id = self.room_ids.get(room)
+        if room_id is None:
+            room_id = self.room_ids[room] = len(self.rooms)
+            self.rooms.append(room)
+        self.offsets.append(offset)
+        self.doc_rooms.append(room_id)
+        for term in tokenize(text):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array("I")
+            postings.append(doc)
+
+    def _store(self, room, when, user, text):
+        line = (json.dumps([room, when, user, text]) + "\n").encode()
+        offset = self._docs_file.tell()
+        self._docs_file.write(line)
+        return offset
+
+    def add(self, room, when, user, text):
+        """Queue a message for indexing; returns immediately"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((room, when, user, text))
+
+    def _run(self):
+        self._docs_file = open(self.docs_path, "ab")
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            with self._lock:
+                for record in batch:
+                    if record is self._STOP:
+                        self._docs_file.flush()
+                        return
+                    room, when, user, text = record
+                    self._index(self._store(room, when, user, text), room, text)
+                self._docs_file.flush()
+
+    def close(self):
+        """Index everything queued and write a snapshot"""
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+        if self.offsets:
+            self.save()
+        if self._docs_file is not None:
+            self._docs_file.close()
+            self._docs_file = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    # Querying
+
+    def _doc(self, doc):
+        if self._reader is None:
+            self._reader = open(self.docs_path, "rb")
+        self._reader.seek(self.offsets[doc])
+        return json.loads(self._reader.readline())
+
+    def search(self, query, room=None, limit=RESULT_LIMIT):
+        """Ranked matches as (room, time, user, text) tuples.
+
+        Messages containing every term come first, newest first. If there
+        are fewer than `limit`, messages matching some of the terms follow,
+        ranked by the summed IDF of the terms they contain.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        with self._lock:
+            room_id = None
+            if room is not None:
+                room_id = self.room_ids.get(room)
+                if room_id is None:
+                    return []
+
+            total = len(self.offsets)
+            lists = sorted(
+                (self.postings.get(t, array.array("I")) for t in terms), key=len
+            )
+            docs = self._match_all(lists, room_id, limit)
+            if len(docs) < limit and len(lists) > 1:
+                docs += self._match_some(lists, room_id, limit - len(docs), set(docs), total)
+            return [tuple(self._doc(d)) for d in docs]
+
+    def _match_all(self, lists, room_id, limit):
+        rarest, others = lists[0], lists[1:]
+        found = []
+        for i in range(len(rarest) - 1, -1, -1):
+            doc = rarest[i]
+            if room_id is not None and self.doc_rooms[doc] != room_id:
+                continue
+            if all(_contains(other, doc) for other in others):
+                found.append(doc)
+                if len(found) == limit:
+                    break
+        return found
+
+    def _match_some(self, lists, room_id, limit, exclude, total):
+        scores = {}
+        common = max(COMMON_TERM_MIN, total * COMMON_TERM_RATIO)
+        for postings in lists:
+            if not postings or len(postings) > common:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for doc in postings:
+                scores[doc] = scores.get(doc, 0.0) + idf
+        ranked = sorted(
+            (
+                (score, doc)
+                for doc, score in scores.items()
+                if doc not in exclude
+                and (room_id is None or self.doc_rooms[doc] == room_id)
+            ),
+            reverse=True,
+        )
+        return [doc for _, doc in ranked[:limit]]
+
+
+def _contains(postings, doc):
+    i = bisect.bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+def rebuild(log_dir, directory=None):
+    """Recreate the index from the plain-text room logs in log_dir"""
+    directory = directory or os.path.join(log_dir, "search")
+    os.makedirs(directory, exist_ok=True)
+    for name in ("docs.jsonl", "index.pickle"):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    index = SearchIndex(directory)
+    count = 0
+    with open(index.docs_path, "ab") as docs:
+        index._docs_file = docs
+        for name in sorted(os.listdir(log_dir)):
+            path = os.path.join(log_dir, name)
+            if not name.endswith(".txt") or name == "global.txt" or not os.path.isfile(path):
+                continue
+            room = name[:-4]
+            with open(path, encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    m = LOG_LINE_RE.match(line.rstrip("\n"))
+                    if m is None:
+                        continue
+                    when, user, text = m.groups()
+                    index._index(index._store(room, when, user, text), room, text)
+                    count += 1
+    index._docs_file = None
+    index.save()
+    return count
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Usage: python search.py rebuild [log_dir]")
+        sys.exit(1)
+    log_dir = sys.argv[2] if len(sys.argv) > 2 else "chat_logs"
+    started = time.perf_counter()
+    count = rebuild(log_dir)
+    print(f"Indexed {count} messages in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
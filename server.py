@@ -1,326 +1,3401 @@
 import socket
 import threading
 import json
+import base64
 import datetime
 import os
+import select
+import argparse
+import asyncio
+import collections
+import queue
+import time
+import atexit
+import itertools
+import secrets
+import signal
+import sys
+import zlib
+
+from framing import COMPRESS_ACK, READ_SIZE
+from storage import MessageStore
+from search import SearchIndex
+from metrics import MetricsRegistry, RateMeter, serve_http
+from bus import BusClient, BusHub
+from federation import Federation
+from ratelimit import RateLimiter
+from files import FileServer, FileStore
+import multicast as mcast
+import handoff
+import wire
 
 HOST = "0.0.0.0"  # Listen on all network interfaces
 PORT = 3000
+LISTEN_BACKLOG = 1024  # pending connections, capped by net.core.somaxconn
+SERVER_MODE = "threaded"  # "threaded" or "asyncio"
+
+# Admission control, checked at accept before a connection costs a thread.
+# Limits are per process, so with --workers N the totals are N times higher
+MAX_CONNECTIONS = 5000  # open client connections, 0 = unlimited
+MAX_CONNECTIONS_PER_IP = 20  # open connections per address, admins exempt; 0 = unlimited
+HELLO_TIMEOUT = 10.0  # seconds a new connection has to send its hello, 0 = no limit
+
+# Outbound queue limits per connection
+OUTBOUND_QUEUE_SIZE = 1000  # frames
+OUTBOUND_QUEUE_BYTES = 4 * 1024 * 1024
+SLOW_CONSUMER_POLICY = "drop_oldest"  # "drop_oldest", "drop_connection" or "coalesce"
+
+# Outbound writes: frames sent to a connection within this many seconds are
+# written together in one vectored send. TCP_NODELAY then pushes each write
+# out at once instead of waiting on Nagle's algorithm.
+WRITE_COALESCE_DELAY = 0.001
+TCP_NODELAY = True
+
+# zlib stream compression for clients that ask for it in their hello.
+# A 4 KB window still spans dozens of messages, and it keeps each
+# connection's compressor at about 32 KB.
+COMPRESSION = True  # accept compression requests
+COMPRESS_LEVEL = 6
+COMPRESS_WBITS = 12
+COMPRESS_MEMLEVEL = 5
+
+# Compact binary frames (see wire.py) for clients that ask in their hello
+BINARY_WIRE = True
+
+# Chat log writer
+LOG_DIR = "chat_logs"
+LOG_FLUSH_INTERVAL = 0.5  # seconds between flushes to the OS
+LOG_FSYNC = "never"  # "never" or "interval" (fsync on every flush)
+LOG_MAX_OPEN_FILES = 64
+
+# Recent messages kept in memory per room
+HISTORY_MAX_MESSAGES = 500
+HISTORY_MAX_BYTES = 512 * 1024
+HISTORY_BACKLOG = 50  # messages replayed to someone entering a room
+
+# Segmented on-disk history served by /history
+STORE_DIR = os.path.join(LOG_DIR, "store")
+STORE_SEGMENT_BYTES = 16 * 1024 * 1024
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE = 200
+
+# Full-text search index served by /search
+SEARCH_DIR = os.path.join(LOG_DIR, "search")
+
+# Instrumentation
+ADMIN_IPS = {"127.0.0.1", "::1"}  # addresses allowed to run /stats
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None  # Prometheus endpoint, off unless set
+STATS_DUMP_INTERVAL = 0  # seconds between dumps to chat_logs/stats.txt, 0 = off
+
+# Multi-process mode: worker processes sharing PORT through SO_REUSEPORT
+WORKERS = 1
+BUS_PATH = None  # Unix socket of the worker bus, default chat_logs/bus-<port>.sock
+
+# Federation with chat servers on other machines
+SERVER_NAME = None  # unique name among federated servers, default <hostname>:<port>
+FEDERATION_PORT = None  # accept peer links here, off unless set
+PEERS = []  # "host:port" federation addresses to keep a link to
+FEDERATION_SECRET = None  # shared secret peers must prove, else only PEERS hosts may link
+FEDERATED_OPS = ("msg", "room", "pm", "join", "move", "leave")
+
+# Flood control: token buckets of (rate per second, burst) per scope and
+# kind of event. Scopes are "conn" (one connection), "ip" (all connections
+# from an address) and "room" (everyone posting to a room).
+RATE_LIMITS = {
+    ("conn", "msg"): (5, 20),
+    ("conn", "command"): (5, 20),
+    ("conn", "pm"): (2, 10),
+    ("ip", "msg"): (15, 60),
+    ("ip", "command"): (15, 60),
+    ("ip", "pm"): (5, 20),
+    ("room", "msg"): (50, 200),
+}
+RATE_LIMIT_ACTION = "delay"  # "delay" stops reading from the sender, "drop" discards
+RATE_LIMIT_ADMINS = False  # admins (ADMIN_IPS) are exempt unless set
+BAN_AFTER = 0  # throttled events within BAN_WINDOW that ban the IP, 0 = never
+BAN_WINDOW = 10.0  # seconds
+THROTTLE_NOTICE_INTERVAL = 2.0  # seconds between "too fast" notices per client
+
+# Heartbeats and reaping of dead connections
+PING_INTERVAL = 30.0  # ping a client silent for this long, 0 = never
+IDLE_TIMEOUT = 90.0  # drop a client silent for this long, 0 = never
+WRITE_TIMEOUT = 30.0  # drop a client whose socket accepts nothing for this long
+REAP_INTERVAL = 5.0  # seconds between sweeps
+
+# Session resume
+RESUME_GRACE = 60.0  # seconds a dropped client's seat is held for it, 0 = off
+RESUME_MAX_REPLAY = 500  # missed messages replayed to a returning client
+# Identifies this run of the server (workers inherit it): the store's tail may
+# be lost in a crash, so seqs are only unique within one epoch
+EPOCH = secrets.token_hex(4)
+
+# Zero-downtime upgrades (handoff.py)
+UPGRADES = True  # let a new server started with --takeover take over
+UPGRADE_PATH = None  # Unix socket for takeovers, default chat_logs/upgrade-<port>.sock
+HANDOFF_TIMEOUT = 10.0  # seconds to settle and flush clients before handing them over
+
+# Presence updates pushed to clients
+PRESENCE_DELAY = 0.25  # seconds room changes are collected into one update
+
+# File transfer side channel (files.py)
+FILE_PORT = None  # default PORT + 1, 0 = off
+FILES_DIR = os.path.join(LOG_DIR, "files")
+MAX_FILE_SIZE = 100 * 1024 * 1024
+FILE_QUOTA = 1024 * 1024 * 1024  # bytes the spool may hold in total, 0 = no limit
+FILE_TTL = 7 * 24 * 3600  # seconds a shared file is kept, 0 = forever
+FILE_SECRET = secrets.token_bytes(32)  # signs tickets; forked workers inherit it
+
+# Multicast delivery of room traffic (multicast.py)
+MULTICAST = False  # offer multicast to clients that ask for it
+MULTICAST_PORT = None  # UDP port, default PORT + 2; workers add their index
+MULTICAST_INTERFACE = None  # address of the interface to send on, default by route
+MULTICAST_TTL = 1  # stay on the local network
+
+banned_ips = set()
+
+os.makedirs(LOG_DIR, exist_ok=True)
+
+
+class ClientRegistry:
+    """Connected clients indexed by connection, room and username.
+
+    Every update happens under one lock so the three indexes always agree.
+    Lookups return snapshots, so callers can send to the members without
+    holding the lock. Room and name indexes keep insertion order, which
+    keeps /users listing people in the order they arrived.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._info = {}  # conn -> {"username", "room", "addr"}
+        self._rooms = {}  # room -> {conn: info}
+        self._names = {}  # username -> {conn: info}
+
+    def __contains__(self, conn):
+        return conn in self._info
+
+    def __len__(self):
+        return len(self._info)
+
+    def get(self, conn):
+        """Return the info dict for a connection, or None"""
+        return self._info.get(conn)
+
+    def add(self, conn, username, room, addr):
+        info = {"username": username, "room": room, "addr": addr}
+        with self._lock:
+            self._info[conn] = info
+            self._rooms.setdefault(room, {})[conn] = info
+            self._names.setdefault(username, {})[conn] = info
+        return info
+
+    def remove(self, conn):
+        """Drop a connection from every index and return its info"""
+        with self._lock:
+            info = self._info.pop(conn, None)
+            if info is None:
+                return None
+            self._discard(self._rooms, info["room"], conn)
+            self._discard(self._names, info["username"], conn)
+            return info
+
+    def move(self, conn, new_room):
+        """Switch a connection to another room and return the old one"""
+        with self._lock:
+            info = self._info[conn]
+            old_room = info["room"]
+            self._discard(self._rooms, old_room, conn)
+            info["room"] = new_room
+            self._rooms.setdefault(new_room, {})[conn] = info
+            return old_room
+
+    def members(self, room):
+        """Snapshot of (conn, info) pairs in a room"""
+        with self._lock:
+            return list(self._rooms.get(room, {}).items())
+
+    def usernames(self, room):
+        with self._lock:
+            return [info["username"] for info in self._rooms.get(room, {}).values()]
+
+    def rooms(self):
+        """Names of rooms with at least one member"""
+        with self._lock:
+            return list(self._rooms)
+
+    def find(self, username):
+        """Return the first connection using a username, or None"""
+        with self._lock:
+            for conn in self._names.get(username, ()):
+                return conn
+        return None
+
+    def items(self):
+        with self._lock:
+            return list(self._info.items())
+
+    @staticmethod
+    def _discard(index, key, conn):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(conn, None)
+            if not bucket:
+                del index[key]
+
+
+clients = ClientRegistry()
+
+
+# Worker bus and federation state. Every client gets a bus id,
+# "<server name>/<worker>:<n>". In a worker process `bus` is its BusClient;
+# clients of other workers and of federated servers are tracked in
+# remote_clients, keyed by their bus id.
+bus = None
+hub = None  # BusHub, in the supervisor of a multi-process server
+federation = None  # Federation, in a single-process server or the supervisor
+bus_loop = None  # event loop that bus and peer events are handed to
+worker_id = 0
+remote_clients = ClientRegistry()
+bus_conns = {}  # bus id -> local connection, for replies routed back
+bus_ids = itertools.count()
+
+
+def publish(op, **fields):
+    """Tell the other workers, or the federated servers, about something"""
+    if bus is not None:
+        fields["op"] = op
+        bus.publish(fields)
+    elif federation is not None and op in FEDERATED_OPS:
+        fields["op"] = op
+        federation.send(fields)
+
+
+class PresenceTracker:
+    """Who is in which room, with changes pushed to the rooms in batches.
+
+    Covers local and remote clients alike. A join, leave or room change
+    updates the live counts at once and adds to the room's pending delta;
+    every PRESENCE_DELAY the net deltas go out as one event per room, so a
+    storm of joins (say, everyone reconnecting after a restart) costs each
+    client one update instead of hundreds. A join and leave of the same name
+    in one batch cancel out.
+
+    Snapshots show a room as of its last published delta, and carry the
+    version (number of deltas) they include, so a client can drop any delta
+    its snapshot already covers and apply the rest.
+    """
+
+    def __init__(self, delay=PRESENCE_DELAY):
+        self.delay = delay
+        self.rooms = {}  # room -> {username: connections}, live
+        self.published = {}  # room -> {username: connections}, as clients know it
+        self.versions = {}  # room -> deltas published
+        self.pending = {}  # room -> {username: net change}
+        self.batches = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def save(self):
+        """Everything tracked, for the server taking over; stops the batch
+        timer, so nothing further is published from here"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            copy = lambda rooms: {room: dict(counts) for room, counts in rooms.items()}
+            return {
+                "rooms": copy(self.rooms),
+                "published": copy(self.published),
+                "versions": dict(self.versions),
+                "pending": copy(self.pending),
+            }
+
+    def load(self, state):
+        """Carry on from save(); pending changes wait for the next flush()"""
+        with self._lock:
+            self.rooms = state["rooms"]
+            self.published = state["published"]
+            self.versions = state["versions"]
+            self.pending = state["pending"]
+
+    def join(self, room, username):
+        self._change(room, username, 1)
+
+    def leave(self, room, username):
+        self._change(room, username, -1)
+
+    @staticmethod
+    def _apply(rooms, room, username, delta):
+        counts = rooms.setdefault(room, {})
+        count = counts.get(username, 0) + delta
+        if count > 0:
+            counts[username] = count
+        else:
+            counts.pop(username, None)
+            if not counts:
+                del rooms[room]
+
+    def _change(self, room, username, delta):
+        with self._lock:
+            self._apply(self.rooms, room, username, delta)
+            changes = self.pending.setdefault(room, {})
+            net = changes.get(username, 0) + delta
+            if net:
+                changes[username] = net
+            else:
+                changes.pop(username, None)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    @staticmethod
+    def _names(counts):
+        return [name for name, count in counts.items() for _ in range(count)]
+
+    def users(self, room):
+        """Usernames in a room, one per connection, in order of arrival"""
+        with self._lock:
+            return self._names(self.rooms.get(room, {}))
+
+    def room_names(self):
+        with self._lock:
+            return list(self.rooms)
+
+    def snapshot(self, room):
+        """Full presence event for a client entering a room"""
+        with self._lock:
+            return {
+                "type": "presence",
+                "room": room,
+                "v": self.versions.get(room, 0),
+                "users": self._names(self.published.get(room, {})),
+            }
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            pending, self.pending = self.pending, {}
+            for room, changes in pending.items():
+                if changes:
+                    self._publish(room, changes)
+
+    def _publish(self, room, changes):
+        for name, net in changes.items():
+            self._apply(self.published, room, name, net)
+        version = self.versions.get(room, 0) + 1
+        self.versions[room] = version
+        payload = {"type": "presence", "room": room, "v": version}
+        joined = [name for name, net in changes.items() for _ in range(net)]
+        left = [name for name, net in changes.items() for _ in range(-net)]
+        if joined:
+            payload["join"] = joined
+        if left:
+            payload["leave"] = left
+        self.batches += 1
+        dispatch_bus_event({"op": "presence", "room": room, "payload": payload})
+
+
+roster = PresenceTracker()
+
+
+class RoomHistory:
+    """Ring buffer of recent encoded messages per room.
+
+    Each room keeps at most max_messages frames and max_bytes bytes; the
+    oldest frames are evicted first. Frames are stored already encoded so a
+    backlog can be replayed with one write and no re-serialization.
+    """
+
+    def __init__(self, max_messages=HISTORY_MAX_MESSAGES, max_bytes=HISTORY_MAX_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._rooms = {}  # room -> [deque of frames, total bytes]
+
+    def append(self, room, frame):
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                entry = self._rooms[room] = [collections.deque(), 0]
+            frames = entry[0]
+            frames.append(frame)
+            entry[1] += len(frame)
+            while len(frames) > self.max_messages or (
+                entry[1] > self.max_bytes and len(frames) > 1
+            ):
+                entry[1] -= len(frames.popleft())
+
+    def rooms(self):
+        with self._lock:
+            return list(self._rooms)
+
+    def recent(self, room, count):
+        """The last `count` frames of a room, oldest first"""
+        if count <= 0:
+            return []
+        with self._lock:
+            entry = self._rooms.get(room)
+            if entry is None:
+                return []
+            frames = entry[0]
+            start = max(0, len(frames) - count)
+            return [frames[i] for i in range(start, len(frames))]
+
+
+history = RoomHistory()
+
+
+store = MessageStore(STORE_DIR, segment_bytes=STORE_SEGMENT_BYTES)
+atexit.register(store.close)
+
+
+def parse_history_before(room, value):
+    """Turn a /history position into a seq: a seq number or an ISO time"""
+    if value.isdigit():
+        return int(value)
+    if "-" in value:
+        when = datetime.datetime.fromisoformat(value)
+    else:
+        # Bare time of day means today
+        when = datetime.datetime.combine(
+            datetime.date.today(), datetime.time.fromisoformat(value)
+        )
+    return store.seq_at_time(room, int(when.timestamp() * 1000))
+
+
+def send_earlier(conn, room, frames):
+    """Send frames a client asked to see again, between two "backlog" markers.
+
+    Clients drop room messages whose seq they have already seen, which is
+    meant for a resume replay; inside the markers they show them anyway.
+    """
+    conn.send(
+        b"".join(
+            [
+                encode({"type": "backlog", "room": room}),
+                *frames,
+                encode({"type": "backlog", "room": room, "end": True}),
+            ]
+        )
+    )
+
+
+def send_history(conn, room, args):
+    """Answer /history [before] [count] with one page of stored messages"""
+    try:
+        before = parse_history_before(room, args[0]) if args else None
+        count = int(args[1]) if len(args) > 1 else HISTORY_PAGE_SIZE
+    except ValueError:
+        send_json(conn, system_message("Usage: /history [before] [count]"))
+        return
+
+    count = max(1, min(count, HISTORY_MAX_PAGE))
+    start, payloads = store.read(room, before, count)
+    if not payloads:
+        send_json(conn, system_message(f"No earlier history in {room}"))
+        return
+
+    end = start + len(payloads) - 1
+    frames = [encode(system_message(f"History of {room}: #{start}-#{end}"))]
+    frames.extend(payloads)
+    if start > 0:
+        frames.append(encode(system_message(f"Older messages: /history {start}")))
+    send_earlier(conn, room, frames)
+
+
+search_index = SearchIndex(SEARCH_DIR)
+atexit.register(search_index.close)
+
+
+def send_search(conn, args):
+    """Answer /search <terms> [room]; a trailing known room name filters"""
+    room = None
+    if len(args) > 1 and args[-1] in search_index.room_ids:
+        room = args[-1]
+        args = args[:-1]
+    query = " ".join(args)
+    if not query:
+        send_json(conn, system_message("Usage: /search <terms> [room]"))
+        return
+
+    started = time.perf_counter()
+    results = search_index.search(query, room)
+    elapsed = (time.perf_counter() - started) * 1000
+
+    where = f" in {room}" if room else ""
+    frames = [
+        encode(
+            system_message(
+                f"Search '{query}'{where}: {len(results)} result(s) in {elapsed:.1f} ms"
+            )
+        )
+    ]
+    for r_room, when, user, text in results:
+        frames.append(encode(system_message(f"[{r_room}] {when} {user}: {text}")))
+    conn.send(b"".join(frames))
+
+
+def send_backlog(conn, room):
+    """Replay a room's recent messages to one client in a single write"""
+    frames = history.recent(room, HISTORY_BACKLOG)
+    if frames:
+        send_earlier(conn, room, frames)
+
+
+outbound_stats = {"dropped": 0, "coalesced": 0, "disconnected": 0}
+outbound_stats_lock = threading.Lock()
+
+
+def count_outbound(key, n=1):
+    with outbound_stats_lock:
+        outbound_stats[key] += n
+
+
+# Instrumentation, rendered by /stats and the Prometheus endpoint
+started_at = time.time()
+metrics = MetricsRegistry()
+room_rates = {}  # room -> RateMeter of chat messages
+COMMANDS = ("/users", "/allrooms", "/pm", "/join", "/history", "/search", "/stats", "/help")
+
+connections_accepted = metrics.counter(
+    "chat_connections_accepted_total", "Connections accepted"
+)
+connections_rejected = metrics.counter(
+    "chat_connections_rejected_total", "Connections turned away", label="reason"
+)
+connections_adopted = metrics.counter(
+    "chat_connections_adopted_total", "Connections taken over from the previous server"
+)
+decode_errors = metrics.counter(
+    "chat_decode_errors_total", "Incoming lines that were not valid JSON"
+)
+commands_total = metrics.counter(
+    "chat_commands_total", "Commands handled", label="command"
+)
+decode_seconds = metrics.histogram(
+    "chat_decode_seconds", "Time to parse one incoming line"
+)
+command_seconds = metrics.histogram(
+    "chat_command_seconds", "Time to dispatch one command"
+)
+broadcast_seconds = metrics.histogram(
+    "chat_broadcast_seconds", "Time to fan one event out to a room"
+)
+broadcast_recipients = metrics.counter(
+    "chat_broadcast_recipients_total", "Frames queued by room broadcasts"
+)
+log_write_seconds = metrics.histogram(
+    "chat_log_write_seconds", "Time to write one batch of chat log records"
+)
+
+
+binary_connections = metrics.counter(
+    "chat_binary_connections_total", "Connections that switched to the binary wire format"
+)
+compressed_connections = metrics.counter(
+    "chat_compressed_connections_total", "Connections that negotiated compression"
+)
+compress_raw_bytes = metrics.counter(
+    "chat_compress_raw_bytes_total", "Bytes written to compressed connections, before compression"
+)
+compress_wire_bytes = metrics.counter(
+    "chat_compress_wire_bytes_total", "Bytes written to compressed connections, after compression"
+)
+
+
+frames_written = metrics.counter(
+    "chat_frames_written_total", "Frames written to client sockets"
+)
+socket_writes = metrics.counter(
+    "chat_socket_writes_total", "Coalesced writes to client sockets"
+)
+
+
+throttled = metrics.counter(
+    "chat_throttled_total", "Events held back by rate limits", label="limit"
+)
+bans = metrics.counter("chat_bans_total", "Addresses banned for flooding")
+
+
+multicast_saved = metrics.counter(
+    "chat_multicast_saved_total", "Unicast frames replaced by multicast datagrams"
+)
+
+
+def file_bytes():
+    if file_server is None:
+        return {}
+    return {"upload": file_server.upload_bytes, "download": file_server.download_bytes}
+
+
+metrics.gauge(
+    "chat_file_bytes_total",
+    "File bytes moved over the side channel",
+    file_bytes,
+    label="direction",
+    type="counter",
+)
+
+
+pings_sent = metrics.counter("chat_pings_total", "Heartbeat pings sent to idle clients")
+reaped = metrics.counter(
+    "chat_reaped_total", "Dead connections closed by the reaper", label="reason"
+)
+
+
+sessions_resumed = metrics.counter("chat_sessions_resumed_total", "Sessions resumed")
+sessions_expired = metrics.counter(
+    "chat_sessions_expired_total", "Held seats given up after the resume grace period"
+)
+
+
+def outbound_depths():
+    return [conn.depth for conn, _ in clients.items()]
+
+
+metrics.gauge(
+    "chat_messages_total",
+    "Chat messages received",
+    lambda: {room: meter.total for room, meter in list(room_rates.items())},
+    label="room",
+    type="counter",
+)
+metrics.gauge("chat_connections", "Registered clients", lambda: len(clients))
+metrics.gauge(
+    "chat_room_members",
+    "Clients per room",
+    lambda: {room: len(clients.members(room)) for room in clients.rooms()},
+    label="room",
+)
+metrics.gauge(
+    "chat_outbound_backlog_frames",
+    "Frames waiting in all outbound queues",
+    lambda: sum(outbound_depths()),
+)
+metrics.gauge(
+    "chat_outbound_backlog_max_frames",
+    "Largest single outbound queue",
+    lambda: max(outbound_depths(), default=0),
+)
+metrics.gauge(
+    "chat_outbound_events_total",
+    "Slow-consumer actions taken",
+    lambda: dict(outbound_stats),
+    label="event",
+    type="counter",
+)
+metrics.gauge(
+    "chat_log_records_total",
+    "Chat log records written",
+    lambda: log_writer.records,
+    type="counter",
+)
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return ">1000"
+    return f"{seconds * 1000:g}"
+
+
+def stats_report():
+    """Human-readable summary for /stats and the periodic dump"""
+    uptime = int(time.time() - started_at)
+    conns = clients.items()
+    rates = sorted(
+        ((meter.rate(), room) for room, meter in list(room_rates.items())),
+        reverse=True,
+    )
+    total_messages = sum(meter.total for meter in list(room_rates.values()))
+
+    lines = [f"Worker {worker_id} of {WORKERS} (pid {os.getpid()})"] if bus else []
+    lines += [
+        f"Uptime {uptime // 3600}h{uptime // 60 % 60:02d}m, "
+        f"{len(conns)} connections in {len(clients.rooms())} rooms, "
+        f"{connections_accepted.value} accepted",
+        f"Messages: {total_messages} total, "
+        f"{sum(rate for rate, _ in rates):.2f}/s over the last minute",
+    ]
+    busiest = [f"{room} {rate:.2f}" for rate, room in rates[:5] if rate]
+    if busiest:
+        lines.append("Busiest rooms (msg/s): " + ", ".join(busiest))
+
+    latencies = [
+        f"{label} {format_ms(h.quantile(0.5))}/{format_ms(h.quantile(0.99))}"
+        for label, h in (
+            ("decode", decode_seconds),
+            ("command", command_seconds),
+            ("broadcast", broadcast_seconds),
+            ("log write", log_write_seconds),
+        )
+    ]
+    lines.append("Latency p50/p99 (ms): " + ", ".join(latencies))
+
+    backlog = sorted(((conn.depth, info["username"]) for conn, info in conns), reverse=True)
+    largest = [f"{name} {depth}" for depth, name in backlog[:5] if depth]
+    line = f"Outbound backlog: {sum(depth for depth, _ in backlog)} frames"
+    if largest:
+        line += f" (largest: {', '.join(largest)})"
+    with outbound_stats_lock:
+        line += (
+            f"; dropped {outbound_stats['dropped']}, "
+            f"coalesced {outbound_stats['coalesced']}, "
+            f"disconnected {outbound_stats['disconnected']}"
+        )
+    lines.append(line)
+    if socket_writes.value:
+        lines.append(
+            f"Writes: {frames_written.value} frames in {socket_writes.value} writes "
+            f"({frames_written.value / socket_writes.value:.1f} per write)"
+        )
+    if connections_rejected.values:
+        lines.append(
+            "Rejected connections: "
+            + ", ".join(f"{k} {v}" for k, v in sorted(connections_rejected.values.items()))
+        )
+    if connections_adopted.value:
+        lines.append(f"Taken over: {connections_adopted.value} connections from the previous server")
+    if pings_sent.value or reaped.values:
+        line = f"Heartbeats: {pings_sent.value} pings sent"
+        if reaped.values:
+            line += "; reaped " + ", ".join(f"{k} {v}" for k, v in sorted(reaped.values.items()))
+        lines.append(line)
+    if sessions or sessions_resumed.value or sessions_expired.value:
+        lines.append(
+            f"Sessions: {len(sessions)} seats held, {sessions_resumed.value} resumed, "
+            f"{sessions_expired.value} expired"
+        )
+    if throttled.values:
+        limits = ", ".join(f"{k} {v}" for k, v in sorted(throttled.values.items()))
+        lines.append(f"Throttled ({RATE_LIMIT_ACTION}): {limits}; {bans.value} bans")
+    lines.append(f"Log writer: {log_writer.records} records in {log_writer.batches} batches")
+    if compress_raw_bytes.value:
+        ratio = compress_wire_bytes.value / compress_raw_bytes.value
+        lines.append(
+            f"Compression: {compressed_connections.value} connections, "
+            f"{compress_raw_bytes.value} bytes sent as {compress_wire_bytes.value} ({ratio:.0%})"
+        )
+    if binary_connections.value:
+        lines.append(
+            f"Binary wire: {binary_connections.value} connections, "
+            f"{len(interned.ids[wire.USER])} users and {len(interned.ids[wire.ROOM])} rooms interned"
+        )
+    if file_server is not None:
+        lines.append(file_server.stats())
+    if multicast is not None:
+        lines.append(f"{multicast.stats()}, replacing {multicast_saved.value} unicast frames")
+    if federation is not None:
+        lines.append(
+            f"Federation '{SERVER_NAME}': {len(remote_clients)} remote clients, "
+            f"{federation.duplicates} duplicate events dropped"
+        )
+        lines.extend("  " + line for line in federation.stats())
+    return "\n".join(lines)
+
+
+def dump_stats_forever(interval):
+    while True:
+        time.sleep(interval)
+        write_log("stats.txt", f"[{timestamp()}]\n{stats_report()}\n\n")
+
+
+class Connection:
+    """A client socket plus a bounded queue of outgoing frames.
+
+    Handlers call send(), which only enqueues; a dedicated writer drains the
+    queue, so a client with a full TCP window never stalls the sender or the
+    rest of the room. When the queue is full, the slow-consumer policy decides
+    what gives:
+
+    - "drop_oldest": discard queued frames, oldest first
+    - "drop_connection": disconnect the client
+    - "coalesce": merge everything queued into one frame so the writer sends
+      it in a single call; disconnect only once the byte limit is reached
+
+    The writer waits WRITE_COALESCE_DELAY after waking up, so a burst of
+    frames goes out in one vectored write. Once compression is enabled, each
+    write is deflated through the connection's own zlib stream, so the queue
+    still holds plain frames.
+    """
+
+    def __init__(self, sock, addr, policy=None, max_frames=None, max_bytes=None):
+        self.sock = sock
+        self.addr = addr
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        self.max_frames = max_frames or OUTBOUND_QUEUE_SIZE
+        self.max_bytes = max_bytes or OUTBOUND_QUEUE_BYTES
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.bus_id = None
+        self.compressor = None
+        self.binary = None  # wire.Names, once on the binary wire format
+        self.notified_at = 0.0  # last "sending too fast" notice
+        self.wants_multicast = False
+        self.session = None  # resume token, if the client asked for one
+        self.leaving = False  # said goodbye, or was banned: do not hold its seat
+        self.last_recv = time.monotonic()
+        self.pinged_at = 0.0
+        self.write_started = None  # when a blocked write began
+        self.multicast = None  # room it currently receives by multicast
+        self._writer = None  # writer thread, None once it has stopped
+        self.detached = False  # closed by detach(), for reattach() to undo
+        self._unflushed = b""  # end of a zlib flush the writer still owes
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def start(self):
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def send(self, data):
+        """Queue JSON lines for delivery; returns False if the client is gone"""
+        if self.binary is not None:
+            data = wire.pack_lines(data)
+        return self.send_raw(data)
+
+    def send_packed(self, packed):
+        """Queue a message packed by wire.pack_message, naming what it uses"""
+        return self.binary.send(packed, self.send_raw)
+
+    def send_raw(self, data):
+        """Queue bytes in the connection's wire format as they are"""
+        with self._lock:
+            if self.closed:
+                return False
+            if self._full(len(data)) and not self._make_room(len(data)):
+                self.closed = True
+                overflow = True
+            else:
+                self.queue.append(data)
+                self.queued_bytes += len(data)
+                overflow = False
+
+        if overflow:
+            count_outbound("disconnected")
+            print(f"Dropping slow client {self.addr[0]}:{self.addr[1]}")
+            self.abort()
+            return False
+
+        self._ready.set()
+        return True
+
+    def enable_binary(self):
+        """Acknowledge a binary wire request; all later writes are frames.
+
+        Call only before the connection is registered, and before
+        enable_compression.
+        """
+        self._write_now(wire.WIRE_SWITCH + b"\n")
+        self.binary = wire.Names()
+        binary_connections.inc()
+
+    def enable_compression(self):
+        """Acknowledge a compression request and deflate all later writes.
+
+        Call only before the connection is registered, while nothing else
+        can be writing to it.
+        """
+        ack = COMPRESS_ACK + b"\n"
+        self._write_now(ack if self.binary is None else wire.pack_lines(ack))
+        self.compressor = zlib.compressobj(
+            COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_WBITS, COMPRESS_MEMLEVEL
+        )
+        compressed_connections.inc()
+
+    def _deflate(self, data):
+        """Bytes to put on the wire for one write"""
+        if self.compressor is None:
+            return data
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        compress_raw_bytes.inc(len(data))
+        compress_wire_bytes.inc(len(out))
+        return out
+
+    def _write_now(self, data):
+        self.sock.sendall(data)
+
+    def _full(self, size):
+        return (
+            len(self.queue) >= self.max_frames
+            or self.queued_bytes + size > self.max_bytes
+        )
+
+    def _make_room(self, size):
+        """Apply the slow-consumer policy; False means disconnect"""
+        if self.policy == "drop_oldest":
+            dropped = 0
+            while self.queue and self._full(size):
+                self.queued_bytes -= len(self.queue.popleft())
+                dropped += 1
+            self.dropped += dropped
+            count_outbound("dropped", dropped)
+            if dropped and self.binary is not None:
+                # The NAME frames of what is still queued may have gone too
+                self.binary.forget()
+            return not self._full(size)
+
+        if self.policy == "coalesce":
+            if self.queued_bytes + size > self.max_bytes:
+                return False
+            merged = b"".join(self.queue)
+            self.queue.clear()
+            self.queue.append(merged)
+            count_outbound("coalesced")
+            return True
+
+        return False
+
+    def _take(self):
+        """Pop every queued frame"""
+        with self._lock:
+            frames = list(self.queue)
+            self.queue.clear()
+            self.queued_bytes = 0
+            return frames
+
+    def _write_loop(self):
+        try:
+            if self._unflushed:
+                self.sock.sendall(self._unflushed)
+                self._unflushed = b""
+            while True:
+                self._ready.wait()
+                if WRITE_COALESCE_DELAY:
+                    # Let the rest of the burst catch up
+                    time.sleep(WRITE_COALESCE_DELAY)
+                self._ready.clear()
+                frames = self._take()
+                if frames:
+                    self.write_started = time.monotonic()
+                    send_vectored(self.sock, self._prepare(frames))
+                    self.write_started = None
+                with self._lock:
+                    if self.closed and not self.queue:
+                        # Decided under the lock, so reattach() knows
+                        self._writer = None
+                        break
+        except OSError:
+            self.abort()
+
+    def _prepare(self, frames):
+        """The buffers for one coalesced write of frames"""
+        frames_written.inc(len(frames))
+        socket_writes.inc()
+        if self.compressor is not None:
+            return [self._deflate(b"".join(frames))]
+        return frames
+
+    def abort(self):
+        """Tear the connection down so the reader sees EOF"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+        self._ready.set()
+
+    def detach(self):
+        """Take no more frames; the writer stops once the queue is written.
+
+        For handing the socket to another process, see wait_detached().
+        """
+        with self._lock:
+            if not self.closed:
+                self.closed = self.detached = True
+        self._ready.set()
+
+    def wait_detached(self, deadline):
+        """Wait for the writer to stop, then end the zlib stream where a new
+        one can carry on. False if the client is not reading fast enough."""
+        writer = self._writer
+        if writer is not None:
+            writer.join(max(0.0, deadline - time.monotonic()))
+            if writer.is_alive():
+                return False
+        if self.compressor is None:
+            return True
+        data = self.compressor.flush(zlib.Z_FULL_FLUSH)
+        try:
+            sent = self.sock.send(data, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            return False
+        # Owed to the client should this process carry on after all
+        self._unflushed = data[sent:]
+        return not self._unflushed
+
+    def reattach(self):
+        """Undo detach() when a handover falls through. The zlib stream
+        carries on after wait_detached()'s full flush."""
+        with self._lock:
+            if not self.detached:
+                return
+            self.closed = self.detached = False
+            stopped = self._writer is None
+        if stopped:
+            self.start()
+
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def send_vectored(sock, buffers):
+    """sendall() for a list of buffers, gathered into as few syscalls as possible"""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    i = 0
+    while i < len(buffers):
+        sent = sock.sendmsg(buffers[i : i + IOV_MAX])
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        if sent:
+            buffers[i] = memoryview(buffers[i])[sent:]
+
+
+def timestamp():
+    return datetime.datetime.now().strftime("%H:%M:%S")
+
+
+class LogWriter:
+    """Appends chat log lines from a background thread.
+
+    Callers only put (filename, line) records on a queue. The writer thread
+    takes everything queued, groups it per file and writes each group with a
+    single call, keeping up to max_open files open in LRU order. Buffers are
+    flushed every flush_interval seconds (and fsynced too when fsync is
+    "interval"); close() drains the queue and closes every file.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        directory=LOG_DIR,
+        flush_interval=LOG_FLUSH_INTERVAL,
+        fsync=LOG_FSYNC,
+        max_open=LOG_MAX_OPEN_FILES,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_open = max_open
+        self.records = 0
+        self.batches = 0
+        self._queue = queue.SimpleQueue()
+        self._files = collections.OrderedDict()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def write(self, filename, line):
+        if self._thread is None:
+            self._start()
+        self._queue.put((filename, line))
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def close(self):
+        """Write out everything queued and close all files"""
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _open(self, filename):
+        f = self._files.get(filename)
+        if f is not None:
+            self._files.move_to_end(filename)
+            return f
+
+        f = open(
+            os.path.join(self.directory, filename),
+            "a",
+            encoding="utf-8",
+            # Clients can send lone surrogates; keep them visible, not fatal
+            errors="backslashreplace",
+            buffering=64 * 1024,
+        )
+        self._files[filename] = f
+        if len(self._files) > self.max_open:
+            _, oldest = self._files.popitem(last=False)
+            self._close_file(oldest)
+        return f
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync == "interval":
+            os.fsync(f.fileno())
+
+    def _close_file(self, f):
+        try:
+            self._sync(f)
+        finally:
+            f.close()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        dirty = set()
+        stop = False
+
+        while not stop:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            grouped = {}
+            for record in batch:
+                if record is self._STOP:
+                    stop = True
+                    continue
+                filename, line = record
+                grouped.setdefault(filename, []).append(line)
+                self.records += 1
+
+            started = time.perf_counter()
+            for filename, lines in grouped.items():
+                try:
+                    self._open(filename).write("".join(lines))
+                    dirty.add(filename)
+                except Exception as e:
+                    # Lose this batch, never the writer thread
+                    print(f"Error writing log {filename}: {e!r}")
+            if grouped:
+                self.batches += 1
+                log_write_seconds.observe(time.perf_counter() - started)
+
+            now = time.monotonic()
+            if stop or now - last_flush >= self.flush_interval:
+                for filename in dirty:
+                    f = self._files.get(filename)
+                    if f is not None:
+                        try:
+                            self._sync(f)
+                        except Exception as e:
+                            print(f"Error flushing log {filename}: {e!r}")
+                dirty.clear()
+                last_flush = now
+
+        while self._files:
+            _, f = self._files.popitem(last=False)
+            try:
+                self._close_file(f)
+            except OSError:
+                pass
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.close)
+
+
+def write_log(filename, text):
+    """Append to a log file; workers hand the write to the supervisor"""
+    if bus is None:
+        log_writer.write(filename, text)
+    else:
+        publish("log", file=filename, text=text)
+
+
+def log(room, message):
+    """Log messages to room-specific files"""
+    write_log(f"{room}.txt", message + "\n")
+
+
+def log_global(message):
+    """Log global server events"""
+    write_log("global.txt", f"[{timestamp()}] {message}\n")
+
+
+def encode(payload):
+    """Encode a payload as one JSON line"""
+    return (json.dumps(payload) + "\n").encode()
+
+
+def broadcast(room, message):
+    """Send message to all clients in a specific room, on every worker"""
+    broadcast_local(room, message)
+    publish("room", room=room, payload=message)
+
+
+def broadcast_local(room, message, frame=None):
+    """Send message to the clients of a room connected to this process.
+
+    The message is encoded once and the same frame queued for every member;
+    pass frame if the caller already has it.
+    """
+    started = time.perf_counter()
+    if frame is None:
+        frame = encode(message)
+    members = clients.members(room)
+    if multicast is not None:
+        members = multicast_fanout(room, frame, members)
+    packed = None
+    for client, info in members:
+        try:
+            if client.binary is None:
+                client.send_raw(frame)
+            else:
+                if packed is None:
+                    packed = wire.pack_message(message, frame, interned)
+                client.send_packed(packed)
+        except Exception as e:
+            print(f"Error broadcasting to {info['username']}: {e}")
+    broadcast_recipients.inc(len(members))
+    broadcast_seconds.observe(time.perf_counter() - started)
+
+
+multicast = None  # multicast.Sender, when multicast delivery is on
+interned = wire.Interner()  # user and room ids for the binary wire format
+
+
+def multicast_fanout(room, frame, members):
+    """Multicast a frame if any members listen to the room's group.
+
+    Returns the members that still need a unicast copy.
+    """
+    if len(frame) > mcast.MAX_FRAME:
+        return members
+    with multicast.lock:
+        unicast = [m for m in members if m[0].multicast != room]
+        if len(unicast) == len(members):
+            return members
+        multicast.send(room, frame)
+    multicast_saved.inc(len(members) - len(unicast))
+    return unicast
+
+
+def offer_multicast(conn, room):
+    """Invite a client that asked for multicast into a room's group"""
+    conn.multicast = None
+    if multicast is not None and conn.wants_multicast:
+        send_json(conn, multicast.offer(room, conn.bus_id))
+
+
+def handle_multicast(conn, msg, room):
+    """Move a client through the multicast handshake, or repair its gaps"""
+    if multicast is None or not conn.wants_multicast or msg.get("room") != room:
+        return
+    if msg["type"] == "nack":
+        first, last = int(msg["first"]), int(msg["last"])
+        lines = multicast.repair(room, first, min(last, first + mcast.REPAIR_WINDOW))
+        if lines:
+            conn.send(b"".join(lines))
+    elif msg.get("confirm"):
+        with multicast.lock:
+            conn.multicast = room
+            seq = multicast.next_seq(room)
+        send_json(conn, {"type": "multicast", "room": room, "seq": seq})
+    else:
+        multicast.probe(room, conn.bus_id)
+
+
+def send_private(sender_conn, target_user, message):
+    """Send private message to a specific user"""
+    payload = {
+        "type": "private",
+        "from": clients.get(sender_conn)["username"],
+        "msg": message,
+        "time": timestamp(),
+    }
+
+    client = clients.find(target_user)
+    if client is None:
+        remote = remote_clients.find(target_user)
+        if remote is None:
+            return False
+        publish("pm", to=target_user, id=remote, payload=payload)
+        return True
+
+    try:
+        return client.send(encode(payload))
+    except:
+        return False
+
+
+def send_json(conn, payload):
+    """Queue a single JSON line for a client"""
+    conn.send(encode(payload))
+
+
+def system_message(text):
+    """Build a system notice payload"""
+    return {"type": "system", "msg": text, "time": timestamp()}
+
+
+def register_client(conn, hello):
+    """Add a client from its hello payload and announce it to the room.
+
+    A hello with the resume token of a held seat takes the seat back without
+    a word to the room. One with "seq" gets the room's messages after that
+    seq replayed instead of the usual backlog.
+    """
+    username = hello["username"]
+    room = hello["room"]
+
+    if BINARY_WIRE and hello.get("wire") == "binary":
+        conn.enable_binary()
+    if COMPRESSION and hello.get("compress") == "zlib":
+        conn.enable_compression()
+    conn.wants_multicast = bool(hello.get("multicast"))
+
+    seat = resume_session(hello.get("resume"), username)
+    if seat:
+        room = seat["room"]
+        conn.bus_id = seat["bus_id"]
+    else:
+        conn.bus_id = f"{SERVER_NAME}/{worker_id}:{next(bus_ids)}"
+    if hello.get("session"):
+        # First, so the client knows the epoch of the seqs that follow
+        conn.session = f"{worker_id}.{secrets.token_urlsafe(16)}"
+        send_json(conn, {"type": "session", "token": conn.session, "epoch": EPOCH})
+    after = hello.get("seq")
+    replay = isinstance(after, int) and hello["room"] == room
+    if not replay:
+        send_backlog(conn, room)
+    offer_multicast(conn, room)
+    clients.add(conn, username, room, conn.addr)
+    bus_conns[conn.bus_id] = conn
+    if replay:
+        # After joining, so nothing sent in between is missed; the client
+        # drops what it gets twice by seq
+        send_replay(conn, room, after)
+    if not seat:
+        roster.join(room, username)
+        publish("join", id=conn.bus_id, username=username, room=room)
+    send_json(conn, roster.snapshot(room))
+
+    if seat is not None:
+        log_global(f"{username} ({conn.addr[0]}) resumed in {room}")
+        return
+    log(room, f"[{timestamp()}] {username} joined {room}")
+    log_global(f"{username} ({conn.addr[0]}) joined {room}")
+    broadcast(room, system_message(f"{username} joined the room"))
+
+
+def unregister_client(conn):
+    """Remove a client and announce its departure, or hold its seat if it
+    asked for a session and did not say goodbye"""
+    info = clients.remove(conn)
+    if info is None:
+        return
+    bus_conns.pop(conn.bus_id, None)
+    if conn.session is not None and not conn.leaving and RESUME_GRACE:
+        sessions[conn.session] = {
+            "username": info["username"],
+            "room": info["room"],
+            "bus_id": conn.bus_id,
+            "expires": time.monotonic() + RESUME_GRACE,
+        }
+        log_global(f"{info['username']} dropped, seat held for {RESUME_GRACE:g}s")
+        return
+    depart(conn.bus_id, info["username"], info["room"])
+
+
+def depart(bus_id, username, room):
+    """Announce that a client is gone for good"""
+    publish("leave", id=bus_id)
+    roster.leave(room, username)
+    broadcast(room, system_message(f"{username} left the room"))
+    log(room, f"[{timestamp()}] {username} left {room}")
+    log_global(f"{username} disconnected")
+
+
+sessions = {}  # resume token -> seat of a client whose connection dropped
+
+
+def resume_session(token, username):
+    """Take back the seat held under a resume token.
+
+    Returns the seat; {} if the token is another worker's, which is told to
+    give its seat up quietly; or None if there is nothing to resume.
+    """
+    if not isinstance(token, str):
+        return None
+    seat = sessions.get(token)
+    if seat is not None and seat["username"] == username:
+        del sessions[token]
+        sessions_resumed.inc()
+        return seat
+    if bus is not None and token.split(".", 1)[0] != str(worker_id):
+        publish("resume", token=token)
+        return {}
+    return None
+
+
+def expire_sessions(now):
+    for token, seat in list(sessions.items()):
+        if now > seat["expires"] and sessions.pop(token, None) is not None:
+            sessions_expired.inc()
+            depart(seat["bus_id"], seat["username"], seat["room"])
+
+
+def send_replay(conn, room, after):
+    """Send a returning client the messages of a room after seq `after`"""
+    if bus is not None:
+        # The supervisor owns the store
+        publish("request", id=conn.bus_id, cmd="/replay", room=room, args=[after])
+        return
+    stop = store.next_seq(room)
+    count = stop - after - 1
+    if count <= 0:
+        return
+    skipped = max(0, count - RESUME_MAX_REPLAY)
+    start, payloads = store.read(room, stop, count - skipped)
+    frames = []
+    if skipped:
+        frames.append(
+            encode(system_message(f"{skipped} earlier missed messages: /history {start}"))
+        )
+    frames.extend(payloads)
+    conn.send(b"".join(frames))
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+strikes = {}  # ip -> deque of times it was throttled
+strikes_lock = threading.Lock()
+
+
+def check_rate(conn, kind, room, retry=False):
+    """Charge one event to the sender's, its address's and the room's buckets.
+
+    Returns None if the event may go ahead; otherwise the seconds to wait
+    before retrying it, or 0 if it was dropped. A retry of an event that was
+    already held back is not counted or struck against the sender again.
+    """
+    ip = conn.addr[0]
+    if ip in banned_ips:
+        # Lines already read from a connection that is being dropped
+        return 0
+    if ip in ADMIN_IPS and not RATE_LIMIT_ADMINS:
+        return None
+    scope, wait = rate_limiter.acquire(kind, {"conn": conn.bus_id, "ip": ip, "room": room})
+    if scope is None:
+        return None
+    if retry:
+        return wait
+
+    throttled.inc_label(f"{scope}.{kind}")
+    if BAN_AFTER and add_strike(ip):
+        ban_ip(ip, f"flooding ({scope} {kind} limit)")
+        return 0
+    if RATE_LIMIT_ACTION == "delay":
+        return wait
+
+    now = time.monotonic()
+    if now - conn.notified_at >= THROTTLE_NOTICE_INTERVAL:
+        conn.notified_at = now
+        send_json(conn, system_message(f"You are sending too fast; {kind} dropped"))
+    return 0
+
+
+def add_strike(ip):
+    """Count a throttled event; True once the address has earned a ban"""
+    now = time.monotonic()
+    with strikes_lock:
+        times = strikes.setdefault(ip, collections.deque())
+        times.append(now)
+        while times and now - times[0] > BAN_WINDOW:
+            times.popleft()
+        if len(times) < BAN_AFTER:
+            return False
+        del strikes[ip]
+        return True
+
+
+def ban_ip(ip, reason):
+    """Ban an address and drop its connections"""
+    banned_ips.add(ip)
+    bans.inc()
+    print(f"Banned {ip}: {reason}")
+    log_global(f"Banned {ip}: {reason}")
+    for conn, _ in clients.items():
+        if conn.addr[0] == ip:
+            conn.leaving = True
+            conn.abort()
+
+
+def decode_line(line):
+    """The message in one JSON line from a client, or None for a blank or
+    undecodable line; a message the binary wire format decoded is returned
+    as it is"""
+    if isinstance(line, dict):
+        return line
+    if not line.strip():
+        return None
+    started = time.perf_counter()
+    try:
+        msg = json.loads(line)
+    except ValueError:
+        decode_errors.inc()
+        return None
+    decode_seconds.observe(time.perf_counter() - started)
+    return msg
+
+
+def handle_line(conn, msg, retry=False):
+    """Process one message from a registered client, as decode_line()
+    returned it.
+
+    Returns the seconds to wait before handing the same message in again,
+    with retry=True, when a rate limit holds it back, otherwise None (or 0).
+    """
+    info = clients.get(conn)
+    username = info["username"]
+    room = info["room"]
+
+    if msg["type"] == "bye":
+        conn.leaving = True
+        return
+    if msg["type"] == "msg":
+        kind = "msg"
+    elif msg["type"] == "command":
+        kind = "pm" if msg["cmd"].startswith("/pm ") else "command"
+    elif msg["type"] in ("upload", "download", "multicast", "nack", "ping"):
+        kind = "command"
+    else:
+        # Includes "pong" and the client's "wire" switch, which the decoder
+        # has acted on; reading them was all that mattered
+        return
+    limited = check_rate(conn, kind, room, retry)
+    if limited is not None:
+        return limited
+
+    if msg["type"] == "msg":
+        final = {
+            "type": "msg",
+            "room": room,
+            "from": username,
+            "msg": msg["msg"],
+            "time": timestamp(),
+        }
+        meter = room_rates.get(room)
+        if meter is None:
+            meter = room_rates.setdefault(room, RateMeter())
+        meter.mark()
+
+        if bus is not None:
+            # The supervisor numbers it and hands it back to every worker
+            publish("msg", room=room, payload=final)
+        else:
+            frame = record_message(room, final)
+            history.append(room, frame)
+            broadcast_local(room, final, frame)
+            publish("msg", room=room, payload=final)
+
+    elif msg["type"] == "command":
+        started = time.perf_counter()
+        handle_command(conn, msg["cmd"])
+        command_seconds.observe(time.perf_counter() - started)
+
+    elif msg["type"] in ("multicast", "nack"):
+        handle_multicast(conn, msg, room)
+
+    elif msg["type"] == "ping":
+        send_json(conn, {"type": "pong"})
+
+    else:
+        handle_file_request(conn, msg, username, room)
+
+
+def record_message(room, message):
+    """Number a chat message and persist it to the store, the room log and
+    the index; returns the encoded frame, which carries the seq"""
+    frames = []
+
+    def numbered(seq):
+        message["seq"] = seq
+        frames.append(encode(message))
+        return frames[0]
+
+    store.append(room, numbered)
+    log(room, f"[{message['time']}] {message['from']}: {message['msg']}")
+    search_index.add(
+        room, f"{datetime.date.today()} {message['time']}", message["from"], message["msg"]
+    )
+    return frames[0]
+
+
+file_store = FileStore(FILES_DIR, FILE_SECRET, FILE_QUOTA, FILE_TTL)
+file_server = None  # FileServer, once the file port is open
+
+
+def handle_file_request(conn, msg, username, room):
+    """Answer an upload or download request with a ticket for the file port"""
+    if file_server is None:
+        send_json(conn, system_message("File transfer is not enabled on this server"))
+        return
+
+    if msg["type"] == "upload":
+        name = os.path.basename(str(msg.get("name", "")).replace("\\", "/"))[:255] or "file"
+        size = msg.get("size")
+        if not isinstance(size, int) or size < 0:
+            return
+        if size > MAX_FILE_SIZE:
+            send_json(
+                conn,
+                system_message(f"{name} is over the {MAX_FILE_SIZE // 1048576} MB file limit"),
+            )
+            return
+        if not file_store.has_room(size):
+            send_json(conn, system_message(f"No room left to share {name}, try again later"))
+            return
+        file_id = file_store.new_id()
+        ticket = file_store.issue(
+            {"op": "put", "id": file_id, "name": name, "size": size, "room": room, "from": username}
+        )
+        reply = {"type": "upload", "ref": msg.get("ref"), "id": file_id}
+    else:
+        meta = file_store.info(str(msg.get("id", "")))
+        if meta is None or meta["room"] != room:
+            send_json(conn, system_message("That file is not shared in this room"))
+            return
+        ticket = file_store.issue({"op": "get", "id": meta["id"]})
+        reply = {"type": "download", "id": meta["id"], "name": meta["name"], "size": meta["size"]}
+
+    reply.update(ticket=ticket, port=FILE_PORT)
+    send_json(conn, reply)
+
+
+def announce_file(meta):
+    """Tell a room, on every worker, that a file finished uploading"""
+    room = meta["room"]
+    payload = {
+        "type": "file",
+        "from": meta["from"],
+        "id": meta["id"],
+        "name": meta["name"],
+        "size": meta["size"],
+        "time": timestamp(),
+    }
+    dispatch_bus_event({"op": "file", "room": room, "payload": payload})
+    publish("file", room=room, payload=payload)
+    log(room, f"[{payload['time']}] {meta['from']} shared {meta['name']} ({meta['size']} bytes)")
+
+
+def handle_command(conn, cmd):
+    """Run a slash command on behalf of a client"""
+    parts = cmd.split()
+    if not parts:
+        return
+    commands_total.inc_label(parts[0] if parts[0] in COMMANDS else "other")
+
+    info = clients.get(conn)
+    username = info["username"]
+    room = info["room"]
+
+    if parts[0] == "/users":
+        # List all users in current room
+        names = roster.users(room)
+        send_json(conn, system_message(f"Users in {room}: {', '.join(names)}"))
+
+    elif parts[0] == "/allrooms":
+        # List all active rooms
+        rooms_list = roster.room_names()
+        send_json(conn, system_message(f"Active rooms: {', '.join(rooms_list)}"))
+
+    elif parts[0] == "/pm" and len(parts) >= 3:
+        target = parts[1]
+        text = " ".join(parts[2:])
+        if send_private(conn, target, text):
+            send_json(conn, system_message(f"PM sent to {target}"))
+        else:
+            send_json(conn, system_message(f"User {target} not found"))
+
+    elif parts[0] == "/join" and len(parts) >= 2:
+        new_room = parts[1]
+
+        # Notify old room
+        broadcast(room, system_message(f"{username} left the room"))
+
+        # Update room
+        send_backlog(conn, new_room)
+        offer_multicast(conn, new_room)
+        old_room = clients.move(conn, new_room)
+        publish("move", id=conn.bus_id, room=new_room)
+        roster.leave(old_room, username)
+        roster.join(new_room, username)
+        send_json(conn, roster.snapshot(new_room))
+
+        # Notify new room
+        broadcast(new_room, system_message(f"{username} joined the room"))
+        send_json(conn, system_message(f"Joined room: {new_room}"))
+
+        log(old_room, f"[{timestamp()}] {username} left for {new_room}")
+        log(new_room, f"[{timestamp()}] {username} joined from {old_room}")
+
+    elif parts[0] in ("/history", "/search") and bus is not None:
+        # The supervisor owns the store and the index
+        publish("request", id=conn.bus_id, cmd=parts[0], room=room, args=parts[1:])
+
+    elif parts[0] == "/history":
+        send_history(conn, room, parts[1:])
+
+    elif parts[0] == "/search":
+        send_search(conn, parts[1:])
+
+    elif parts[0] == "/stats":
+        if conn.addr[0] in ADMIN_IPS:
+            send_json(conn, system_message(stats_report()))
+        else:
+            send_json(conn, system_message("/stats is only available to admins"))
+
+    elif parts[0] == "/help":
+        help_text = (
+            "Commands: /users, /allrooms, /pm <user> <msg>, /join <room>, "
+            "/history [before] [count], /search <terms> [room], /stats, /help"
+        )
+        send_json(conn, system_message(help_text))
+
+
+def reap_connections():
+    """Ping quiet clients, drop the ones that stopped reading or answering,
+    and give up the seats of clients that did not come back"""
+    if handover.active:
+        # The clients are about to change hands; leave them be
+        return
+    now = time.monotonic()
+    expire_sessions(now)
+    ping = encode({"type": "ping", "interval": PING_INTERVAL})
+    for conn, info in clients.items():
+        idle = now - conn.last_recv
+        # With pings on, only a client that left one unanswered counts as idle
+        if IDLE_TIMEOUT and idle > IDLE_TIMEOUT and (
+            not PING_INTERVAL or conn.pinged_at > conn.last_recv
+        ):
+            reason = "idle"
+        elif (
+            WRITE_TIMEOUT
+            and conn.write_started is not None
+            and now - conn.write_started > WRITE_TIMEOUT
+        ):
+            reason = "write"
+        else:
+            if PING_INTERVAL and idle > PING_INTERVAL and now - conn.pinged_at > PING_INTERVAL:
+                conn.pinged_at = now
+                conn.send(ping)
+                pings_sent.inc()
+            continue
+        reaped.inc_label(reason)
+        print(f"Reaping {info['username']} ({conn.addr[0]}): {reason} timeout")
+        conn.abort()
+
+
+def reap_forever():
+    interval = min(REAP_INTERVAL, PING_INTERVAL / 2 or REAP_INTERVAL)
+    while True:
+        time.sleep(interval)
+        if bus_loop is not None:
+            bus_loop.call_soon_threadsafe(reap_connections)
+        else:
+            reap_connections()
+
+
+class Handover:
+    """Brings this server to a standstill so a new one can take it over.
+
+    Reading threads wait for their socket through wait(), which also watches
+    a pipe; freeze() writes to the pipe and returns once every thread is
+    parked between two reads, with whatever it read of an unfinished line
+    still in its decoder. In asyncio mode only `active` is used; the event
+    loop pauses its transports instead.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.readers = 0
+        self.parked = {}  # connection or listening socket -> decoder
+        self.listen_fd = None  # asyncio mode: the listener, kept while stopped
+        self._cond = threading.Condition()
+        self._wake_r, self._wake_w = os.pipe()
+
+    def watch(self, sock):
+        """A poller for one reading thread's socket, counting the thread in"""
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self._wake_r, select.POLLIN)
+        with self._cond:
+            self.readers += 1
+        return poller
+
+    def unwatch(self):
+        with self._cond:
+            self.readers -= 1
+            self._cond.notify_all()
+
+    def wait(self, poller, key, decoder=None, timeout=None):
+        """Block until the socket is readable, parking while a handover is on.
+
+        Raises socket.timeout if it is not readable within timeout seconds.
+        """
+        while True:
+            ms = None if timeout is None else max(1, int(timeout * 1000))
+            if not poller.poll(ms):
+                raise socket.timeout("timed out")
+            if not self.active:
+                return
+            with self._cond:
+                self.parked[key] = decoder
+                self._cond.notify_all()
+                while self.active:
+                    self._cond.wait()
+                del self.parked[key]
+
+    def freeze(self, deadline):
+        """Park every reading thread; returns what they parked with"""
+        self.active = True
+        os.write(self._wake_w, b"\0")
+        with self._cond:
+            settled = self._cond.wait_for(
+                lambda: len(self.parked) >= self.readers,
+                max(0.0, deadline - time.monotonic()),
+            )
+            if not settled:
+                raise TimeoutError("clients did not settle in time")
+            return dict(self.parked)
+
+    def thaw(self):
+        with self._cond:
+            if self.active and bus_loop is None:
+                os.read(self._wake_r, 1)
+            self.active = False
+            self._cond.notify_all()
+
+
+handover = Handover()
+
+
+def read_client(sock, decoder, poller, conn, timeout=None):
+    """One blocking read, as decoder.read_from(), through the handover gate
+    if the thread has a poller"""
+    if poller is not None:
+        handover.wait(poller, conn, decoder, timeout)
+    return decoder.read_from(sock)
+
+
+class Admission:
+    """Open connections per process and per address.
+
+    Checked when a connection is accepted, so a reconnect storm or a runaway
+    script is turned away before it gets a thread or any other state.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.per_ip = collections.Counter()
+        self._lock = threading.Lock()
+
+    def admit(self, ip):
+        """Take a slot for a new connection from ip.
+
+        Returns None, or (reason, message) if the connection is refused.
+        """
+        if ip in banned_ips:
+            return "banned", "Your IP is banned."
+        with self._lock:
+            if MAX_CONNECTIONS and self.total >= MAX_CONNECTIONS:
+                return "full", "Server is full, try again later."
+            if (
+                MAX_CONNECTIONS_PER_IP
+                and ip not in ADMIN_IPS
+                and self.per_ip[ip] >= MAX_CONNECTIONS_PER_IP
+            ):
+                return "per_ip", f"Too many connections from {ip}."
+            self.total += 1
+            self.per_ip[ip] += 1
+        return None
+
+    def adopt(self, ip):
+        """Count a connection the previous server admitted"""
+        with self._lock:
+            self.total += 1
+            self.per_ip[ip] += 1
+
+    def release(self, ip):
+        with self._lock:
+            self.total -= 1
+            self.per_ip[ip] -= 1
+            if not self.per_ip[ip]:
+                del self.per_ip[ip]
+
+
+admission = Admission()
+
+
+def reject_connection(sock, reason, text):
+    """Tell a refused client why, without ever blocking on it, and hang up"""
+    connections_rejected.inc_label(reason)
+    try:
+        sock.setblocking(False)
+        sock.send(encode(system_message(text)))
+    except OSError:
+        pass
+    sock.close()
 
-clients = {}
-banned_ips = set()
 
-os.makedirs("chat_logs", exist_ok=True)
+def hello_time_left(deadline):
+    """Seconds a new connection has left to send its hello, None if unlimited"""
+    if not HELLO_TIMEOUT:
+        return None
+    return max(0.001, deadline - time.monotonic())
 
 
-def timestamp():
-    return datetime.datetime.now().strftime("%H:%M:%S")
+def handle_client(sock, addr, poller=None, conn=None, decoder=None):
+    """Serve one client on its own thread.
 
+    poller comes from handover.watch() when upgrades are on. A client taken
+    over from the previous server comes with its connection and decoder.
+    """
+    username = None
+    if conn is None:
+        connections_accepted.inc()
+        if TCP_NODELAY:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, addr)
+        decoder = wire.FrameDecoder()
+    conn.start()
 
-def log(room, message):
-    """Log messages to room-specific files"""
-    filename = f"chat_logs/{room}.txt"
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(message + "\n")
+    try:
+        frames = []
+        info = clients.get(conn)
+        if info is not None:
+            username = info["username"]
+        else:
+            # Receive initial connection data
+            deadline = time.monotonic() + HELLO_TIMEOUT
+            while frames == []:
+                timeout = hello_time_left(deadline)
+                if poller is None:
+                    sock.settimeout(timeout)
+                frames = read_client(sock, decoder, poller, conn, timeout)
+            if frames is None:
+                return
+            sock.settimeout(None)
 
+            hello = json.loads(frames.pop(0))
+            username = hello["username"]
+            register_client(conn, hello)
+            if conn.binary is not None:
+                decoder.expect_binary()
 
-def log_global(message):
-    """Log global server events"""
-    filename = "chat_logs/global.txt"
-    with open(filename, "a", encoding="utf-8") as f:
-        f.write(f"[{timestamp()}] {message}\n")
+        # Main message loop
+        while frames is not None:
+            conn.last_recv = time.monotonic()
+            for line in frames:
+                msg = decode_line(line)
+                if msg is None:
+                    continue
+                wait = handle_line(conn, msg)
+                while wait:
+                    time.sleep(wait)
+                    wait = handle_line(conn, msg, retry=True)
+            frames = read_client(sock, decoder, poller, conn)
 
+    except socket.timeout:
+        # Only the hello is read with a timeout
+        connections_rejected.inc_label("hello_timeout")
+        try:
+            sock.send(encode(system_message("No hello received in time.")))
+        except OSError:
+            pass
 
-def broadcast(room, message):
-    """Send message to all clients in a specific room"""
-    for client, info in list(clients.items()):
-        if info["room"] == room:
-            try:
-                client.sendall((json.dumps(message) + "\n").encode())
-            except Exception as e:
-                print(f"Error broadcasting to {info['username']}: {e}")
+    except Exception as e:
+        print(f"Error handling client {username or addr}: {e}")
 
+    finally:
+        # Clean up on disconnect
+        unregister_client(conn)
+        conn.close()
+        admission.release(addr[0])
+        if poller is not None:
+            handover.unwatch()
 
-def send_private(sender_sock, target_user, message):
-    """Send private message to a specific user"""
-    for client, info in list(clients.items()):
-        if info["username"] == target_user:
-            payload = {
-                "type": "private",
-                "from": clients[sender_sock]["username"],
-                "msg": message,
-                "time": timestamp(),
-            }
-            try:
-                client.sendall((json.dumps(payload) + "\n").encode())
-                return True
-            except:
+        try:
+            sock.close()
+        except:
+            pass
+
+
+class FlushScheduler:
+    """Writes the frames pending on every asyncio connection once per tick.
+
+    A connection registers when it gets its first pending frame; a single
+    timer then hands each registered connection's frames to its transport
+    in one call.
+    """
+
+    def __init__(self, loop, delay=WRITE_COALESCE_DELAY):
+        self.loop = loop
+        self.delay = delay
+        self.dirty = []
+        self._handle = None
+
+    def schedule(self, conn):
+        self.dirty.append(conn)
+        if self._handle is None:
+            if self.delay:
+                self._handle = self.loop.call_later(self.delay, self.flush)
+            else:
+                self._handle = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self._handle = None
+        dirty, self.dirty = self.dirty, []
+        for conn in dirty:
+            conn.flush()
+
+
+flush_scheduler = None  # FlushScheduler of the running event loop
+
+
+class AsyncConnection(Connection):
+    """Connection whose queue is drained by a task on the event loop.
+
+    While the transport's buffer is below the high-water mark, frames are
+    collected as pending and written by the flush scheduler; past that they
+    wait in the bounded queue and the slow-consumer policy applies. send()
+    must be called from the loop thread.
+    """
+
+    def __init__(self, writer, addr, **kwargs):
+        super().__init__(writer.get_extra_info("socket"), addr, **kwargs)
+        self.writer = writer
+        self.pending = []
+        self.pending_bytes = 0
+        self.reader = None  # StreamReader, set by the handler
+        self.reading = False  # waiting on the socket, with nothing half handled
+        self._ready = asyncio.Event()
+        self._high_water = writer.transport.get_write_buffer_limits()[1]
+
+    @property
+    def depth(self):
+        return len(self.queue) + len(self.pending)
+
+    def send_raw(self, data):
+        transport = self.writer.transport
+        if (
+            not self.queue
+            and not self.closed
+            and not transport.is_closing()
+            and transport.get_write_buffer_size() + self.pending_bytes < self._high_water
+        ):
+            if not self.pending:
+                flush_scheduler.schedule(self)
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            return True
+        return super().send_raw(data)
+
+    def flush(self):
+        """Hand every pending frame to the transport in one call"""
+        if not self.pending:
+            return
+        frames = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        if not self.writer.transport.is_closing():
+            self.writer.transport.writelines(self._prepare(frames))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                frames = self._take()
+                if frames:
+                    # Pending frames were sent before anything was queued
+                    self.flush()
+                    self.writer.writelines(self._prepare(frames))
+                    self.write_started = time.monotonic()
+                    await self.writer.drain()
+                    self.write_started = None
+                if self.closed and not self.queue:
+                    break
+        except OSError:
+            self.abort()
+
+    def _write_now(self, data):
+        self.writer.transport.write(data)
+
+    def abort(self):
+        self.writer.transport.abort()
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+    def idle(self):
+        """Whether the handler waits for the socket with nothing read that
+        it has not handled, and no end of stream or error coming"""
+        reader = self.reader
+        # Bytes read but not yet returned sit in the StreamReader's buffer
+        return (
+            self.reading
+            and not reader._buffer
+            and not reader.at_eof()
+            and reader.exception() is None
+        )
+
+    def detach(self):
+        self.flush()
+        super().detach()
+
+    def reattach(self):
+        if not self.detached:
+            return
+        self.closed = self.detached = False
+        if self._task.done():
+            self.start()
+
+    async def wait_detached(self, deadline):
+        transport = self.writer.transport
+        ended = self.compressor is None
+        while True:
+            if self._task.done() and not transport.get_write_buffer_size():
+                if ended:
+                    return True
+                self._write_now(self.compressor.flush(zlib.Z_FULL_FLUSH))
+                ended = True
+            elif time.monotonic() > deadline:
                 return False
-    return False
+            else:
+                await asyncio.sleep(0.01)
 
 
-def handle_client(sock, addr):
+async def handle_client_async(reader, writer, conn=None, decoder=None):
+    """Serve one client from the event loop; conn and decoder as for
+    handle_client()"""
     username = None
-    room = None
+    if conn is None:
+        addr = writer.get_extra_info("peername")
+        refused = admission.admit(addr[0])
+        if refused is not None:
+            reason, text = refused
+            connections_rejected.inc_label(reason)
+            # Lands in an empty socket buffer, so close() sends it right away
+            writer.write(encode(system_message(text)))
+            writer.close()
+            return
+        print(f"New connection from {addr[0]}:{addr[1]}")
+        connections_accepted.inc()
+        conn = AsyncConnection(writer, addr)
+        decoder = wire.FrameDecoder()
+    addr = conn.addr
+    conn.reader = reader
+    conn.start()
+    live[conn] = decoder
 
     try:
-        # Receive initial connection data
-        data = sock.recv(1024).decode().strip()
-        hello = json.loads(data)
-        username = hello["username"]
-        room = hello["room"]
-
-        # Register client
-        clients[sock] = {"username": username, "room": room, "addr": addr}
-
-        log(room, f"[{timestamp()}] {username} joined {room}")
-        log_global(f"{username} ({addr[0]}) joined {room}")
-        broadcast(
-            room,
-            {
-                "type": "system",
-                "msg": f"{username} joined the room",
-                "time": timestamp(),
-            },
-        )
+        frames = []
+        info = clients.get(conn)
+        if info is not None:
+            username = info["username"]
+        else:
+            # Receive initial connection data
+            deadline = time.monotonic() + HELLO_TIMEOUT
+            while not frames:
+                conn.reading = True
+                data = await asyncio.wait_for(
+                    reader.read(READ_SIZE), hello_time_left(deadline)
+                )
+                conn.reading = False
+                if not data:
+                    return
+                frames = decoder.feed(data)
+
+            hello = json.loads(frames.pop(0))
+            username = hello["username"]
+            register_client(conn, hello)
+            if conn.binary is not None:
+                decoder.expect_binary()
 
         # Main message loop
         while True:
-            raw = sock.recv(1024).decode().strip()
-            if not raw:
-                break
-
-            for line in raw.split("\n"):
-                if not line.strip():
+            for line in frames:
+                msg = decode_line(line)
+                if msg is None:
                     continue
+                wait = handle_line(conn, msg)
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = handle_line(conn, msg, retry=True)
 
-                try:
-                    msg = json.loads(line)
-                except json.JSONDecodeError:
-                    continue
+            conn.reading = True
+            data = await reader.read(READ_SIZE)
+            conn.reading = False
+            if not data:
+                break
+            conn.last_recv = time.monotonic()
+            frames = decoder.feed(data)
+
+    except asyncio.CancelledError:
+        # Server shutting down
+        pass
 
-                if msg["type"] == "msg":
-                    final = {
-                        "type": "msg",
-                        "from": username,
-                        "msg": msg["msg"],
-                        "time": timestamp(),
-                    }
-                    broadcast(room, final)
-                    log(room, f"[{final['time']}] {username}: {msg['msg']}")
-
-                elif msg["type"] == "command":
-                    parts = msg["cmd"].split()
-
-                    if not parts:
-                        continue
-
-                    if parts[0] == "/users":
-                        # List all users in current room
-                        names = [
-                            info["username"]
-                            for client, info in clients.items()
-                            if info["room"] == room
-                        ]
-                        sock.sendall(
-                            (
-                                json.dumps(
-                                    {
-                                        "type": "system",
-                                        "msg": f"Users in {room}: {', '.join(names)}",
-                                        "time": timestamp(),
-                                    }
-                                )
-                                + "\n"
-                            ).encode()
-                        )
-
-                    elif parts[0] == "/allrooms":
-                        # List all active rooms
-                        rooms_list = list(
-                            set([info["room"] for info in clients.values()])
-                        )
-                        sock.sendall(
-                            (
-                                json.dumps(
-                                    {
-                                        "type": "system",
-                                        "msg": f"Active rooms: {', '.join(rooms_list)}",
-                                        "time": timestamp(),
-                                    }
-                                )
-                                + "\n"
-                            ).encode()
-                        )
-
-                    elif parts[0] == "/pm" and len(parts) >= 3:
-                        target = parts[1]
-                        text = " ".join(parts[2:])
-                        if send_private(sock, target, text):
-                            sock.sendall(
-                                (
-                                    json.dumps(
-                                        {
-                                            "type": "system",
-                                            "msg": f"PM sent to {target}",
-                                            "time": timestamp(),
-                                        }
-                                    )
-                                    + "\n"
-                                ).encode()
-                            )
-                        else:
-                            sock.sendall(
-                                (
-                                    json.dumps(
-                                        {
-                                            "type": "system",
-                                            "msg": f"User {target} not found",
-                                            "time": timestamp(),
-                                        }
-                                    )
-                                    + "\n"
-                                ).encode()
-                            )
-
-                    elif parts[0] == "/join" and len(parts) >= 2:
-                        old_room = room
-                        new_room = parts[1]
-
-                        # Notify old room
-                        broadcast(
-                            old_room,
-                            {
-                                "type": "system",
-                                "msg": f"{username} left the room",
-                                "time": timestamp(),
-                            },
-                        )
-
-                        # Update room
-                        clients[sock]["room"] = new_room
-                        room = new_room
-
-                        # Notify new room
-                        broadcast(
-                            new_room,
-                            {
-                                "type": "system",
-                                "msg": f"{username} joined the room",
-                                "time": timestamp(),
-                            },
-                        )
-                        sock.sendall(
-                            (
-                                json.dumps(
-                                    {
-                                        "type": "system",
-                                        "msg": f"Joined room: {new_room}",
-                                        "time": timestamp(),
-                                    }
-                                )
-                                + "\n"
-                            ).encode()
-                        )
-
-                        log(old_room, f"[{timestamp()}] {username} left for {new_room}")
-                        log(
-                            new_room,
-                            f"[{timestamp()}] {username} joined from {old_room}",
-                        )
-
-                    elif parts[0] == "/help":
-                        help_text = "Commands: /users, /allrooms, /pm <user> <msg>, /join <room>, /help"
-                        sock.sendall(
-                            (
-                                json.dumps(
-                                    {
-                                        "type": "system",
-                                        "msg": help_text,
-                                        "time": timestamp(),
-                                    }
-                                )
-                                + "\n"
-                            ).encode()
-                        )
+    except asyncio.TimeoutError:
+        # Only the hello is read with a timeout
+        connections_rejected.inc_label("hello_timeout")
+        writer.write(encode(system_message("No hello received in time.")))
 
     except Exception as e:
         print(f"Error handling client {username or addr}: {e}")
 
     finally:
         # Clean up on disconnect
-        if sock in clients:
-            username = clients[sock]["username"]
-            room = clients[sock]["room"]
-            del clients[sock]
-            broadcast(
-                room,
-                {
-                    "type": "system",
-                    "msg": f"{username} left the room",
-                    "time": timestamp(),
-                },
-            )
-            log(room, f"[{timestamp()}] {username} left {room}")
-            log_global(f"{username} disconnected")
+        live.pop(conn, None)
+        unregister_client(conn)
+        admission.release(addr[0])
 
         try:
-            sock.close()
-        except:
+            conn.close()
+        except Exception:
+            pass
+
+
+live = {}  # asyncio mode: every connection being served -> its decoder
+
+
+def raise_fd_limit():
+    """Raise the open file limit so the event loop can hold many sockets"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
             pass
 
 
-def start_server():
-    print(f"Starting LAN Chat Server on {HOST}:{PORT}")
-    log_global("Server started")
+async def serve_async(takeover=None):
+    global bus_loop, flush_scheduler, async_server
+    bus_loop = asyncio.get_running_loop()
+    flush_scheduler = FlushScheduler(bus_loop)
+    if takeover is None:
+        async_server = await asyncio.start_server(
+            handle_client_async,
+            HOST,
+            PORT,
+            backlog=LISTEN_BACKLOG,
+            reuse_address=True,
+            reuse_port=bus is not None,
+        )
+    else:
+        async_server = await asyncio.start_server(
+            handle_client_async, sock=takeover["listener"], backlog=LISTEN_BACKLOG
+        )
+        streams = [
+            (await asyncio.open_connection(sock=sock), entry)
+            for sock, entry in takeover["clients"]
+        ]
+        # Register everyone before any handler runs, so nobody misses the
+        # first messages relayed on the new side
+        adopted = []
+        for (reader, writer), entry in streams:
+            conn = AsyncConnection(writer, tuple(entry["addr"]))
+            adopted.append((reader, writer, conn, adopt_client(conn, entry)))
+        for args in adopted:
+            bus_loop.create_task(handle_client_async(*args))
+        settle_takeover(takeover)
+
+    print("Server is running (asyncio). Waiting for connections...")
+    print(
+        f"Clients should connect to: {socket.gethostbyname(socket.gethostname())}:{PORT}"
+    )
+    start_upgrades()
+
+    try:
+        while True:
+            try:
+                await async_server.serve_forever()
+            except asyncio.CancelledError:
+                if not handover.active:
+                    raise
+            # Stopped for a handover: it either ends this process or
+            # resume_async() starts listening again
+            while handover.active:
+                await asyncio.sleep(0.1)
+    finally:
+        async_server.close()
+
+
+async_server = None  # asyncio.Server accepting clients in asyncio mode
+
+
+# Handing over to a new server (handoff.py)
+
+
+def upgrades_on():
+    """Whether this process can be taken over; workers cannot"""
+    return UPGRADES and bus is None and handoff.supported()
+
+
+def upgrade_path():
+    return UPGRADE_PATH or os.path.join(LOG_DIR, f"upgrade-{PORT}.sock")
+
+
+def start_upgrades():
+    """Wait for takeovers once this process is serving"""
+    if not upgrades_on():
+        return
+    path = upgrade_path()
+    try:
+        listener = handoff.listen(path)
+    except OSError as e:
+        print(f"Takeovers disabled: {e}")
+        return
+    threading.Thread(target=serve_upgrades, args=(listener,), daemon=True).start()
+    print(f"A new server can take over through {path}")
+
+
+def serve_upgrades(listener):
+    while True:
+        channel, _ = listener.accept()
+        try:
+            if handoff.same_user(channel):
+                hand_over(channel)
+        except Exception as e:
+            # Whatever went wrong, the next takeover gets a fresh try
+            print(f"Handover failed, carrying on: {e!r}")
+        finally:
+            channel.close()
+
+
+def hand_over(channel):
+    """Give the listening socket and every client to the server on channel,
+    then exit.
+
+    Returns, still serving every client, if that server fails before it has
+    the sockets.
+    """
+    channel.settimeout(HANDOFF_TIMEOUT)
+    handoff.expect(channel, "takeover")
+    print("A new server is taking over...")
+    deadline = time.monotonic() + HANDOFF_TIMEOUT
+    if bus_loop is None:
+        quiesced = quiesce_threads(deadline)
+    else:
+        quiesced = asyncio.run_coroutine_threadsafe(
+            quiesce_async(deadline), bus_loop
+        ).result()
+
+    try:
+        state, fds = handover_state(*quiesced)
+        handoff.send_state(channel, state, fds)
+        handoff.expect(channel, "adopted")
+    except Exception:
+        if bus_loop is None:
+            resume_threads(quiesced[1])
+        else:
+            asyncio.run_coroutine_threadsafe(resume_async(), bus_loop).result()
+        raise
+
+    # The new server reads the logs and the store as soon as we let go
+    print(f"Handed {len(state['clients'])} connections over, exiting")
+    log_global(f"Handed {len(state['clients'])} connections over to a new server")
+    stop_services()
+    try:
+        handoff.send_event(channel, {"op": "released"})
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
+
+
+def quiesce_threads(deadline):
+    """Park every thread, then let every writer finish and stop.
+
+    Returns the listening socket's descriptor, (connection, decoder) pairs,
+    the connections that could not be stopped cleanly, and the presence
+    state.
+    """
+    try:
+        parked = handover.freeze(deadline)
+    except TimeoutError:
+        handover.thaw()
+        raise
+    listen_fd = next(key.fileno() for key in parked if isinstance(key, socket.socket))
+    entries = [(key, decoder) for key, decoder in parked.items() if isinstance(key, Connection)]
+    presence = roster.save()
+    for conn, _ in entries:
+        conn.detach()
+    stuck = {conn for conn, _ in entries if not conn.wait_detached(deadline)}
+    return listen_fd, entries, stuck, presence
+
+
+async def quiesce_async(deadline):
+    """quiesce_threads() for the event loop: stop accepting, pause every
+    transport and wait until no handler is halfway through a read"""
+    handover.active = True
+    handover.listen_fd = os.dup(async_server.sockets[0].fileno())
+    async_server.close()
+    for conn in live:
+        conn.writer.transport.pause_reading()
+    # Let handlers already woken by data have their turn before judging
+    await asyncio.sleep(0)
+    while not all(conn.idle() for conn in live):
+        if time.monotonic() > deadline:
+            await resume_async()
+            raise TimeoutError("clients did not settle in time")
+        await asyncio.sleep(0.01)
+    entries = list(live.items())
+    presence = roster.save()
+    for conn, _ in entries:
+        conn.detach()
+    stuck = set()
+    for conn, _ in entries:
+        if not await conn.wait_detached(deadline):
+            stuck.add(conn)
+    return handover.listen_fd, entries, stuck, presence
+
+
+def resume_threads(entries):
+    """Serve on after a handover that fell through, as if it never began"""
+    for conn, _ in entries:
+        conn.reattach()
+    handover.thaw()
+    roster.flush()
+
+
+async def resume_async():
+    global async_server
+    for conn in live:
+        conn.reattach()
+        conn.writer.transport.resume_reading()
+    async_server = await asyncio.start_server(
+        handle_client_async,
+        sock=socket.socket(fileno=handover.listen_fd),
+        backlog=LISTEN_BACKLOG,
+    )
+    handover.thaw()
+    roster.flush()
+
+
+def handover_state(listen_fd, entries, stuck, presence):
+    """The JSON state and the descriptors a new server carries on from.
+
+    A connection whose writer could not be stopped is left out: it is
+    dropped, and its seat held for it like any other dropped session.
+    """
+    now = time.monotonic()
+    fds = [listen_fd]
+    handed, gone = [], []
+    held = {token: dict(seat, expires=seat["expires"] - now) for token, seat in sessions.items()}
+    for conn, decoder in entries:
+        info = clients.get(conn)
+        if conn in stuck:
+            if info is None:
+                continue
+            if conn.session is not None and not conn.leaving and RESUME_GRACE:
+                held[conn.session] = {
+                    "username": info["username"],
+                    "room": info["room"],
+                    "bus_id": conn.bus_id,
+                    "expires": RESUME_GRACE,
+                }
+            else:
+                gone.append([conn.bus_id, info["username"], info["room"]])
+            continue
+        buffer, binary, await_switch = decoder.save()
+        entry = {
+            "fd": len(fds),
+            "addr": list(conn.addr[:2]),
+            "input": base64.b64encode(buffer).decode(),
+            "binary": binary,
+            "await_switch": await_switch,
+        }
+        if info is not None:
+            entry.update(
+                username=info["username"],
+                room=info["room"],
+                bus_id=conn.bus_id,
+                session=conn.session,
+                leaving=conn.leaving,
+                multicast=conn.wants_multicast,
+                compressed=conn.compressor is not None,
+                names=None if conn.binary is None else sorted(conn.binary.known),
+            )
+        fds.append(conn.sock.fileno())
+        handed.append(entry)
+
+    state = {
+        "pid": os.getpid(),
+        "epoch": EPOCH,
+        "next_bus_id": next(bus_ids),
+        "clients": handed,
+        "sessions": held,
+        "gone": gone,
+        "remote": [[info["room"], info["username"]] for _, info in remote_clients.items()],
+        "presence": presence,
+        "history": {
+            room: [frame.decode() for frame in history.recent(room, history.max_messages)]
+            for room in history.rooms()
+        },
+        "names": [sorted(table, key=lambda name: table[name][0]) for table in interned.ids],
+        "banned": sorted(banned_ips),
+    }
+    return state, fds
+
+
+def take_over():
+    """Take the listening socket, clients and state of the server running on
+    this port. Returns what start_server() needs to carry on, or None if no
+    server answers on the upgrade socket."""
+    path = upgrade_path()
+    if not handoff.supported():
+        print("Takeover needs Unix sockets with SCM_RIGHTS; starting afresh")
+        return None
+    try:
+        channel = handoff.connect(path, 2 * HANDOFF_TIMEOUT)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No server to take over from at {path}; starting afresh")
+        return None
+
+    with channel:
+        handoff.send_event(channel, {"op": "takeover"})
+        state, fds = handoff.receive_state(channel)
+        load_state(state)
+        takeover = {
+            "listener": socket.socket(fileno=fds[0]),
+            "clients": [
+                (socket.socket(fileno=fds[entry["fd"]]), entry) for entry in state["clients"]
+            ],
+            "gone": state["gone"],
+            "remote": state["remote"],
+        }
+        handoff.send_event(channel, {"op": "adopted"})
+        handoff.expect(channel, "released")
+
+    # Its other ports are free once it is gone
+    if not handoff.wait_exit(state["pid"], HANDOFF_TIMEOUT):
+        print(f"Process {state['pid']} is still running; its ports may be busy")
+    print(f"Took over {len(state['clients'])} connections from process {state['pid']}")
+    return takeover
+
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen(100)
+def load_state(state):
+    """Carry on from the previous server's sessions, presence, history and ids"""
+    global EPOCH, bus_ids
+    # Same store, so the seqs clients have seen stay valid
+    EPOCH = state["epoch"]
+    bus_ids = itertools.count(state["next_bus_id"])
+    now = time.monotonic()
+    for token, seat in state["sessions"].items():
+        sessions[token] = dict(seat, expires=now + seat["expires"])
+    roster.load(state["presence"])
+    for room, frames in state["history"].items():
+        for frame in frames:
+            history.append(room, frame.encode())
+    for namespace, names in enumerate(state["names"]):
+        for name in names:
+            interned.intern(namespace, name)
+    banned_ips.update(state["banned"])
+
+
+def adopt_client(conn, entry):
+    """Register a client handed over by the previous server, exactly as it
+    was there; returns its decoder"""
+    decoder = wire.FrameDecoder()
+    decoder.load(base64.b64decode(entry["input"]), entry["binary"], entry["await_switch"])
+    admission.adopt(conn.addr[0])
+    connections_adopted.inc()
+    if "username" not in entry:
+        # Still to say hello
+        return decoder
+
+    conn.bus_id = entry["bus_id"]
+    conn.session = entry["session"]
+    conn.leaving = entry["leaving"]
+    conn.wants_multicast = entry["multicast"]
+    if entry["names"] is not None:
+        conn.binary = wire.Names()
+        conn.binary.known.update(map(tuple, entry["names"]))
+        binary_connections.inc()
+    if entry["compressed"]:
+        # The old server ended its zlib stream with a full flush, after which
+        # a raw deflate stream with no history carries on seamlessly
+        conn.compressor = zlib.compressobj(
+            COMPRESS_LEVEL, zlib.DEFLATED, -COMPRESS_WBITS, COMPRESS_MEMLEVEL
+        )
+        compressed_connections.inc()
+    clients.add(conn, entry["username"], entry["room"], conn.addr)
+    bus_conns[conn.bus_id] = conn
+    # The old server's multicast groups went with it
+    offer_multicast(conn, entry["room"])
+    return decoder
+
+
+def settle_takeover(takeover):
+    """Publish what changed in the handover, once every client is adopted"""
+    for room, username in takeover["remote"]:
+        # Federation links start over; peers announce their clients again
+        roster.leave(room, username)
+    for bus_id, username, room in takeover["gone"]:
+        depart(bus_id, username, room)
+    roster.flush()
+    log_global(f"Took over {len(takeover['clients'])} connections")
+
+
+# Worker side of the bus
+
+
+def handle_bus_event(event):
+    """Apply an event relayed from another worker or the supervisor"""
+    op = event["op"]
+    if op == "msg":
+        frame = encode(event["payload"])
+        history.append(event["room"], frame)
+        broadcast_local(event["room"], event["payload"], frame)
+    elif op in ("room", "file", "presence"):
+        broadcast_local(event["room"], event["payload"])
+    elif op == "resume":
+        # The client came back through another worker
+        seat = sessions.pop(event["token"], None)
+        if seat is not None:
+            sessions_resumed.inc()
+            publish("leave", id=seat["bus_id"])
+            roster.leave(seat["room"], seat["username"])
+    elif op == "pm":
+        # By bus id: a local user of the same name is someone else
+        conn = bus_conns.get(event["id"])
+        if conn is not None:
+            conn.send(encode(event["payload"]))
+    elif op == "reply":
+        conn = bus_conns.get(event["id"])
+        if conn is not None:
+            conn.send(event["data"].encode())
+    elif op == "join":
+        old = remote_clients.remove(event["id"])
+        if old is not None:
+            roster.leave(old["room"], old["username"])
+        remote_clients.add(event["id"], event["username"], event["room"], None)
+        roster.join(event["room"], event["username"])
+    elif op == "move":
+        info = remote_clients.get(event["id"])
+        if info is not None:
+            old_room = remote_clients.move(event["id"], event["room"])
+            roster.leave(old_room, info["username"])
+            roster.join(event["room"], info["username"])
+    elif op == "leave":
+        info = remote_clients.remove(event["id"])
+        if info is not None:
+            roster.leave(info["room"], info["username"])
+
+
+def dispatch_bus_event(event):
+    """Run handle_bus_event where connections may be written from"""
+    if bus_loop is not None:
+        bus_loop.call_soon_threadsafe(handle_bus_event, event)
+    else:
+        handle_bus_event(event)
+
+
+def bus_closed():
+    """The supervisor is gone; stop this worker"""
+    print(f"Worker {worker_id} lost the bus, stopping")
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+def handle_peer_event(event):
+    """Apply an event that arrived from a federated server"""
+    if hub is not None:
+        handle_hub_event(hub, None, event, event)
+        return
+    if event["op"] == "msg":
+        # Still being forwarded to other peers, so number a copy
+        event = dict(event, payload=dict(event["payload"]))
+        record_message(event["room"], event["payload"])
+    handle_bus_event(event)
+
+
+def dispatch_peer_event(event):
+    if handover.active:
+        # Lost with the link once this process is gone; the store is not ours
+        return
+    if bus_loop is None:
+        handle_peer_event(event)
+        return
+    try:
+        bus_loop.call_soon_threadsafe(handle_peer_event, event)
+    except RuntimeError:
+        # Event loop closed, server shutting down
+        pass
+
+
+def presence_snapshot():
+    """Join events for every client this server knows of, for a new peer"""
+    if hub is not None:
+        known = presence.items()
+    else:
+        known = [(conn.bus_id, info) for conn, info in clients.items()]
+        known += remote_clients.items()
+    return [
+        {"op": "join", "id": bus_id, "username": info["username"], "room": info["room"]}
+        for bus_id, info in known
+    ]
+
+
+def start_federation():
+    """Listen for and dial peer servers if any are configured"""
+    global federation
+    if not FEDERATION_PORT and not PEERS:
+        return
+    federation = Federation(
+        SERVER_NAME,
+        dispatch_peer_event,
+        presence_snapshot,
+        FEDERATED_OPS,
+        FEDERATION_SECRET,
+    )
+    if FEDERATION_PORT:
+        federation.listen(HOST, FEDERATION_PORT)
+        print(f"Federation '{SERVER_NAME}' accepting peers on {HOST}:{FEDERATION_PORT}")
+    for peer in PEERS:
+        host, port = peer.rsplit(":", 1)
+        federation.connect(host, int(port))
+
+
+def run_worker(mode, index, path):
+    """Body of a forked worker process; never returns"""
+    global bus, worker_id
+    worker_id = index
+    try:
+        bus = BusClient(path, index, dispatch_bus_event, bus_closed)
+        bus.connect()
+        start_server(mode)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Worker {index} failed: {e}")
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
+
+
+# Supervisor side of the bus
+
+presence = ClientRegistry()  # every worker's clients by bus id; addr holds the worker
+
+
+class BusReply:
+    """Connection stand-in that routes a reply back to a worker's client"""
+
+    def __init__(self, hub, worker, bus_id):
+        self.hub = hub
+        self.worker = worker
+        self.bus_id = bus_id
+
+    def send(self, data):
+        self.hub.send(self.worker, {"op": "reply", "id": self.bus_id, "data": data.decode()})
+        return True
+
+
+def handle_hub_event(hub, worker, event, line):
+    """Route one event published by a worker, or by a peer if worker is None"""
+    op = event["op"]
+    if op == "msg":
+        # Numbered here, then sent to every worker including the sender's.
+        # A peer's event is still being forwarded, so number a copy
+        event = dict(event, payload=dict(event["payload"]))
+        record_message(event["room"], event["payload"])
+    if worker is not None and federation is not None and op in FEDERATED_OPS:
+        federation.send(dict(event))
+
+    if op == "msg":
+        hub.publish(event)
+    elif op in ("room", "file", "resume"):
+        # Files stay on this server, so "file" is not federated
+        hub.publish(line, exclude=worker)
+    elif op == "pm":
+        target = presence.get(event["id"])
+        owner = target["addr"] if target is not None else None
+        if owner is not None:
+            hub.send(owner, line)
+    elif op == "log":
+        log_writer.write(event["file"], event["text"])
+    elif op == "request":
+        reply = BusReply(hub, worker, event["id"])
+        if event["cmd"] == "/history":
+            send_history(reply, event["room"], event["args"])
+        elif event["cmd"] == "/replay":
+            send_replay(reply, event["room"], event["args"][0])
+        else:
+            send_search(reply, event["args"])
+    elif op in ("join", "move", "leave"):
+        if op == "join":
+            presence.remove(event["id"])
+            presence.add(event["id"], event["username"], event["room"], worker)
+        elif op == "move" and event["id"] in presence:
+            presence.move(event["id"], event["room"])
+        elif op == "leave":
+            presence.remove(event["id"])
+        hub.publish(line, exclude=worker)
+    elif op == "hello":
+        # Bring a (re)started worker up to date with everyone else's clients
+        for bus_id, info in presence.items():
+            hub.send(
+                worker,
+                {"op": "join", "id": bus_id, "username": info["username"], "room": info["room"]},
+            )
+
+
+def handle_worker_exit(hub, worker):
+    """Announce the departure of every client a dead worker had"""
+    print(f"Worker {worker} disconnected from the bus")
+    for bus_id, info in presence.items():
+        if info["addr"] != worker:
+            continue
+        presence.remove(bus_id)
+        notice = system_message(f"{info['username']} left the room")
+        for event in (
+            {"op": "leave", "id": bus_id},
+            {"op": "room", "room": info["room"], "payload": notice},
+        ):
+            hub.publish(event)
+            if federation is not None:
+                federation.send(event)
+
+
+async def serve_hub():
+    global bus_loop
+    bus_loop = asyncio.get_running_loop()
+    start_federation()
+    await hub.serve()
+
+
+def start_workers(mode, count):
+    """Fork `count` workers that share PORT and run the bus between them"""
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        print("Multiple workers need SO_REUSEPORT and fork(); using one process")
+        start_server(mode)
+        return
+
+    path = BUS_PATH or os.path.join(LOG_DIR, f"bus-{PORT}.sock")
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Fork before any thread exists in this process
+    sys.stdout.flush()
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(mode, index, path)
+        pids.append(pid)
+
+    global hub
+    print(f"Starting LAN Chat Server on {HOST}:{PORT} ({count} {mode} workers)")
+    log_global(f"Server started ({count} {mode} workers)")
+    search_index.load()
+    hub = BusHub(path, handle_hub_event, handle_worker_exit)
+
+    try:
+        asyncio.run(serve_hub())
+    except KeyboardInterrupt:
+        print("\nShutting down server...")
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        stop_services()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def start_services():
+    """Load persistent state and start optional background services"""
+    global file_server, multicast
+    if bus is None:
+        search_index.load()
+        start_federation()
+
+    if FILE_PORT:
+        file_server = FileServer(file_store, announce_file)
+        file_server.listen(HOST, FILE_PORT, reuse_port=bus is not None)
+        if bus is None:
+            print(f"File transfers on {HOST}:{FILE_PORT}")
+
+    if PING_INTERVAL or IDLE_TIMEOUT or WRITE_TIMEOUT or RESUME_GRACE:
+        threading.Thread(target=reap_forever, daemon=True).start()
+
+    if MULTICAST:
+        port = MULTICAST_PORT + worker_id
+        multicast = mcast.Sender(
+            f"{SERVER_NAME}/{worker_id}", port, MULTICAST_INTERFACE, MULTICAST_TTL
+        )
+        multicast.start()
+        if bus is None:
+            print(f"Multicast delivery on UDP port {port}")
+
+    if METRICS_PORT:
+        # Each worker serves its own metrics on the next port up
+        port = METRICS_PORT + worker_id
+        serve_http(metrics, METRICS_HOST, port)
+        print(f"Metrics at http://{METRICS_HOST}:{port}/metrics")
+
+    if STATS_DUMP_INTERVAL > 0:
+        threading.Thread(
+            target=dump_stats_forever, args=(STATS_DUMP_INTERVAL,), daemon=True
+        ).start()
+
+
+def stop_services():
+    """Flush logs, history and the search index"""
+    if bus is not None:
+        # Workers keep no state of their own; the supervisor flushes
+        return
+    log_global("Server stopped")
+    log_writer.close()
+    store.close()
+    search_index.close()
+
+
+def start_async_server(takeover=None):
+    if bus is None:
+        print(f"Starting LAN Chat Server on {HOST}:{PORT} (asyncio mode)")
+        log_global("Server started (asyncio)")
+    start_services()
+    raise_fd_limit()
+
+    try:
+        asyncio.run(serve_async(takeover))
+    except KeyboardInterrupt:
+        print("\nShutting down server...")
+        stop_services()
+
+
+def start_server(mode=SERVER_MODE, takeover=None):
+    """Serve clients; takeover is what take_over() got from the previous server"""
+    if mode == "asyncio":
+        start_async_server(takeover)
+        return
+
+    if bus is None:
+        print(f"Starting LAN Chat Server on {HOST}:{PORT}")
+        log_global("Server started")
+    start_services()
+
+    if takeover is None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bus is not None:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind((HOST, PORT))
+        server.listen(LISTEN_BACKLOG)
+    else:
+        server = takeover["listener"]
+        server.setblocking(True)
+        adopted = []
+        for sock, entry in takeover["clients"]:
+            sock.setblocking(True)
+            conn = Connection(sock, tuple(entry["addr"]))
+            adopted.append((sock, conn, adopt_client(conn, entry)))
+        # Only once everyone is registered, as in serve_async()
+        for sock, conn, decoder in adopted:
+            poller = handover.watch(sock) if upgrades_on() else None
+            threading.Thread(
+                target=handle_client, args=(sock, conn.addr, poller, conn, decoder), daemon=True
+            ).start()
+        settle_takeover(takeover)
 
     print("Server is running. Waiting for connections...")
     print(
         f"Clients should connect to: {socket.gethostbyname(socket.gethostname())}:{PORT}"
     )
+    # The accept loop parks for a handover like any reading thread
+    poller = handover.watch(server) if upgrades_on() else None
+    start_upgrades()
 
     try:
         while True:
+            if poller is not None:
+                try:
+                    # Wake up now and then: a Ctrl+C that lands on another
+                    # thread is only raised here once the poll returns
+                    handover.wait(poller, server, timeout=1.0)
+                except socket.timeout:
+                    continue
             client_sock, addr = server.accept()
-            print(f"New connection from {addr[0]}:{addr[1]}")
 
-            # Check if IP is banned
-            if addr[0] in banned_ips:
-                try:
-                    client_sock.sendall(
-                        (
-                            json.dumps(
-                                {
-                                    "type": "system",
-                                    "msg": "Your IP is banned.",
-                                    "time": timestamp(),
-                                }
-                            )
-                            + "\n"
-                        ).encode()
-                    )
-                    client_sock.close()
-                except:
-                    pass
+            refused = admission.admit(addr[0])
+            if refused is not None:
+                reject_connection(client_sock, *refused)
                 continue
+            print(f"New connection from {addr[0]}:{addr[1]}")
 
             # Start new thread for client
+            client_poller = handover.watch(client_sock) if poller is not None else None
             t = threading.Thread(
-                target=handle_client, args=(client_sock, addr), daemon=True
+                target=handle_client,
+                args=(client_sock, addr, client_poller),
+                daemon=True,
             )
-            t.start()
+            try:
+                t.start()
+            except RuntimeError:
+                # Out of threads despite the caps
+                admission.release(addr[0])
+                if client_poller is not None:
+                    handover.unwatch()
+                reject_connection(client_sock, "threads", "Server is full, try again later.")
 
     except KeyboardInterrupt:
         print("\nShutting down server...")
-        log_global("Server stopped")
+        stop_services()
     finally:
         server.close()
 
 
+def parse_rate_limit(text):
+    """Parse "scope.kind=rate[/burst]" for --rate-limit"""
+    try:
+        key, value = text.split("=", 1)
+        scope, kind = key.split(".", 1)
+        rate, _, burst = value.partition("/")
+        rate = float(rate)
+        burst = float(burst) if burst else max(1.0, rate * 4)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected scope.kind=rate[/burst], got {text!r}")
+    if rate < 0:
+        raise argparse.ArgumentTypeError(f"rate of {key!r} must not be negative")
+    if burst < 1:
+        # The bucket could never hold the one token an event takes
+        raise argparse.ArgumentTypeError(f"burst of {key!r} must be at least 1")
+    if scope not in ("conn", "ip", "room") or kind not in ("msg", "command", "pm"):
+        raise argparse.ArgumentTypeError(f"unknown limit {key!r}")
+    return (scope, kind), (rate, burst)
+
+
+def main():
+    global HOST, PORT, SLOW_CONSUMER_POLICY, OUTBOUND_QUEUE_SIZE, HISTORY_BACKLOG
+    global METRICS_PORT, STATS_DUMP_INTERVAL, WORKERS
+    global SERVER_NAME, FEDERATION_PORT, FEDERATION_SECRET, COMPRESSION, BINARY_WIRE
+    global RATE_LIMIT_ACTION, RATE_LIMIT_ADMINS, BAN_AFTER
+    global FILE_PORT, MAX_FILE_SIZE, FILE_QUOTA, FILE_TTL
+    global MULTICAST, MULTICAST_PORT, MULTICAST_INTERFACE
+    global PING_INTERVAL, IDLE_TIMEOUT, WRITE_TIMEOUT, RESUME_GRACE
+    global LISTEN_BACKLOG, MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP, HELLO_TIMEOUT
+    global UPGRADES, UPGRADE_PATH, HANDOFF_TIMEOUT
+
+    parser = argparse.ArgumentParser(description="LAN Chat Server")
+    parser.add_argument("--host", default=HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on")
+    parser.add_argument(
+        "--listen-backlog",
+        type=int,
+        default=LISTEN_BACKLOG,
+        help="pending connections the kernel queues (capped by net.core.somaxconn)",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=MAX_CONNECTIONS,
+        help="open client connections per process (0 = unlimited)",
+    )
+    parser.add_argument(
+        "--max-connections-per-ip",
+        type=int,
+        default=MAX_CONNECTIONS_PER_IP,
+        help="open connections per address, admin IPs exempt (0 = unlimited)",
+    )
+    parser.add_argument(
+        "--hello-timeout",
+        type=float,
+        default=HELLO_TIMEOUT,
+        help="seconds a new connection has to send its hello (0 = no limit)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("threaded", "asyncio"),
+        default=SERVER_MODE,
+        help="threaded: one thread per client; asyncio: single event loop",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="worker processes sharing the port (needs SO_REUSEPORT)",
+    )
+    parser.add_argument(
+        "--name",
+        default=SERVER_NAME,
+        help="server name among federated peers (default <hostname>:<port>)",
+    )
+    parser.add_argument(
+        "--federation-port",
+        type=int,
+        default=FEDERATION_PORT,
+        help="accept links from peer servers on this port",
+    )
+    parser.add_argument(
+        "--peer",
+        action="append",
+        default=[],
+        help="host:port of a peer server's federation port (repeatable)",
+    )
+    parser.add_argument(
+        "--federation-secret-file",
+        help="file holding a secret every peer must share; without it only --peer "
+        "hosts may link in",
+    )
+    parser.add_argument(
+        "--slow-consumer",
+        choices=("drop_oldest", "drop_connection", "coalesce"),
+        default=SLOW_CONSUMER_POLICY,
+        help="what to do when a client's outbound queue is full",
+    )
+    parser.add_argument(
+        "--outbound-queue",
+        type=int,
+        default=OUTBOUND_QUEUE_SIZE,
+        help="maximum frames queued per client",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="ignore client requests for compressed connections",
+    )
+    parser.add_argument(
+        "--no-binary",
+        action="store_true",
+        help="ignore client requests for the binary wire format",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=parse_rate_limit,
+        action="append",
+        default=[],
+        metavar="SCOPE.KIND=RATE[/BURST]",
+        help="set a token bucket, e.g. conn.msg=5/20 or room.msg=0 to disable "
+        "(scopes: conn, ip, room; kinds: msg, command, pm)",
+    )
+    parser.add_argument(
+        "--rate-limit-action",
+        choices=("delay", "drop"),
+        default=RATE_LIMIT_ACTION,
+        help="what happens to events over a limit",
+    )
+    parser.add_argument(
+        "--rate-limit-admins",
+        action="store_true",
+        help="apply rate limits to admin addresses too",
+    )
+    parser.add_argument(
+        "--ban-after",
+        type=int,
+        default=BAN_AFTER,
+        help=f"ban an address throttled this many times within {BAN_WINDOW:g}s (0 = never)",
+    )
+    parser.add_argument(
+        "--file-port",
+        type=int,
+        default=FILE_PORT,
+        help="port for file transfers (default: chat port + 1, 0 = off)",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=MAX_FILE_SIZE // 1048576,
+        help="largest file users may share, in MB",
+    )
+    parser.add_argument(
+        "--file-quota",
+        type=int,
+        default=FILE_QUOTA // 1048576,
+        help="space shared files may take in total, in MB (0 = no limit)",
+    )
+    parser.add_argument(
+        "--file-ttl",
+        type=float,
+        default=FILE_TTL / 3600,
+        help="hours a shared file is kept before it is deleted (0 = forever)",
+    )
+    parser.add_argument(
+        "--multicast",
+        action="store_true",
+        help="send room traffic once per room to a UDP multicast group "
+        "for clients that ask for it",
+    )
+    parser.add_argument(
+        "--multicast-port",
+        type=int,
+        default=MULTICAST_PORT,
+        help="UDP port for multicast delivery (default: chat port + 2)",
+    )
+    parser.add_argument(
+        "--multicast-interface",
+        default=MULTICAST_INTERFACE,
+        help="address of the interface to send multicast on",
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=PING_INTERVAL,
+        help="seconds of client silence before it is pinged (0 = never)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="seconds of client silence before it is dropped (0 = never)",
+    )
+    parser.add_argument(
+        "--write-timeout",
+        type=float,
+        default=WRITE_TIMEOUT,
+        help="seconds a blocked write to a client may last before it is dropped",
+    )
+    parser.add_argument(
+        "--resume-grace",
+        type=float,
+        default=RESUME_GRACE,
+        help="seconds a dropped client may take to resume its session (0 = off)",
+    )
+    parser.add_argument(
+        "--takeover",
+        action="store_true",
+        help="take the port and every client over from the server running on it",
+    )
+    parser.add_argument(
+        "--no-upgrades",
+        action="store_true",
+        help="do not let a new server take this one over",
+    )
+    parser.add_argument(
+        "--upgrade-socket",
+        default=UPGRADE_PATH,
+        help="Unix socket for takeovers (default chat_logs/upgrade-<port>.sock)",
+    )
+    parser.add_argument(
+        "--handoff-timeout",
+        type=float,
+        default=HANDOFF_TIMEOUT,
+        help="seconds to flush clients before handing them to a new server",
+    )
+    parser.add_argument(
+        "--log-flush-interval",
+        type=float,
+        default=LOG_FLUSH_INTERVAL,
+        help="seconds between chat log flushes",
+    )
+    parser.add_argument(
+        "--log-fsync",
+        choices=("never", "interval"),
+        default=LOG_FSYNC,
+        help="fsync chat logs on every flush",
+    )
+    parser.add_argument(
+        "--history-backlog",
+        type=int,
+        default=HISTORY_BACKLOG,
+        help="recent messages replayed to clients entering a room",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help=f"serve Prometheus metrics on {METRICS_HOST}:<port>",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=STATS_DUMP_INTERVAL,
+        help="seconds between stats dumps to chat_logs/stats.txt (0 = off)",
+    )
+    parser.add_argument(
+        "--admin-ip",
+        action="append",
+        default=[],
+        help="additional address allowed to run /stats (repeatable)",
+    )
+    args = parser.parse_args()
+    if args.takeover and args.workers > 1:
+        parser.error("--takeover works with a single process")
+
+    HOST = args.host
+    PORT = args.port
+    SLOW_CONSUMER_POLICY = args.slow_consumer
+    OUTBOUND_QUEUE_SIZE = args.outbound_queue
+    COMPRESSION = not args.no_compression
+    BINARY_WIRE = not args.no_binary
+    RATE_LIMITS.update(args.rate_limit)
+    RATE_LIMIT_ACTION = args.rate_limit_action
+    RATE_LIMIT_ADMINS = args.rate_limit_admins
+    BAN_AFTER = args.ban_after
+    FILE_PORT = PORT + 1 if args.file_port is None else args.file_port
+    MAX_FILE_SIZE = args.max_file_size * 1048576
+    FILE_QUOTA = file_store.quota = args.file_quota * 1048576
+    FILE_TTL = file_store.ttl = args.file_ttl * 3600
+    PING_INTERVAL = args.ping_interval
+    IDLE_TIMEOUT = args.idle_timeout
+    WRITE_TIMEOUT = args.write_timeout
+    RESUME_GRACE = args.resume_grace
+    UPGRADES = not args.no_upgrades
+    UPGRADE_PATH = args.upgrade_socket
+    HANDOFF_TIMEOUT = args.handoff_timeout
+    LISTEN_BACKLOG = args.listen_backlog
+    MAX_CONNECTIONS = args.max_connections
+    MAX_CONNECTIONS_PER_IP = args.max_connections_per_ip
+    HELLO_TIMEOUT = args.hello_timeout
+    MULTICAST = args.multicast
+    MULTICAST_PORT = PORT + 2 if args.multicast_port is None else args.multicast_port
+    MULTICAST_INTERFACE = args.multicast_interface
+    log_writer.flush_interval = args.log_flush_interval
+    log_writer.fsync = args.log_fsync
+    HISTORY_BACKLOG = args.history_backlog
+    METRICS_PORT = args.metrics_port
+    STATS_DUMP_INTERVAL = args.stats_interval
+    ADMIN_IPS.update(args.admin_ip)
+    WORKERS = max(1, args.workers)
+    SERVER_NAME = args.name or f"{socket.gethostname()}:{PORT}"
+    FEDERATION_PORT = args.federation_port
+    PEERS.extend(args.peer)
+    if args.federation_secret_file:
+        with open(args.federation_secret_file) as f:
+            FEDERATION_SECRET = f.read().strip() or None
+        if FEDERATION_SECRET is None:
+            parser.error("--federation-secret-file is empty")
+    if WORKERS > 1:
+        start_workers(args.mode, WORKERS)
+    else:
+        start_server(args.mode, take_over() if args.takeover else None)
+
+
 if __name__ == "__main__":
-    start_server()
+    main()
@@ -0,0 +1,322 @@
+"""Segmented, indexed on-disk store for room message history.
+
+Each room gets a directory of append-only segments:
+
+    <directory>/<room>/<base_seq>.log   records
+    <directory>/<room>/<base_seq>.idx   sparse index
+
+Messages in a room are numbered 0, 1, 2, ... A record is a fixed header
+(payload length, seq, timestamp in ms) followed by the payload, which is the
+encoded JSON line exactly as it was broadcast. A segment is sealed once it
+passes segment_bytes and the next one is named after its first seq.
+
+The index holds one (seq, timestamp, offset) entry per index_bytes of
+records, so finding any message means a binary search over segments, a binary
+search over one index, and a scan of at most index_bytes. Reads map the
+segment with mmap instead of reading it into Python buffers.
+"""
+
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote
+
+RECORD_HEADER = struct.Struct("<IQQ")  # payload length, seq, timestamp (ms)
+INDEX_ENTRY = struct.Struct("<QQQ")  # seq, timestamp (ms), offset
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+INDEX_BYTES = 4096
+FLUSH_INTERVAL = 1.0  # seconds a room's appends may sit in Python buffers
+MAX_OPEN_ROOMS = 64  # rooms whose active segment stays open for appends
+
+
+def room_dirname(room):
+    """Filesystem-safe directory name for a room"""
+    return quote(room, safe="").replace(".", "%2E") or "%00"
+
+
+class Segment:
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.idx_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.size = 0
+        # Sparse index, kept as parallel lists for bisect
+        self.seqs = []
+        self.stamps = []
+        self.offsets = []
+
+    def add_index(self, seq, ts, offset):
+        self.seqs.append(seq)
+        self.stamps.append(ts)
+        self.offsets.append(offset)
+
+    def load_index(self):
+        with open(self.idx_path, "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        for seq, ts, offset in INDEX_ENTRY.iter_unpack(data[:usable]):
+            if offset >= self.size:
+                break
+            self.add_index(seq, ts, offset)
+
+    def offset_for_seq(self, seq):
+        """Offset of the last indexed record at or before seq"""
+        i = bisect.bisect_right(self.seqs, seq) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+    def offset_for_time(self, ts):
+        """Offset of the last indexed record stamped before ts"""
+        i = bisect.bisect_left(self.stamps, ts) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+    def scan(self, start, size):
+        """Yield (seq, ts, payload offset, payload length) from start to size"""
+        if size <= start:
+            return
+        with open(self.log_path, "rb") as f:
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+                pos = start
+                while pos + RECORD_HEADER.size <= size:
+                    length, seq, ts = RECORD_HEADER.unpack_from(m, pos)
+                    body = pos + RECORD_HEADER.size
+                    if body + length > size:
+                        break
+                    yield m, seq, ts, body, length
+                    pos = body + length
+
+
+class RoomLog:
+    """The segments of one room; appends and reads are thread-safe"""
+
+    def __init__(self, directory, segment_bytes, index_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_bytes = index_bytes
+        self.lock = threading.Lock()
+        self.segments = []
+        self.next_seq = 0
+        self.last_ts = 0
+        self._log_file = None
+        self._idx_file = None
+        self._last_flush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        bases = sorted(
+            int(name[:-4])
+            for name in os.listdir(self.directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        for base in bases:
+            seg = Segment(self.directory, base)
+            seg.size = os.path.getsize(seg.log_path)
+            if os.path.exists(seg.idx_path):
+                seg.load_index()
+            self.segments.append(seg)
+
+        if self.segments:
+            self._recover(self.segments[-1])
+
+    def _recover(self, seg):
+        """Rebuild the tail of the active segment after an unclean stop.
+
+        Scans from the last index entry, re-creates missing index entries and
+        cuts off a partially written record.
+        """
+        start = seg.offsets[-1] if seg.offsets else 0
+        del_from = bisect.bisect_left(seg.offsets, start)
+        del seg.seqs[del_from:], seg.stamps[del_from:], seg.offsets[del_from:]
+
+        end = start
+        self.next_seq = seg.base_seq
+        for _, seq, ts, body, length in seg.scan(start, seg.size):
+            if not seg.offsets or end - seg.offsets[-1] >= self.index_bytes:
+                seg.add_index(seq, ts, end)
+            end = body + length
+            self.next_seq = seq + 1
+            self.last_ts = ts
+
+        if end < seg.size:
+            with open(seg.log_path, "r+b") as f:
+                f.truncate(end)
+            seg.size = end
+
+        with open(seg.idx_path, "wb") as f:
+            for entry in zip(seg.seqs, seg.stamps, seg.offsets):
+                f.write(INDEX_ENTRY.pack(*entry))
+
+    def _open_active(self):
+        seg = self.segments[-1]
+        self._log_file = open(seg.log_path, "ab")
+        self._idx_file = open(seg.idx_path, "ab")
+
+    def _roll(self):
+        self.close_files()
+        seg = Segment(self.directory, self.next_seq)
+        open(seg.log_path, "ab").close()
+        self.segments.append(seg)
+
+    def append(self, payload, ts):
+        with self.lock:
+            if not self.segments or self.segments[-1].size >= self.segment_bytes:
+                self._roll()
+            if self._log_file is None:
+                self._open_active()
+
+            seg = self.segments[-1]
+            seq = self.next_seq
+            ts = max(ts, self.last_ts)
+            if callable(payload):
+                payload = payload(seq)
+            if not seg.offsets or seg.size - seg.offsets[-1] >= self.index_bytes:
+                seg.add_index(seq, ts, seg.size)
+                self._idx_file.write(INDEX_ENTRY.pack(seq, ts, seg.size))
+
+            self._log_file.write(RECORD_HEADER.pack(len(payload), seq, ts))
+            self._log_file.write(payload)
+            seg.size += RECORD_HEADER.size + len(payload)
+            self.next_seq = seq + 1
+            self.last_ts = ts
+
+            now = time.monotonic()
+            if now - self._last_flush >= FLUSH_INTERVAL:
+                self._flush()
+                self._last_flush = now
+            return seq
+
+    def _flush(self):
+        if self._log_file is not None:
+            self._log_file.flush()
+            self._idx_file.flush()
+
+    def snapshot(self):
+        """Flush pending appends and return (segments, sizes, next_seq)"""
+        with self.lock:
+            self._flush()
+            return list(self.segments), [s.size for s in self.segments], self.next_seq
+
+    def close_files(self):
+        if self._log_file is not None:
+            self._flush()
+            self._log_file.close()
+            self._idx_file.close()
+            self._log_file = None
+            self._idx_file = None
+
+    def read(self, start, stop):
+        """Payloads of messages start <= seq < stop"""
+        segments, sizes, next_seq = self.snapshot()
+        stop = min(stop, next_seq)
+        first = max(0, bisect.bisect_right([s.base_seq for s in segments], start) - 1)
+
+        payloads = []
+        for seg, size in zip(segments[first:], sizes[first:]):
+            if seg.base_seq >= stop:
+                break
+            for m, seq, _, body, length in seg.scan(seg.offset_for_seq(start), size):
+                if seq >= stop:
+                    break
+                if seq >= start:
+                    payloads.append(m[body : body + length])
+        return payloads
+
+    def seq_at_time(self, ts):
+        """First seq stamped at or after ts (next_seq if there is none)"""
+        segments, sizes, next_seq = self.snapshot()
+        firsts = [s.stamps[0] if s.stamps else 0 for s in segments]
+        first = max(0, bisect.bisect_left(firsts, ts) - 1)
+
+        for seg, size in zip(segments[first:], sizes[first:]):
+            for _, seq, stamp, _, _ in seg.scan(seg.offset_for_time(ts), size):
+                if stamp >= ts:
+                    return seq
+        return next_seq
+
+
+class MessageStore:
+    """Per-room segmented history with paged reads.
+
+    append() buffers writes in the caller's thread and returns the message's
+    seq; read() and seq_at_time() cost O(page) however long the history is.
+    Only the active segments of the most recently written max_open rooms keep
+    file handles open.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_bytes=SEGMENT_BYTES,
+        index_bytes=INDEX_BYTES,
+        max_open=MAX_OPEN_ROOMS,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_bytes = index_bytes
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._open = collections.OrderedDict()
+
+    def _room(self, room):
+        with self._lock:
+            log = self._rooms.get(room)
+            if log is None:
+                log = RoomLog(
+                    os.path.join(self.directory, room_dirname(room)),
+                    self.segment_bytes,
+                    self.index_bytes,
+                )
+                self._rooms[room] = log
+            return log
+
+    def append(self, room, payload, ts=None):
+        """Store one encoded message and return its seq within the room.
+
+        payload may also be a function from the seq to the encoded message,
+        for messages that carry their own seq.
+        """
+        if ts is None:
+            ts = int(time.time() * 1000)
+        log = self._room(room)
+        seq = log.append(payload, ts)
+
+        evicted = None
+        with self._lock:
+            self._open[room] = log
+            self._open.move_to_end(room)
+            if len(self._open) > self.max_open:
+                _, evicted = self._open.popitem(last=False)
+        if evicted is not None:
+            with evicted.lock:
+                evicted.close_files()
+        return seq
+
+    def next_seq(self, room):
+        return self._room(room).next_seq
+
+    def read(self, room, before=None, count=50):
+        """Up to `count` messages older than seq `before` (newest if None).
+
+        Returns (first seq, payloads).
+        """
+        log = self._room(room)
+        stop = log.next_seq if before is None else min(before, log.next_seq)
+        start = max(0, stop - count)
+        return start, log.read(start, stop)
+
+    def seq_at_time(self, room, ts):
+        return self._room(room).seq_at_time(ts)
+
+    def close(self):
+        with self._lock:
+            rooms = list(self._rooms.values())
+            self._open.clear()
+        for log in rooms:
+            with log.lock:
+                log.close_files()
@@ -0,0 +1,265 @@
+"""Compact binary wire format, negotiated per connection.
+
+A client that puts "wire": "binary" in its hello may get this format
+instead of JSON lines. A server that supports it answers with the
+WIRE_SWITCH line before anything else, and every byte it sends after that
+line is binary frames. The client in turn sends WIRE_SWITCH as its last
+line once it has seen the server's; what it sends after it is binary frames
+as well. Until then both sides keep speaking JSON lines, so an older peer on
+either end simply never switches.
+
+Every frame is a 5-byte header, the body length as an unsigned 32-bit int
+and a kind byte, followed by the body:
+
+    LINES  JSON lines, exactly as the text protocol would send them; every
+           message without a compact form travels this way
+    NAME   u8 namespace (USER or ROOM), u32 id, then the name in UTF-8:
+           binds the id for the rest of the connection
+    MSG    u32 room id, u32 user id, u64 seq, u32 seconds since midnight,
+           then the text in UTF-8: one chat message
+    SEND   the text of a chat message, client to server
+
+The server interns user and room names to integer ids once, and a
+connection is sent the NAME frame for an id just before the first frame
+that uses it, so each name crosses each connection once. A MSG frame is
+packed once per message and the same bytes are queued for every binary
+member of the room, just like the shared JSON frame.
+
+Compression, if also negotiated, starts after a LINES frame that holds
+exactly the COMPRESS_ACK line, and then covers the binary frames.
+"""
+
+import struct
+import threading
+import zlib
+
+from framing import COMPRESS_ACK, FrameTooLarge, LineDecoder
+
+WIRE_SWITCH = b'{"type": "wire", "format": "binary"}'
+
+LINES, NAME, MSG, SEND = range(4)
+USER, ROOM = range(2)
+
+HEADER = struct.Struct(">IB")
+NAME_HEADER = struct.Struct(">BI")
+MSG_HEADER = struct.Struct(">IIQI")
+NO_SEQ = 2**64 - 1  # seq field of a message that has none
+# Text may hold lone surrogates, which JSON carries as \ud800 escapes; pass
+# them through the same way rather than fail the whole frame
+TEXT_ERRORS = "surrogatepass"
+
+
+def frame(kind, body):
+    return HEADER.pack(len(body), kind) + body
+
+
+def pack_lines(data):
+    """JSON lines wrapped in one LINES frame"""
+    return HEADER.pack(len(data), LINES) + data
+
+
+def pack_payload(payload, encode):
+    """Frame for a payload a client sends; encode turns it into a JSON line"""
+    if payload.get("type") == "msg" and len(payload) == 2:
+        return frame(SEND, payload["msg"].encode("utf-8", TEXT_ERRORS))
+    return pack_lines(encode(payload))
+
+
+def parse_time(text):
+    """Seconds since midnight of an HH:MM:SS time, or None"""
+    try:
+        hours, minutes, seconds = text.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Interner:
+    """Integer ids for user and room names, assigned on first use"""
+
+    def __init__(self):
+        self.ids = ({}, {})  # per namespace: name -> (id, NAME frame)
+        self._lock = threading.Lock()
+
+    def intern(self, namespace, name):
+        """The id of a name and the NAME frame that announces it"""
+        table = self.ids[namespace]
+        found = table.get(name)
+        if found is None:
+            with self._lock:
+                found = table.get(name)
+                if found is None:
+                    name_id = len(table)
+                    body = NAME_HEADER.pack(namespace, name_id) + name.encode("utf-8", TEXT_ERRORS)
+                    found = table[name] = (name_id, frame(NAME, body))
+        return found
+
+
+class Packed:
+    """A message's binary frame plus the names it refers to"""
+
+    __slots__ = ("keys", "names", "data")
+
+    def __init__(self, names, data):
+        self.keys = frozenset(names)  # (namespace, id) pairs
+        self.names = names  # (namespace, id) -> NAME frame
+        self.data = data
+
+
+def pack_message(message, frame_bytes, interner):
+    """Binary form of a message, shared by every binary recipient.
+
+    Chat messages get a MSG frame; anything else is its JSON frame wrapped
+    in a LINES frame.
+    """
+    if message.get("type") == "msg":
+        seconds = parse_time(message.get("time"))
+        room = message.get("room")
+        user = message.get("from")
+        text = message.get("msg")
+        if seconds is not None and all(isinstance(v, str) for v in (room, user, text)):
+            room_id, room_frame = interner.intern(ROOM, room)
+            user_id, user_frame = interner.intern(USER, user)
+            seq = message.get("seq")
+            body = MSG_HEADER.pack(
+                room_id, user_id, NO_SEQ if seq is None else seq, seconds
+            ) + text.encode("utf-8", TEXT_ERRORS)
+            names = {(ROOM, room_id): room_frame, (USER, user_id): user_frame}
+            return Packed(names, frame(MSG, body))
+    return Packed({}, pack_lines(frame_bytes))
+
+
+class Names:
+    """The ids one connection has been sent, for send()ing packed messages.
+
+    A name is only marked known once its NAME frame is queued, so a sender
+    that finds every name of a message known can queue it without the lock
+    and still never overtake a NAME it depends on.
+    """
+
+    def __init__(self):
+        self.known = set()  # (namespace, id) pairs
+        self.lock = threading.Lock()
+
+    def forget(self):
+        """Start over after queued frames were dropped, NAME frames among
+        them: every name is sent again before its next use"""
+        self.known.clear()
+
+    def send(self, packed, send):
+        """Queue a packed message with send(bytes), preceded by the NAME
+        frames this connection has not had yet"""
+        if packed.keys <= self.known:
+            return send(packed.data)
+        with self.lock:
+            intro = b"".join(
+                data for key, data in packed.names.items() if key not in self.known
+            )
+            sent = send(intro + packed.data)
+            self.known |= packed.keys
+        return sent
+
+
+class FrameDecoder(LineDecoder):
+    """LineDecoder that can switch to binary frames.
+
+    After expect_binary(), the decoder hands out lines until the WIRE_SWITCH
+    line (which it hands out too) and decodes binary frames from there on:
+    the lines of each LINES frame, and a message dict for each MSG or SEND
+    frame. NAME frames are kept to decode later messages; a message naming an
+    id no NAME frame bound lost that frame to a slow-consumer drop, and is
+    dropped as well.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.binary = False
+        self.names = ({}, {})  # per namespace: id -> name
+        self._await_switch = False
+
+    def expect_binary(self):
+        self._await_switch = True
+
+    def save(self):
+        """Buffered bytes and format, for a decoder in another process to
+        carry on from with load(); an inflating decoder cannot be carried"""
+        return bytes(self.buffer), self.binary, self._await_switch
+
+    def load(self, buffer, binary, await_switch):
+        self.buffer += buffer
+        self.binary = binary
+        self._await_switch = await_switch
+
+    def feed(self, data):
+        if self.binary:
+            return self._feed_frames(data)
+        frames = super().feed(data)
+        if self._await_switch and WIRE_SWITCH in frames:
+            end = frames.index(WIRE_SWITCH) + 1
+            # The lines after it were really binary frames split at newlines
+            rest = b"".join(line + b"\n" for line in frames[end:]) + bytes(self.buffer)
+            del self.buffer[:]
+            self._await_switch = False
+            self.binary = True
+            return frames[:end] + self._feed_frames(rest)
+        return frames
+
+    def _feed_frames(self, data):
+        if self._inflater is not None:
+            data = self._inflater.decompress(data)
+        buf = self.buffer
+        buf += data
+        out = []
+        pos = 0
+        while len(buf) - pos >= HEADER.size:
+            length, kind = HEADER.unpack_from(buf, pos)
+            if length > self.max_frame:
+                raise FrameTooLarge(f"frame of {length} bytes exceeds limit")
+            end = pos + HEADER.size + length
+            if end > len(buf):
+                break
+            body = bytes(buf[pos + HEADER.size : end])
+            pos = end
+            if kind == LINES:
+                if self._await_ack and body == COMPRESS_ACK + b"\n":
+                    # Everything after the acknowledgement is compressed
+                    self._await_ack = False
+                    self._inflater = zlib.decompressobj()
+                    rest = self._inflater.decompress(bytes(buf[pos:]))
+                    del buf[:]
+                    buf += rest
+                    pos = 0
+                out.extend(body.rstrip(b"\n").split(b"\n"))
+            elif kind == MSG:
+                message = self._unpack_message(body)
+                if message is not None:
+                    out.append(message)
+            elif kind == NAME:
+                namespace, name_id = NAME_HEADER.unpack_from(body)
+                self.names[namespace][name_id] = body[NAME_HEADER.size :].decode("utf-8", TEXT_ERRORS)
+            elif kind == SEND:
+                out.append({"type": "msg", "msg": body.decode("utf-8", TEXT_ERRORS)})
+        if pos:
+            del buf[:pos]
+        return out
+
+    def _unpack_message(self, body):
+        room_id, user_id, seq, seconds = MSG_HEADER.unpack_from(body)
+        room = self.names[ROOM].get(room_id)
+        user = self.names[USER].get(user_id)
+        if room is None or user is None:
+            return None
+        message = {
+            "type": "msg",
+            "room": room,
+            "from": user,
+            "msg": body[MSG_HEADER.size :].decode("utf-8", TEXT_ERRORS),
+            "time": format_time(seconds),
+        }
+        if seq != NO_SEQ:
+            message["seq"] = seq
+        return message